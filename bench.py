@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the render pipeline.
+
+Everything runs against local fixtures: images are served from the repo
+(background.jpg, plp.jpg) and AniList from canned payloads, through a stub
+HTTP session, so results only depend on this machine and this code.
+
+Reports, per render:
+- p50/p95 latency of generate_thumbnail and of each stage (download, decode,
+  resize, layout, composite, encode; see thumbnail.set_stage_hook)
+- renders/sec with 1..N concurrent workers
+- peak RSS of this process (and of render worker processes)
+
+Usage:
+    python bench.py                              # print results
+    python bench.py --out bench.json             # save them
+    python bench.py --compare bench.json         # flag regressions, exit 1 if any
+    python bench.py --renders 50 --workers 4 --backend process --encoder jpeg
+
+By default every timed render is cold for images (downloaded from the stub and
+decoded again); fonts, text measurements and the static layer stay warm, as in
+a long-running bot. --warm keeps the decoded images too. Latency and stage
+timings are always measured in this process; --backend only changes how the
+throughput runs render.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+# Must be set before thumbnail is imported: its caches are created at import time
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="thumbgen-bench-"))
+os.environ.setdefault("FONTS_DIR", os.path.join(HERE, "fonts"))
+os.environ.setdefault("NO_BOT", "1")
+
+import requests
+import PIL
+
+import thumbnail
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FIXTURE_HOST = "https://fixtures.invalid/"
+STAGES = ("download", "decode", "resize", "layout", "composite", "encode")
+
+# ---------- Fixtures ----------
+ANIME = [
+    {
+        "id": 1001,
+        "title": {"english": "Spy x Family Code: White", "romaji": "Spy x Family Movie"},
+        "coverImage": {"extraLarge": FIXTURE_HOST + "background.jpg"},
+        "averageScore": 85,
+        "genres": ["Action", "Comedy", "Slice of Life"],
+        "description": "A spy, an assassin and a telepath &mdash; a found family that must pretend to be normal. " * 4,
+        "status": "FINISHED",
+        "season": "WINTER",
+        "seasonYear": 2023,
+        "studios": {"nodes": [{"name": "WIT STUDIO"}]},
+        "characters": {"nodes": [{
+            "name": {"full": "Anya Forger"},
+            "description": "Anya is a young girl who can read people's thoughts and is the only one who "
+                           "escaped from an experimental human test subject dubbed '007'.",
+            "image": {"large": FIXTURE_HOST + "plp.jpg"},
+        }]},
+    },
+    {
+        "id": 1002,
+        "title": {"english": "Attack on Titan", "romaji": "Shingeki no Kyojin"},
+        "coverImage": {"extraLarge": FIXTURE_HOST + "plp.jpg"},
+        "averageScore": 84,
+        "genres": ["Action", "Drama", "Fantasy", "Mystery", "Supernatural"],
+        "description": "Several hundred years ago, humans were nearly exterminated by titans. Titans are "
+                       "typically several stories tall, seem to have no intelligence, devour human beings "
+                       "and, worst of all, seem to do it for the pleasure rather than as a food source.<br>",
+        "status": "FINISHED",
+        "season": "SPRING",
+        "seasonYear": 2013,
+        "studios": {"nodes": [{"name": "WIT STUDIO"}]},
+        "characters": {"nodes": [{
+            "name": {"full": "Eren Yeager"},
+            "description": "Eren is the main protagonist of Attack on Titan.",
+            "image": {"large": None},
+        }]},
+    },
+    {
+        "id": 1003,
+        "title": {"english": None, "romaji": "Watashi no Totemo Nagai Anime Title That Should Be Wrapped Properly"},
+        "coverImage": {"extraLarge": FIXTURE_HOST + "background.jpg"},
+        "averageScore": None,
+        "genres": ["Romance"],
+        "description": None,
+        "status": "RELEASING",
+        "season": None,
+        "seasonYear": None,
+        "studios": {"nodes": []},
+        "characters": {"nodes": []},
+    },
+]
+
+
+class FixtureResponse:
+    def __init__(self, status_code, content=b"", headers=None, payload=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self._payload = payload
+
+    def json(self):
+        return self._payload if self._payload is not None else json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} from fixture session", response=self)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FixtureSession:
+    """
+    Stands in for thumbnail.http_session(): GETs under FIXTURE_HOST are served
+    from files in the repo directory (anything else is a 404), POSTs are
+    answered as AniList GraphQL from `anime`. `latency` adds a fixed delay
+    to every request, to model a network round-trip.
+    """
+
+    def __init__(self, anime=ANIME, root=HERE, latency=0.0):
+        self.anime = anime
+        self.root = root
+        self.latency = latency
+        self.requests = 0
+        self._files = {}
+
+    def _wait(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self._wait()
+        return self.serve_get(url, headers)
+
+    def serve_get(self, url, headers=None):
+        if not url.startswith(FIXTURE_HOST):
+            return FixtureResponse(404)
+        name = url[len(FIXTURE_HOST):]
+        if name not in self._files:
+            path = os.path.join(self.root, name)
+            self._files[name] = None
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    self._files[name] = f.read()
+        data = self._files[name]
+        if data is None:
+            return FixtureResponse(404)
+        etag = f'"{len(data)}"'
+        if headers and headers.get("If-None-Match") == etag:
+            return FixtureResponse(304, headers={"ETag": etag})
+        return FixtureResponse(200, data, {"ETag": etag, "Content-Type": "image/jpeg"})
+
+    def find(self, search):
+        want = thumbnail.normalize_search(search)
+        for media in self.anime:
+            titles = [t for t in (media.get("title") or {}).values() if t]
+            if any(want in thumbnail.normalize_search(t) for t in titles):
+                return media
+        return None
+
+    def post(self, url, json=None, timeout=None, **kwargs):
+        self._wait()
+        return self.serve_post(json)
+
+    def serve_post(self, json=None):
+        variables = (json or {}).get("variables") or {}
+        data = {}
+        if "page" in variables:
+            # trending / season lists: fixture order is the ranking
+            media = [m for m in self.anime if "season" not in variables
+                     or (m.get("season"), m.get("seasonYear")) == (variables["season"], variables["seasonYear"])]
+            per_page = variables.get("perPage") or 50
+            start = (variables["page"] - 1) * per_page
+            return FixtureResponse(200, payload={"data": {"Page": {"media": media[start:start + per_page]}}})
+        if "id" in variables:
+            data["Media"] = next((m for m in self.anime if m.get("id") == variables["id"]), None)
+        elif "search" in variables:
+            data["Media"] = self.find(variables["search"])
+        else:
+            # batched query: $s0, $s1, ... (searches) or $i0, $i1, ... (IDs)
+            # answered as aliases m0, m1, ...
+            for name, value in variables.items():
+                if name.startswith("i"):
+                    data["m" + name[1:]] = next((m for m in self.anime if m.get("id") == value), None)
+                else:
+                    data["m" + name[1:]] = self.find(value)
+        # like AniList, a batch reports aliases that matched nothing as 404 errors
+        errors = [{"status": 404, "message": "Not Found.", "path": [alias]}
+                  for alias, media in data.items() if media is None and alias != "Media"]
+        return FixtureResponse(200, payload={"data": data, "errors": errors} if errors else {"data": data})
+
+
+class FixtureAsyncHTTP:
+    """
+    Stands in for thumbnail.async_http(), answering from a FixtureSession;
+    the latency is an asyncio.sleep, so concurrent requests overlap.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    async def request(self, method, url, headers=None, json=None, timeout=10, max_bytes=None):
+        self.session.requests += 1
+        if self.session.latency:
+            await asyncio.sleep(self.session.latency)
+        if method == "POST":
+            r = self.session.serve_post(json)
+        else:
+            r = self.session.serve_get(url, headers)
+        if max_bytes is not None and r.status_code < 300 and len(r.content) > max_bytes:
+            raise thumbnail.TooLarge(f"{url}: body is over the {max_bytes} byte limit")
+        return thumbnail.HTTPResult(r.status_code, r.headers, self._body(r), url)
+
+    @staticmethod
+    def _body(r):
+        return r.content if r._payload is None else json.dumps(r._payload).encode("utf-8")
+
+    async def close(self):
+        pass
+
+
+def install_fixtures(latency=0.0):
+    """
+    Routes all of thumbnail's HTTP traffic, sync and async, to a
+    FixtureSession, with AniList's rate limit lifted. Returns it.
+    """
+    session = FixtureSession(latency=latency)
+    thumbnail._http_session = session
+    thumbnail._async_http = FixtureAsyncHTTP(session)
+    thumbnail.anilist_limiter = thumbnail.RateLimiter(rate=1e6, burst=1e6)
+    return session
+
+class FakeAniListServer:
+    """
+    A real HTTP server on 127.0.0.1 standing in for AniList and the image
+    CDN, answering like FixtureSession: POST / is GraphQL, GET /<file>
+    serves an image fixture. Image URLs in its payloads point back at it.
+    Use it to run thumbnail against real sockets, with ANILIST_URL set to
+    server.url (or thumbnail.ANILIST_URL assigned):
+
+        with FakeAniListServer() as server:
+            ...
+    """
+
+    def __init__(self, anime=ANIME, latency=0.0):
+        self.session = FixtureSession(anime, latency=latency)
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    query = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return self._send(400, b'{"errors": [{"message": "bad JSON"}]}')
+                fake.session._wait()
+                r = fake.session.serve_post(query)
+                body = json.dumps(r.json()).replace(FIXTURE_HOST, fake.url)
+                self._send(r.status_code, body.encode("utf-8"), {"Content-Type": "application/json",
+                                                                 "X-RateLimit-Limit": "90", "X-RateLimit-Remaining": "89"})
+
+            def do_GET(self):
+                fake.session._wait()
+                headers = {"If-None-Match": self.headers["If-None-Match"]} if self.headers.get("If-None-Match") else None
+                r = fake.session.serve_get(FIXTURE_HOST + self.path.lstrip("/"), headers)
+                self._send(r.status_code, r.content, r.headers)
+
+            def _send(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-anilist", daemon=True).start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ---------- Measurement ----------
+class StageRecorder:
+    """
+    Stage hook for thumbnail.set_stage_hook. Records exclusive time per
+    stage (a nested stage's time is not counted again in its parent) for
+    the render running on the current thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.times = dict.fromkeys(STAGES, 0.0)
+        self._local.stack = []
+
+    def end(self):
+        return getattr(self._local, "times", None) or {}
+
+    def __call__(self, name):
+        return _StageTimer(self._local, name)
+
+
+class _StageTimer:
+    def __init__(self, local, name):
+        self.local = local
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is not None:
+            stack.append([time.perf_counter(), 0.0])
+
+    def __exit__(self, *exc):
+        stack = getattr(self.local, "stack", None)
+        if not stack:
+            return False
+        start, nested = stack.pop()
+        elapsed = time.perf_counter() - start
+        times = self.local.times
+        times[self.name] = times.get(self.name, 0.0) + elapsed - nested
+        if stack:
+            stack[-1][1] += elapsed
+        return False
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of values (pct in 0..100).
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        "p50": round(percentile(ms, 50), 3),
+        "p95": round(percentile(ms, 95), 3),
+        "mean": round(sum(ms) / len(ms), 3) if ms else 0.0,
+    }
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size in MiB of this process and, with children=True, of
+    the largest child process that has exited (render workers, after the pool
+    is shut down). None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    scale = 1.0 / 1024 if sys.platform != "darwin" else 1.0 / (1024 * 1024)  # KiB on Linux, bytes on macOS
+    peak = {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1)}
+    if children:
+        peak["children"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1)
+    return peak
+
+
+def _forget_images(anime):
+    """
+    Drops decoded and downloaded copies of anime's images so the next render
+    fetches (from the fixtures) and decodes them again.
+    """
+    thumbnail.image_mem_cache.clear()
+    for url in thumbnail.thumbnail_image_urls(anime):
+        if url:
+            thumbnail.image_disk_cache.delete(url)
+
+
+def measure_latency(anime_list, renders, encoder, warm=False):
+    """
+    Per-stage latency of sequential renders, and how far each render raised
+    the process RSS above where it started (where /proc allows measuring it).
+    """
+    recorder = StageRecorder()
+    thumbnail.set_stage_hook(recorder)
+    totals, stages, peaks = [], {name: [] for name in STAGES}, []
+    try:
+        for i in range(renders):
+            anime = anime_list[i % len(anime_list)]
+            if not warm:
+                _forget_images(anime)
+            tracked = thumbnail.reset_peak_rss()
+            before = thumbnail.rss_bytes()
+            recorder.begin()
+            start = time.perf_counter()
+            thumbnail.generate_thumbnail(anime, use_cache=False, encoder=encoder)
+            totals.append(time.perf_counter() - start)
+            for name, secs in recorder.end().items():
+                stages.setdefault(name, []).append(secs)
+            if tracked and before is not None:
+                peaks.append(max(0, thumbnail.peak_rss_bytes() - before))
+    finally:
+        thumbnail.set_stage_hook(None)
+    memory = None
+    if peaks:
+        mib = [p / (1024 * 1024) for p in peaks]
+        memory = {"p50": round(percentile(mib, 50), 1), "max": round(max(mib), 1)}
+    return {"total": summarize(totals), "stages": {name: summarize(v) for name, v in stages.items()}}, memory
+
+
+def measure_throughput(anime_list, renders, max_workers, encoder, backend):
+    """
+    renders/sec for 1..max_workers concurrent generate_thumbnail calls
+    (image caches warm, render cache bypassed), and for the process backend
+    the largest worker RSS seen during a job, in MiB.
+    """
+    results = {}
+    worker_peak = 0
+    saved_backend, saved_pool = thumbnail.RENDER_BACKEND, thumbnail._render_pool
+    thumbnail.RENDER_BACKEND = backend
+    try:
+        for workers in range(1, max_workers + 1):
+            pool = None
+            if backend == "process":
+                pool = thumbnail._render_pool = thumbnail.RenderPool(processes=workers)
+                # start the workers outside the timed section
+                thumbnail.generate_thumbnail(anime_list[0], use_cache=False, encoder=encoder)
+            jobs = [anime_list[i % len(anime_list)] for i in range(renders)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                start = time.perf_counter()
+                list(executor.map(lambda a: thumbnail.generate_thumbnail(a, use_cache=False, encoder=encoder), jobs))
+                elapsed = time.perf_counter() - start
+            results[str(workers)] = round(renders / elapsed, 3)
+            if pool is not None:
+                worker_peak = max(worker_peak, pool.stats()["peak_rss_max"])
+                pool.shutdown()
+    finally:
+        thumbnail.RENDER_BACKEND, thumbnail._render_pool = saved_backend, saved_pool
+    return results, (round(worker_peak / (1024 * 1024), 1) if worker_peak else None)
+
+
+def run_benchmark(renders=30, workers=None, encoder="png", backend="thread", warm=False, latency=0.0):
+    """
+    Runs the whole suite offline. Returns the result dict (what --out saves).
+    """
+    workers = workers or (os.cpu_count() or 1)
+    session = install_fixtures(latency=latency)
+    names = [(a["title"].get("english") or a["title"].get("romaji")) for a in ANIME]
+    anime_list = [thumbnail.fetch_anime_from_anilist(n) for n in names]
+    if not all(anime_list):
+        raise RuntimeError("fixture AniList lookup failed")
+    # warm-up: fonts, static layers, text measurements
+    for anime in anime_list:
+        thumbnail.generate_thumbnail(anime, use_cache=False, encoder=encoder)
+    latency_ms, render_peak = measure_latency(anime_list, renders, encoder, warm=warm)
+    renders_per_sec, worker_peak = measure_throughput(anime_list, renders, workers, encoder, backend)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": f"{platform.system()} {platform.release()} {platform.machine()}",
+            "cpus": os.cpu_count(),
+            "renders": renders,
+            "encoder": encoder,
+            "backend": backend,
+            "images": "warm" if warm else "cold",
+            "latency_ms": latency * 1000,
+        },
+        "latency_ms": latency_ms,
+        "renders_per_sec": renders_per_sec,
+        "peak_rss_mb": peak_rss_mb(children=(backend == "process")),
+        # RSS growth during one in-process render (p50/max), and the peak RSS
+        # of a render worker process during a job: budget workers * that
+        "render_peak_mb": render_peak,
+        "worker_peak_rss_mb": worker_peak,
+        "http_requests": session.requests,
+    }
+
+# ---------- Reporting ----------
+def compare(current, baseline, threshold=0.10, min_ms=1.0):
+    """
+    Lists regressions of current against baseline: latencies more than
+    `threshold` (fraction) and `min_ms` slower, throughput more than
+    `threshold` lower. Returns a list of human-readable strings.
+    """
+    problems = []
+
+    def check_latency(label, new, old):
+        for pct in ("p50", "p95"):
+            a, b = new.get(pct), (old or {}).get(pct)
+            if a is None or not b:
+                continue
+            if a > b * (1 + threshold) and a - b >= min_ms:
+                problems.append(f"{label} {pct}: {b:.1f} -> {a:.1f} ms (+{(a / b - 1) * 100:.0f}%)")
+
+    cur, base = current["latency_ms"], baseline.get("latency_ms", {})
+    check_latency("total", cur["total"], base.get("total"))
+    for name, stats in cur["stages"].items():
+        check_latency(name, stats, base.get("stages", {}).get(name))
+    for workers, rate in current["renders_per_sec"].items():
+        old = baseline.get("renders_per_sec", {}).get(workers)
+        if old and rate < old * (1 - threshold):
+            problems.append(f"renders/sec at {workers} workers: {old:.2f} -> {rate:.2f} ({(rate / old - 1) * 100:.0f}%)")
+    return problems
+
+
+def print_report(result):
+    meta = result["meta"]
+    print(f"Render benchmark: {meta['renders']} renders, encoder={meta['encoder']}, "
+          f"backend={meta['backend']}, images {meta['images']}, {meta['cpus']} CPUs")
+    print(f"{'stage':<12} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}")
+    rows = list(result["latency_ms"]["stages"].items()) + [("total", result["latency_ms"]["total"])]
+    for name, stats in rows:
+        print(f"{name:<12} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['mean']:>9.2f}")
+    print("renders/sec: " + ", ".join(f"{w} worker(s) {r:.2f}" for w, r in result["renders_per_sec"].items()))
+    rss = result["peak_rss_mb"]
+    if rss:
+        workers = f" (largest render worker {rss['children']:.1f} MiB)" if "children" in rss else ""
+        print(f"peak RSS: {rss['self']:.1f} MiB{workers}")
+    per_render = result.get("render_peak_mb")
+    if per_render:
+        print(f"memory per render: +{per_render['p50']:.1f} MiB p50, +{per_render['max']:.1f} MiB max above the idle RSS")
+    if result.get("worker_peak_rss_mb"):
+        print(f"render worker peak RSS during a job: {result['worker_peak_rss_mb']:.1f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline render pipeline benchmark")
+    parser.add_argument("--renders", type=int, default=30, help="timed renders per measurement (default 30)")
+    parser.add_argument("--workers", type=int, default=None, help="measure throughput for 1..N workers (default: CPUs)")
+    parser.add_argument("--encoder", default="png", choices=sorted(thumbnail.ENCODER_PROFILES))
+    parser.add_argument("--backend", default="thread", choices=("thread", "process"))
+    parser.add_argument("--warm", action="store_true", help="keep decoded images between renders")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated network round-trip per request")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --out; exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown as a fraction (default 0.10)")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(renders=args.renders, workers=args.workers, encoder=args.encoder,
+                           backend=args.backend, warm=args.warm, latency=args.latency_ms / 1000)
+    print_report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved results to {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        problems = compare(result, baseline, threshold=args.threshold)
+        if problems:
+            print(f"REGRESSIONS against {args.compare}:")
+            for p in problems:
+                print(f"  ✗ {p}")
+            return 1
+        print(f"  ✓ No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
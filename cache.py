@@ -0,0 +1,287 @@
+"""
+Caching primitives shared by the thumbnail generator.
+- LRUCache: thread-safe in-memory LRU bounded by entry count and/or bytes
+- DiskStore: on-disk content store keyed by string, bounded by bytes
+
+DiskStore is safe to share between several worker processes: entries are
+written to a temp file and atomically renamed into place, readers tolerate
+entries vanishing underneath them, and eviction runs under an advisory lock
+so only one process sweeps the directory at a time.
+"""
+
+import os
+import json
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction still works, just without the cross-process lock
+    fcntl = None
+
+
+class LRUCache:
+    """
+    Least-recently-used mapping. Bounded by max_entries and/or max_bytes
+    (size of each value given by sizeof(value), or explicitly on put).
+    Keeps hit/miss/eviction counters.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None, name="lru"):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda v: 0)
+        self._data = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None):
+        size = self.sizeof(value) if size is None else size
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                # would evict everything else and still not fit
+                return False
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            self._evict_locked()
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self._bytes -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _evict_locked(self):
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+class DiskStore:
+    """
+    Byte-budgeted store of blobs on disk. Each entry is one file holding a
+    JSON metadata line followed by the payload, so a single rename publishes
+    both atomically. Recency is tracked through the file mtime (touched on
+    every hit) and the least recently used files are removed first.
+    """
+
+    TMP_PREFIX = ".tmp-"
+    STALE_TMP_AGE = 3600  # seconds; leftovers from crashed writers
+
+    def __init__(self, root, max_bytes, name="disk"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+        # bytes written since the last sweep; the true total is shared with
+        # other processes so it is only known after scanning the directory
+        self._pending = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """
+        Returns (payload_bytes, meta_dict) or None.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header = f.readline()
+                payload = f.read()
+            meta = json.loads(header)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError):
+            # truncated or foreign file: drop it
+            self.misses += 1
+            self.delete(key)
+            return None
+        if meta.get("key") != key or meta.get("size") != len(payload):
+            self.misses += 1
+            self.delete(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return payload, meta
+
+    def put(self, key, payload, meta=None):
+        meta = dict(meta or {})
+        meta["key"] = key
+        meta["size"] = len(payload)
+        meta.setdefault("stored_at", time.time())
+        header = json.dumps(meta, separators=(",", ":")).encode("utf-8") + b"\n"
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(header)
+                    f.write(payload)
+                os.replace(tmp, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        except OSError:
+            return False
+        with self._lock:
+            self.writes += 1
+            self._pending += len(header) + len(payload)
+            sweep = self._pending > self.max_bytes // 10
+            if sweep:
+                self._pending = 0
+        if sweep:
+            self.evict()
+        return True
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+            return True
+        except OSError:
+            return False
+
+    def _scan(self):
+        entries = []
+        now = time.time()
+        for sub in os.scandir(self.root):
+            if not sub.is_dir() or len(sub.name) != 2:
+                continue
+            try:
+                files = list(os.scandir(sub.path))
+            except OSError:
+                continue
+            for f in files:
+                try:
+                    st = f.stat()
+                except OSError:
+                    continue
+                if f.name.startswith(self.TMP_PREFIX):
+                    if now - st.st_mtime > self.STALE_TMP_AGE:
+                        try:
+                            os.unlink(f.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, f.path))
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used entries until the store is back under
+        90% of its byte budget. Returns number of bytes in use afterwards.
+        """
+        lock_file = None
+        if fcntl is not None:
+            try:
+                lock_file = open(os.path.join(self.root, ".lock"), "a")
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if lock_file is not None:
+                    lock_file.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    return None  # another process is already sweeping
+                lock_file = None
+        try:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return total
+            target = int(self.max_bytes * 0.9)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+            return total
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def usage(self):
+        return sum(size for _, size, _ in self._scan())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writes": self.writes,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
@@ -0,0 +1,283 @@
+"""
+Process-local instrumentation for the bot and the render pipeline.
+- inc() / observe() / span(): counters, histograms and timing spans with
+  labels; they do nothing (span returns a shared no-op context) until
+  enable() is called, so instrumented hot paths cost one flag check when off
+- register_collector(): callbacks that report gauges (cache sizes, hit
+  ratios, queue depth) only when the metrics are read
+- render_prometheus(): everything in Prometheus text exposition format,
+  served by start_http_server() or written to the log by install_signal_dump()
+- request IDs: new_request_id() sets a contextvar that RequestIdFilter adds
+  to every log record as %(request_id)s
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; covers a cached render (ms) up to a slow upload (tens of seconds)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+NAMESPACE = "thumbgen"
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}    # name -> {labels: value}
+_histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+_help = {}
+_collectors = []
+_dump_pipe = None  # (read fd, write fd) between the signal handler and the dump thread
+_NO_SPAN = nullcontext()
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+logger = logging.getLogger("anime-mayhem-gen")
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = bool(on)
+
+
+def enabled():
+    return _enabled
+
+
+def describe(name, text):
+    """
+    Sets the HELP text of a metric.
+    """
+    _help[name] = text
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name, value=1, **labels):
+    """
+    Adds value to the counter name{labels}.
+    """
+    if not _enabled:
+        return
+    key = _labels(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """
+    Records value (seconds for latencies) in the histogram name{labels}.
+    """
+    if not _enabled:
+        return
+    key = _labels(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        row = series.get(key)
+        if row is None:
+            row = series[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                row[i] += 1
+                break
+        row[-2] += value
+        row[-1] += 1
+
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.labels
+        if exc_type is not None:
+            labels = dict(labels, error=exc_type.__name__)
+        observe(self.name + "_seconds", time.perf_counter() - self.start, **labels)
+        return False
+
+
+def span(name, **labels):
+    """
+    Times the with-block into the histogram <name>_seconds{labels}; a block
+    that raises is recorded with an extra error=<exception class> label.
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, labels)
+
+
+def register_collector(fn):
+    """
+    fn() is called whenever metrics are rendered and returns an iterable of
+    (name, labels_dict, value) gauges.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+def unregister_collector(fn):
+    if fn in _collectors:
+        _collectors.remove(fn)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+# ---------- Exposition ----------
+def _fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for k, v in items)
+    return "{" + body + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def render_prometheus():
+    """
+    All counters, histograms and collected gauges in Prometheus text format.
+    """
+    lines = []
+
+    def header(name, kind, base):
+        if base in _help:
+            lines.append(f"# HELP {name} {_help[base]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with _lock:
+        counters = {n: dict(s) for n, s in _counters.items()}
+        histograms = {n: {k: list(r) for k, r in s.items()} for n, s in _histograms.items()}
+    for name in sorted(counters):
+        full = f"{NAMESPACE}_{name}"
+        header(full, "counter", name)
+        for key, value in sorted(counters[name].items()):
+            lines.append(f"{full}{_fmt_labels(key)} {_fmt_value(value)}")
+    for name in sorted(histograms):
+        full = f"{NAMESPACE}_{name}"
+        header(full, "histogram", name)
+        for key, row in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS, row):
+                cumulative += count
+                lines.append(f"{full}_bucket{_fmt_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{full}_bucket{_fmt_labels(key, [('le', '+Inf')])} {row[-1]}")
+            lines.append(f"{full}_sum{_fmt_labels(key)} {_fmt_value(row[-2])}")
+            lines.append(f"{full}_count{_fmt_labels(key)} {row[-1]}")
+    gauges = {}
+    for fn in list(_collectors):
+        try:
+            for name, labels, value in fn():
+                gauges.setdefault(name, []).append((_labels(labels), value))
+        except Exception as e:
+            logger.warning(f"Metrics collector {getattr(fn, '__name__', fn)} failed: {e}")
+    for name in sorted(gauges):
+        full = f"{NAMESPACE}_{name}"
+        header(full, "gauge", name)
+        for key, value in sorted(gauges[name], key=lambda item: item[0]):
+            lines.append(f"{full}{_fmt_labels(key)} {_fmt_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line each
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """
+    Serves GET /metrics on host:port from a daemon thread. Returns the server
+    (server.server_address has the real port when port is 0).
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics endpoint on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def install_signal_dump(signum=None):
+    """
+    Logs render_prometheus() whenever the process receives signum (SIGUSR1
+    by default). Returns False where that signal does not exist (Windows).
+    The handler only writes a byte to a pipe: it runs on the main thread
+    between bytecodes, possibly while that thread holds _lock (or a cache's
+    lock), so the dump itself happens on a daemon thread.
+    """
+    import signal
+    global _dump_pipe
+    signum = signum if signum is not None else getattr(signal, "SIGUSR1", None)
+    if signum is None:
+        return False
+    if _dump_pipe is None:
+        _dump_pipe = os.pipe()
+        os.set_blocking(_dump_pipe[1], False)
+        threading.Thread(target=_dump_loop, args=(_dump_pipe[0],), name="metrics-dump", daemon=True).start()
+    signal.signal(signum, _request_dump)
+    return True
+
+
+def _request_dump(*_):
+    try:
+        os.write(_dump_pipe[1], b"\0")
+    except BlockingIOError:
+        pass  # plenty of dumps already pending
+
+
+def _dump_loop(fd):
+    while os.read(fd, 64):
+        try:
+            logger.info("Metrics dump:\n" + render_prometheus())
+        except Exception as e:
+            logger.warning(f"Metrics dump failed: {e}")
+
+# ---------- Request IDs ----------
+def new_request_id():
+    """
+    Starts a new request: sets and returns a short random ID for the current context.
+    """
+    rid = uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    return rid
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds record.request_id (the current request's ID, "-" outside a request).
+    Attach it to handlers so records from every logger get the field.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
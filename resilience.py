@@ -0,0 +1,404 @@
+"""
+Latency budgets and failure isolation for calls to upstream services.
+- Deadline: the point in time a request has to be answered by; hands each
+  network call a timeout cut from what is left of the budget
+- CircuitBreaker: stops calling a host after repeated failures, for a
+  cool-down, then lets a single trial call through (half-open)
+- RateLimiter: token bucket that hands out request slots by priority, to
+  threads and coroutines alike, and follows the server's own rate headers
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's budget is spent; the call was not made."""
+
+
+class CircuitOpen(Exception):
+    """
+    The host's circuit is open; the call was not made.
+    retry_after: seconds until the circuit lets a trial call through.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """
+    Deadline(8.0) expires 8 s from now; Deadline(None) never expires, so
+    code can take a deadline unconditionally and callers that do not care
+    pass nothing.
+    """
+
+    __slots__ = ("expires_at", "_clock")
+
+    def __init__(self, seconds=None, clock=time.monotonic):
+        self._clock = clock
+        self.expires_at = None if seconds is None else clock() + seconds
+
+    @classmethod
+    def coerce(cls, value):
+        """
+        A Deadline from None (unbounded), a number of seconds, or a Deadline.
+        """
+        if isinstance(value, Deadline):
+            return value
+        return cls(value)
+
+    @property
+    def bounded(self):
+        return self.expires_at is not None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - self._clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, share=1.0, reserve=0.0):
+        """
+        Timeout for one call: `share` of what is left once `reserve` seconds
+        are kept back for later steps, and never more than cap. Raises
+        DeadlineExceeded when nothing is left.
+        """
+        if self.expires_at is None:
+            return cap
+        left = (self.remaining() - reserve) * share
+        if left <= 0:
+            raise DeadlineExceeded(f"deadline exceeded ({reserve:.1f}s reserved)" if reserve else "deadline exceeded")
+        return left if cap is None else min(cap, left)
+
+    def __repr__(self):
+        return "Deadline(None)" if self.expires_at is None else f"Deadline({self.remaining():.3f}s left)"
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. `failures` consecutive failures open a host's
+    circuit for `cooldown` seconds, during which allow() refuses calls.
+    After the cool-down one trial call is let through: success closes the
+    circuit, failure opens it for another cool-down. Thread-safe.
+    """
+
+    def __init__(self, failures=5, cooldown=30.0, clock=time.monotonic):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> [consecutive failures, opened_at or None, trial started_at or None]
+        self.opened = 0
+        self.rejected = 0
+
+    def _entry(self, host):
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = [0, None, None]
+        return entry
+
+    def _state(self, entry, now):
+        if entry[1] is None:
+            return "closed"
+        return "open" if now - entry[1] < self.cooldown else "half-open"
+
+    def allow(self, host):
+        """
+        True when a call to host may go ahead. In half-open state only the
+        first caller gets True until its outcome is reported (or, should it
+        never be, until another cool-down has passed).
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                return True
+            state = self._state(entry, now)
+            if state == "closed":
+                return True
+            if state == "half-open" and (entry[2] is None or now - entry[2] >= self.cooldown):
+                entry[2] = now
+                return True
+            self.rejected += 1
+            return False
+
+    def check(self, host):
+        """
+        allow(), raising CircuitOpen instead of returning False.
+        """
+        if not self.allow(host):
+            retry = self.retry_in(host)
+            raise CircuitOpen(f"{host}: circuit open, retrying in {retry:.0f}s", retry_after=retry)
+
+    def retry_in(self, host):
+        """
+        Seconds until host's circuit lets a trial call through (0 if closed).
+        """
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None or entry[1] is None:
+                return 0.0
+            return max(0.0, entry[1] + self.cooldown - self._clock())
+
+    def success(self, host):
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is not None:
+                entry[0] = 0
+                entry[1] = entry[2] = None
+
+    def failure(self, host):
+        now = self._clock()
+        with self._lock:
+            entry = self._entry(host)
+            entry[0] += 1
+            trial = entry[2] is not None
+            entry[2] = None
+            if trial or (entry[1] is None and entry[0] >= self.failures):
+                if entry[1] is None:
+                    self.opened += 1
+                entry[1] = now
+
+    def state(self, host):
+        """
+        "closed", "open" or "half-open".
+        """
+        with self._lock:
+            entry = self._hosts.get(host)
+            return "closed" if entry is None else self._state(entry, self._clock())
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            hosts = {host: self._state(entry, now) for host, entry in self._hosts.items()}
+        return {"hosts": hosts, "opened": self.opened, "rejected": self.rejected}
+
+
+class _Waiter:
+    __slots__ = ("priority", "notify", "granted", "cancelled")
+
+    def __init__(self, priority, notify):
+        self.priority = priority
+        self.notify = notify
+        self.granted = False
+        self.cancelled = False
+
+
+class RateLimiter:
+    """
+    Token bucket: `rate` tokens per second, at most `burst` saved up. Each
+    request takes a token with acquire() (threads) or acquire_async()
+    (coroutines, without blocking the loop). Callers that have to wait queue
+    by priority, lowest value first and FIFO within a priority, and a
+    freed token always goes to the head of the queue. pause() (Retry-After)
+    and update() (what the server says is left) let the server override the
+    local estimate. Thread-safe; shared by every thread and loop of a process.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()  # in the future while paused
+        self._queue = []  # heap of (priority, seq, _Waiter)
+        self._seq = itertools.count()
+        self.granted = 0
+        self.timeouts = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # Called with the lock held.
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _dispatch(self, now):
+        """
+        Grants tokens to the head of the queue; returns seconds until the
+        next token when someone is still waiting.
+        """
+        self._refill(now)
+        queue = self._queue
+        while queue and (queue[0][2].cancelled or self._tokens >= 1):
+            waiter = heapq.heappop(queue)[2]
+            if waiter.cancelled:
+                continue
+            self._tokens -= 1
+            waiter.granted = True
+            waiter.notify()
+        if not queue:
+            return None
+        return max(0.0, self._updated - now) + (1 - self._tokens) / self.rate
+
+    def _enqueue(self, priority, notify):
+        waiter = _Waiter(priority, notify)
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        return waiter
+
+    def _record(self, start):
+        waited = self._clock() - start
+        self.granted += 1
+        if waited > 0:
+            self.waited += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def _try_now(self, now):
+        self._refill(now)
+        if not self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _give_up(self, waiter):
+        """
+        Withdraws a waiter; True if a token was granted to it in the meantime.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.timeouts += 1
+            return False
+
+    def acquire(self, priority=0, timeout=None):
+        """
+        Takes a token, waiting up to timeout seconds (None: as long as it
+        takes). Returns False if none was granted in time.
+        """
+        start = self._clock()
+        event = threading.Event()
+        with self._lock:
+            if self._try_now(start):
+                self._record(start)
+                return True
+            waiter = self._enqueue(priority, event.set)
+            delay = self._dispatch(start)
+        while not waiter.granted:
+            left = None if timeout is None else timeout - (self._clock() - start)
+            if left is not None and left <= 0:
+                if not self._give_up(waiter):
+                    return False
+                break
+            event.wait(delay if left is None else min(delay, left))
+            with self._lock:
+                delay = self._dispatch(self._clock()) or 0.0
+        with self._lock:
+            self._record(start)
+        return True
+
+    async def acquire_async(self, priority=0, timeout=None):
+        """
+        acquire() for coroutines: waits without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            if not granted.done():
+                granted.set_result(True)
+
+        start = self._clock()
+        with self._lock:
+            if self._try_now(start):
+                self._record(start)
+                return True
+            waiter = self._enqueue(priority, lambda: loop.call_soon_threadsafe(wake))
+            delay = self._dispatch(start)
+        try:
+            while not waiter.granted:
+                left = None if timeout is None else timeout - (self._clock() - start)
+                if left is not None and left <= 0:
+                    if not self._give_up(waiter):
+                        return False
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(granted), delay if left is None else min(delay, left))
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    delay = self._dispatch(self._clock()) or 0.0
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                self.release()
+            raise
+        with self._lock:
+            self._record(start)
+        return True
+
+    def release(self):
+        """
+        Returns an unused token.
+        """
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+            self._dispatch(self._clock())
+
+    def pause(self, seconds):
+        """
+        Grants nothing for `seconds` (a Retry-After); then one request may go
+        and the bucket refills from there.
+        """
+        now = self._clock()
+        with self._lock:
+            self._refill(now)
+            self._tokens = 0.0
+            # refilling from here, the first token is ready when the pause ends
+            self._updated = max(self._updated, now + seconds - 1 / self.rate)
+
+    def update(self, remaining=None, reset_in=None):
+        """
+        Lowers the bucket to the `remaining` requests the server reports (other
+        processes may share the quota); with none left, waits for reset_in.
+        """
+        now = self._clock()
+        with self._lock:
+            self._refill(now)
+            if remaining is not None:
+                self._tokens = min(self._tokens, float(remaining))
+        if remaining is not None and remaining <= 0 and reset_in:
+            self.pause(reset_in)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(self._clock())
+            self.rate = rate
+
+    def retry_in(self):
+        """
+        Seconds until the next token, ignoring anyone already queued.
+        """
+        now = self._clock()
+        with self._lock:
+            self._refill(now)
+            return max(0.0, self._updated - now) + max(0.0, 1 - self._tokens) / self.rate
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            self._refill(now)
+            waiting = {}
+            for priority, _, waiter in self._queue:
+                if not waiter.cancelled:
+                    waiting[priority] = waiting.get(priority, 0) + 1
+            return {
+                "tokens": self._tokens,
+                "rate_per_s": self.rate,
+                "paused_s": max(0.0, self._updated - now),
+                "waiting": waiting,
+                "granted": self.granted,
+                "timeouts": self.timeouts,
+                "wait_avg_s": self.wait_total / self.waited if self.waited else 0.0,
+                "wait_max_s": self.wait_max,
+            }
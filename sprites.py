@@ -0,0 +1,89 @@
+"""
+Pre-rasterized text for the parts of the thumbnail drawn from a small
+vocabulary: genre pills, info labels and their values.
+- Text runs are kept as coverage masks, keyed by (font, text, sub-pixel
+  offset), and tinted when pasted, so one mask serves every color
+- Pills (rounded box plus label) are kept as finished patches with their
+  shape mask, keyed by (font, text, colors, height, padding)
+- Each kind has its own LRU, bounded in bytes; cache_stats() reports hits
+
+A pasted sprite gives exactly the pixels ImageDraw.text and
+rounded_rectangle would have drawn on the same canvas.
+"""
+
+import os
+import math
+
+from PIL import Image, ImageDraw
+
+from cache import LRUCache
+from textlayout import font_key, text_size
+
+SPRITE_CACHE_BYTES = int(os.getenv("SPRITE_CACHE_BYTES", 4 * 1024 * 1024))  # per kind
+
+_runs = LRUCache(max_bytes=SPRITE_CACHE_BYTES, name="sprite-text")
+_pills = LRUCache(max_bytes=SPRITE_CACHE_BYTES, name="sprite-pill")
+
+
+def _text_sprite(text, font, fx, fy):
+    """
+    (mask, dx, dy): text's coverage mask when drawn at fractional offset
+    (fx, fy), to be pasted at the integer position plus (dx, dy). The mask is
+    None for text without ink.
+    """
+    key = (font_key(font), text, fx, fy)
+    sprite = _runs.get(key)
+    if sprite is None:
+        left, top, right, bottom = font.getbbox(text)
+        # margins so glyphs left of or above the origin still fit
+        ox, oy = 2 - min(0, left), 2 - min(0, top)
+        canvas = Image.new("L", (ox + max(0, right) + 3, oy + max(0, bottom) + 3), 0)
+        ImageDraw.Draw(canvas).text((ox + fx, oy + fy), text, font=font, fill=255)
+        box = canvas.getbbox()
+        if box is None:
+            sprite = (None, 0, 0)
+        else:
+            sprite = (canvas.crop(box), box[0] - ox, box[1] - oy)
+        _runs.put(key, sprite, size=sprite[0].width * sprite[0].height + 64 if sprite[0] else 64)
+    return sprite
+
+
+def draw_text(canvas, xy, text, font, fill):
+    """
+    ImageDraw.Draw(canvas).text(xy, text, font=font, fill=fill), from the
+    sprite cache.
+    """
+    x, y = xy
+    if x < 0 or y < 0:
+        # negative positions round the other way; not worth a sprite
+        ImageDraw.Draw(canvas).text(xy, text, font=font, fill=fill)
+        return
+    mask, dx, dy = _text_sprite(text, font, math.modf(x)[0], math.modf(y)[0])
+    if mask is not None:
+        canvas.paste(fill, (int(x) + dx, int(y) + dy), mask)
+
+
+def draw_pill(canvas, xy, text, font, color, fill, height, padding):
+    """
+    Draws a pill at xy (integers): a rounded box `height` high with text
+    centered vertically, `padding` pixels in from each end. Returns its width.
+    """
+    key = (font_key(font), text, tuple(color), tuple(fill), height, padding)
+    sprite = _pills.get(key)
+    if sprite is None:
+        tw, th = text_size(font, text)
+        width = tw + 2 * padding
+        # rounded_rectangle's box includes its right and bottom edges
+        patch = Image.new("RGB", (width + 1, height + 1), tuple(fill))
+        ImageDraw.Draw(patch).text((padding, (height - th) // 2), text, font=font, fill=tuple(color))
+        mask = Image.new("L", patch.size, 0)
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, width, height), radius=height // 2, fill=255)
+        sprite = (patch, mask, width)
+        _pills.put(key, sprite, size=patch.width * patch.height * 4 + 64)
+    patch, mask, width = sprite
+    canvas.paste(patch, xy, mask)
+    return width
+
+
+def cache_stats():
+    return {"text": _runs.stats(), "pill": _pills.stats()}
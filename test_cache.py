@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Tests for the caching primitives in cache.py.
+
+Usage:
+    python test_cache.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache import LRUCache, DiskStore
+
+
+def test_lru_byte_budget():
+    """Least recently used entries are evicted once the byte budget is exceeded."""
+    print("Testing LRU byte budget...")
+    c = LRUCache(max_bytes=10, sizeof=len)
+    c.put("a", b"aaaa")
+    c.put("b", b"bbbb")
+    assert c.get("a") == b"aaaa"  # a is now most recent
+    c.put("c", b"cccc")
+    assert c.get("b") is None
+    assert c.get("a") == b"aaaa"
+    assert c.get("c") == b"cccc"
+    stats = c.stats()
+    assert stats["evictions"] == 1 and stats["bytes"] == 8
+    assert stats["hits"] == 3 and stats["misses"] == 1
+    # values larger than the whole budget are refused
+    assert not c.put("big", b"x" * 11)
+    print("  ✓ LRU evicts by bytes")
+
+
+def test_lru_max_entries():
+    """Entry-count bound works without sizeof."""
+    c = LRUCache(max_entries=2)
+    for k in "abc":
+        c.put(k, k)
+    assert "a" not in c and len(c) == 2
+
+
+def test_disk_store_roundtrip():
+    """Payload and metadata survive a put/get round trip, including across instances."""
+    print("Testing disk store round trip...")
+    with tempfile.TemporaryDirectory() as root:
+        store = DiskStore(root, max_bytes=1 << 20)
+        store.put("http://x/a.jpg", b"\x00\x01payload\n", {"etag": '"v1"'})
+        data, meta = DiskStore(root, max_bytes=1 << 20).get("http://x/a.jpg")
+        assert data == b"\x00\x01payload\n"
+        assert meta["etag"] == '"v1"' and meta["key"] == "http://x/a.jpg"
+        assert store.get("http://x/missing.jpg") is None
+    print("  ✓ Disk store round trip")
+
+
+def test_disk_store_drops_corrupt_entries():
+    """Truncated entries (e.g. another process crashed mid-copy) read as misses."""
+    with tempfile.TemporaryDirectory() as root:
+        store = DiskStore(root, max_bytes=1 << 20)
+        store.put("k", b"0123456789")
+        path = store._path("k")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+        assert store.get("k") is None
+        assert not os.path.exists(path)
+
+
+def test_disk_store_evicts_least_recent():
+    """Eviction removes the least recently touched files first."""
+    print("Testing disk store eviction...")
+    with tempfile.TemporaryDirectory() as root:
+        store = DiskStore(root, max_bytes=4000)
+        for i in range(3):
+            store.put(f"k{i}", b"x" * 1000)
+            # spread mtimes so ordering doesn't depend on timestamp resolution
+            t = time.time() - 100 + i
+            os.utime(store._path(f"k{i}"), (t, t))
+        assert store.get("k0") is not None  # touch: k0 becomes most recent
+        store.put("k3", b"x" * 1000)
+        store.put("k4", b"x" * 1000)
+        store.evict()
+        assert store.get("k1") is None
+        assert store.get("k0") is not None
+        assert store.get("k4") is not None
+        assert store.usage() <= 4000
+    print("  ✓ Disk store evicts LRU files")
+
+
+def main():
+    test_lru_byte_budget()
+    test_lru_max_entries()
+    test_disk_store_roundtrip()
+    test_disk_store_drops_corrupt_entries()
+    test_disk_store_evicts_least_recent()
+    print("All cache tests passed.")
+
+
+if __name__ == "__main__":
+    main()
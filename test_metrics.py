@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Tests for metrics.py: counters, histograms, spans, the Prometheus output
+and request IDs in log records.
+
+Usage:
+    python test_metrics.py
+"""
+
+import os
+import sys
+import logging
+import contextvars
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import metrics
+
+
+def _fresh(on=True):
+    metrics.reset()
+    metrics.enable(on)
+
+
+def test_disabled_is_noop():
+    """Nothing is recorded while metrics are off; span() is a shared no-op."""
+    _fresh(on=False)
+    metrics.inc("requests_total")
+    metrics.observe("latency_seconds", 0.2)
+    assert metrics.span("x") is metrics.span("y")
+    with metrics.span("x"):
+        pass
+    assert "requests_total" not in metrics.render_prometheus()
+    assert "x_seconds" not in metrics.render_prometheus()
+
+
+def test_counters_and_histograms():
+    print("Testing counters and histograms...")
+    _fresh()
+    metrics.inc("requests_total", result="ok")
+    metrics.inc("requests_total", 2, result="ok")
+    metrics.inc("requests_total", result="busy")
+    for value in (0.003, 0.2, 100.0):
+        metrics.observe("latency_seconds", value, stage="encode")
+    text = metrics.render_prometheus()
+    assert 'thumbgen_requests_total{result="ok"} 3' in text
+    assert 'thumbgen_requests_total{result="busy"} 1' in text
+    assert "# TYPE thumbgen_latency_seconds histogram" in text
+    # buckets are cumulative; 100 s only lands in +Inf
+    assert 'thumbgen_latency_seconds_bucket{stage="encode",le="0.005"} 1' in text
+    assert 'thumbgen_latency_seconds_bucket{stage="encode",le="0.25"} 2' in text
+    assert 'thumbgen_latency_seconds_bucket{stage="encode",le="60.0"} 2' in text
+    assert 'thumbgen_latency_seconds_bucket{stage="encode",le="+Inf"} 3' in text
+    assert 'thumbgen_latency_seconds_count{stage="encode"} 3' in text
+    print("  ✓ Prometheus text output")
+
+
+def test_span_records_errors():
+    """A span whose block raises is recorded with the exception class."""
+    _fresh()
+    try:
+        with metrics.span("fetch", host="cdn"):
+            raise TimeoutError()
+    except TimeoutError:
+        pass
+    assert 'thumbgen_fetch_seconds_count{error="TimeoutError",host="cdn"} 1' in metrics.render_prometheus()
+
+
+def test_collectors_and_endpoint():
+    print("Testing collectors and the HTTP endpoint...")
+    _fresh()
+
+    def broken():
+        raise RuntimeError("collector bug")
+        yield  # pragma: no cover
+
+    def gauges():
+        return [("queue_depth", {}, 7), ("cache_hit_ratio", {"cache": "img"}, 0.5)]
+
+    metrics.register_collector(gauges)
+    metrics.register_collector(broken)
+    server = metrics.start_http_server(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url, timeout=5).read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+        metrics.unregister_collector(gauges)
+        metrics.unregister_collector(broken)
+    assert "thumbgen_queue_depth 7" in body
+    assert 'thumbgen_cache_hit_ratio{cache="img"} 0.5' in body
+    print("  ✓ /metrics serves collected gauges")
+
+
+def test_request_id_in_logs():
+    """Log records carry the request ID of the context they were logged from."""
+    print("Testing request IDs in log records...")
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    handler = Capture()
+    handler.addFilter(metrics.RequestIdFilter())
+    log = logging.getLogger("test-metrics")
+    log.addHandler(handler)
+    try:
+        log.warning("outside")
+
+        def request():
+            rid = metrics.new_request_id()
+            log.warning("inside")
+            return rid
+
+        rid = contextvars.copy_context().run(request)
+    finally:
+        log.removeHandler(handler)
+    assert records[0].request_id == "-"
+    assert records[1].request_id == rid and len(rid) == 12
+    assert metrics.request_id.get() == "-"
+    print("  ✓ Request IDs attached")
+
+
+def test_signal_dump_does_not_deadlock():
+    """The dump signal arriving while the main thread holds the metrics lock still gets logged."""
+    import signal
+    import threading
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    print("Testing the signal dump...")
+    _fresh()
+    metrics.inc("dumped_total")
+    dumped = threading.Event()
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            if "dumped_total" in record.getMessage():
+                dumped.set()
+
+    handler = Capture()
+    metrics.logger.addHandler(handler)
+    level = metrics.logger.level
+    metrics.logger.setLevel(logging.INFO)
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert metrics.install_signal_dump()
+        with metrics._lock:  # as if the signal landed inside inc()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert not dumped.wait(0.2)
+        assert dumped.wait(5)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        metrics.logger.setLevel(level)
+        metrics.logger.removeHandler(handler)
+    print("  ✓ Dump logged once the lock is free")
+
+
+def main():
+    test_disabled_is_noop()
+    test_counters_and_histograms()
+    test_span_records_errors()
+    test_collectors_and_endpoint()
+    test_request_id_in_logs()
+    test_signal_dump_does_not_deadlock()
+    print("All metrics tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Tests for resilience.py: deadline budgets and the per-host circuit breaker
+(on a fake clock), and the priority rate limiter.
+
+Usage:
+    python test_resilience.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from resilience import Deadline, DeadlineExceeded, CircuitBreaker, CircuitOpen, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_deadline_budget():
+    print("Testing deadline budgets...")
+    clock = FakeClock()
+    d = Deadline(8, clock=clock)
+    assert d.bounded and d.remaining() == 8
+    assert d.timeout(15) == 8
+    assert d.timeout(15, share=0.5) == 4
+    assert d.timeout(3, share=0.5) == 3
+    assert d.timeout(15, reserve=1) == 7
+    clock.now += 7.5
+    assert d.timeout(15) == 0.5
+    try:
+        d.timeout(15, reserve=1)
+        assert False, "reserve not honoured"
+    except DeadlineExceeded:
+        pass
+    clock.now += 1
+    assert d.expired() and d.remaining() == 0
+    # no deadline: caps pass through untouched
+    unbounded = Deadline.coerce(None)
+    assert not unbounded.bounded and not unbounded.expired()
+    assert unbounded.timeout(15, share=0.5, reserve=1) == 15
+    assert Deadline.coerce(d) is d
+    assert isinstance(DeadlineExceeded(), TimeoutError)
+    print("  ✓ Timeouts cut from what is left")
+
+
+def test_breaker_opens_and_recovers():
+    print("Testing the circuit breaker...")
+    clock = FakeClock()
+    breaker = CircuitBreaker(failures=3, cooldown=30, clock=clock)
+    for _ in range(2):
+        assert breaker.allow("cdn")
+        breaker.failure("cdn")
+    breaker.success("cdn")  # a success resets the streak
+    for _ in range(3):
+        assert breaker.allow("cdn")
+        breaker.failure("cdn")
+    assert breaker.state("cdn") == "open"
+    assert not breaker.allow("cdn")
+    assert breaker.allow("other")  # hosts are independent
+    try:
+        breaker.check("cdn")
+        assert False, "open circuit let a call through"
+    except CircuitOpen as e:
+        assert "30s" in str(e)
+
+    clock.now += 30
+    assert breaker.state("cdn") == "half-open"
+    assert breaker.allow("cdn")       # the one trial call
+    assert not breaker.allow("cdn")   # everyone else waits for its outcome
+    breaker.failure("cdn")
+    assert breaker.state("cdn") == "open" and breaker.retry_in("cdn") == 30
+
+    clock.now += 30
+    assert breaker.allow("cdn")
+    breaker.success("cdn")
+    assert breaker.state("cdn") == "closed" and breaker.allow("cdn")
+    stats = breaker.stats()
+    assert stats["opened"] == 1 and stats["rejected"] == 3
+    assert stats["hosts"] == {"cdn": "closed"}
+    print("  ✓ Opens, half-opens and closes")
+
+
+def test_lost_trial_call():
+    """A trial call whose outcome is never reported does not wedge the host."""
+    clock = FakeClock()
+    breaker = CircuitBreaker(failures=1, cooldown=10, clock=clock)
+    breaker.failure("api")
+    clock.now += 10
+    assert breaker.allow("api")
+    assert not breaker.allow("api")
+    clock.now += 10
+    assert breaker.allow("api")
+
+
+def test_rate_limiter_bucket():
+    print("Testing the token bucket...")
+    limiter = RateLimiter(rate=20, burst=2)
+    start = time.monotonic()
+    assert limiter.acquire() and limiter.acquire()
+    assert time.monotonic() - start < 0.02  # the burst goes straight through
+    assert limiter.acquire()
+    assert time.monotonic() - start >= 0.04  # then one token per 50 ms
+    # Retry-After: nothing for the pause, and a timeout gives up
+    limiter.pause(0.3)
+    assert not limiter.acquire(timeout=0.05)
+    assert limiter.stats()["timeouts"] == 1 and limiter.stats()["paused_s"] > 0.1
+    assert limiter.acquire(timeout=1.0)
+    # the server's count of what is left wins over the local estimate
+    limiter = RateLimiter(rate=20, burst=5)
+    limiter.update(remaining=0, reset_in=0.2)
+    assert 0.15 < limiter.retry_in() <= 0.3
+    print("  ✓ Burst, refill, pause and timeouts")
+
+
+def test_rate_limiter_priorities():
+    """A freed token goes to the most urgent waiter, whatever the arrival order."""
+    print("Testing rate limiter priorities...")
+    limiter = RateLimiter(rate=10, burst=1)
+    assert limiter.acquire()
+    order = []
+
+    def take(priority):
+        limiter.acquire(priority)
+        order.append(priority)
+
+    threads = []
+    for priority in (2, 1, 0):
+        threads.append(threading.Thread(target=take, args=(priority,)))
+        threads[-1].start()
+        time.sleep(0.01)  # queued in that order
+    assert limiter.stats()["waiting"] == {2: 1, 1: 1, 0: 1}
+    for t in threads:
+        t.join(5)
+    assert order == [0, 1, 2], order
+
+    async def mixed():
+        # coroutines and threads share one queue
+        assert limiter.acquire()
+        thread = threading.Thread(target=take, args=(5,))
+        thread.start()
+        await asyncio.sleep(0.01)
+        assert await limiter.acquire_async(1, timeout=2)
+        order.append(1)
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+        # a cancelled coroutine leaves the queue
+        waiter = asyncio.ensure_future(limiter.acquire_async(0))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert limiter.stats()["waiting"] == {}
+
+    order.clear()
+    asyncio.run(mixed())
+    assert order == [1, 5], order
+    print("  ✓ Priority queue across threads and coroutines")
+
+
+def main():
+    test_deadline_budget()
+    test_breaker_opens_and_recovers()
+    test_lost_trial_call()
+    test_rate_limiter_bucket()
+    test_rate_limiter_priorities()
+    print("All resilience tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Tests for the HTTP API server (`python thumbnail.py serve`), run offline
+against the bench.py fixtures with aiohttp's test client.
+
+Usage:
+    python test_server.py
+"""
+
+import os
+import sys
+import asyncio
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import ANIME, install_fixtures
+import thumbnail
+from PIL import Image
+
+try:
+    from aiohttp import test_utils as aiohttp_test
+except ImportError:
+    aiohttp_test = None
+
+install_fixtures()
+
+
+def _run(scenario, **server_kwargs):
+    """
+    Runs scenario(client) against a fresh ThumbServer app.
+    """
+    if aiohttp_test is None:
+        print("  - aiohttp not installed, skipped")
+        return
+
+    async def main():
+        server = thumbnail.ThumbServer(**server_kwargs)
+        async with aiohttp_test.TestClient(aiohttp_test.TestServer(server.app())) as client:
+            await scenario(client, server)
+
+    asyncio.run(main())
+
+
+def test_thumb_and_conditional_get():
+    """GET /thumb renders, sets an ETag, and a matching If-None-Match gets 304."""
+    print("Testing GET /thumb and 304...")
+
+    async def scenario(client, server):
+        r = await client.get("/thumb", params={"q": "attack on titan"})
+        assert r.status == 200, await r.text()
+        assert r.headers["Content-Type"] == "image/png"
+        assert r.headers["X-Request-ID"]
+        body = await r.read()
+        assert Image.open(BytesIO(body)).size == (thumbnail.CANVAS_WIDTH, thumbnail.CANVAS_HEIGHT)
+        etag = r.headers["ETag"]
+        r = await client.get("/thumb", params={"q": "attack on titan"}, headers={"If-None-Match": f'W/{etag}, "other"'})
+        assert r.status == 304 and r.headers["ETag"] == etag
+        assert await r.read() == b""
+        # another encoder is another representation
+        r = await client.get("/thumb", params={"q": "attack on titan", "encoder": "jpeg"}, headers={"If-None-Match": etag})
+        assert r.status == 200 and r.headers["Content-Type"] == "image/jpeg"
+        assert r.headers["ETag"] != etag
+
+    _run(scenario)
+    print("  ✓ ETag and 304")
+
+
+def test_render_post():
+    """POST /render takes a Media object or an AniList response."""
+    print("Testing POST /render...")
+
+    async def scenario(client, server):
+        r = await client.post("/render", json=ANIME[0], params={"encoder": "webp"})
+        assert r.status == 200 and r.headers["Content-Type"] == "image/webp"
+        etag = r.headers["ETag"]
+        r = await client.post("/render", json={"data": {"Media": ANIME[0]}}, params={"encoder": "webp"})
+        assert r.status == 200 and r.headers["ETag"] == etag
+
+    _run(scenario)
+    print("  ✓ Renders posted payloads")
+
+
+def test_errors():
+    print("Testing API errors...")
+
+    async def scenario(client, server):
+        assert (await client.get("/thumb")).status == 400
+        assert (await client.get("/thumb", params={"q": "no such anime at all"})).status == 404
+        assert (await client.get("/thumb", params={"q": "titan", "encoder": "gif"})).status == 400
+        assert (await client.post("/render", data=b"not json")).status == 400
+        assert (await client.post("/render", json={"title": "flat string"})).status == 400
+        r = await client.post("/render", data=b"x" * (thumbnail.SERVER_MAX_BODY + 1))
+        assert r.status == 413
+
+    _run(scenario)
+    print("  ✓ Bad requests rejected")
+
+
+def test_rendering_stays_off_the_loop():
+    """While a render blocks its worker thread, the loop keeps answering, and
+    concurrent requests for the same thumbnail share that one render."""
+    print("Testing off-loop rendering and shared renders...")
+    gate = threading.Event()
+    calls = []
+    original = thumbnail.generate_thumbnail
+
+    def slow_generate(*args, **kwargs):
+        calls.append(1)
+        gate.wait(5)
+        return original(*args, **kwargs)
+
+    async def scenario(client, server):
+        first = asyncio.ensure_future(client.post("/render", json=ANIME[1]))
+        second = asyncio.ensure_future(client.post("/render", json=ANIME[1]))
+        for _ in range(500):
+            if calls:
+                break
+            await asyncio.sleep(0.01)
+        assert calls, "render never started"
+        health = await client.get("/healthz")
+        assert health.status == 200 and (await health.json())["rendering"] == 1
+        gate.set()
+        a, b = await first, await second
+        assert a.status == b.status == 200
+        assert await a.read() == await b.read()
+        assert len(calls) == 1
+
+    thumbnail.generate_thumbnail = slow_generate
+    try:
+        thumbnail.render_mem_cache.clear()
+        _run(scenario)
+    finally:
+        thumbnail.generate_thumbnail = original
+        gate.set()
+    print("  ✓ Loop stays responsive")
+
+
+def test_busy_server_returns_503():
+    async def scenario(client, server):
+        server.pending = server.max_pending
+        r = await client.get("/thumb", params={"q": "titan"})
+        assert r.status == 503 and r.headers["Retry-After"] == "1"
+
+    _run(scenario, max_pending=1)
+
+
+def test_throttled_lookup_returns_503():
+    """AniList throttling is a 503 with Retry-After, not a 404."""
+    original = thumbnail.fetch_anime_async
+
+    async def throttled(*args, **kwargs):
+        raise thumbnail.AniListRateLimited("AniList rate limit hit", retry_after=2.5)
+
+    async def scenario(client, server):
+        r = await client.get("/thumb", params={"q": "titan"})
+        assert r.status == 503 and r.headers["Retry-After"] == "3"
+
+    thumbnail.fetch_anime_async = throttled
+    try:
+        _run(scenario)
+    finally:
+        thumbnail.fetch_anime_async = original
+
+
+def test_failed_lookup_is_not_404():
+    """An open AniList circuit is a 503, a spent deadline a 504; only a real miss is a 404."""
+    print("Testing failed AniList lookups...")
+    saved = thumbnail.upstream_breaker, thumbnail.REQUEST_DEADLINE
+    host = urlsplit(thumbnail.ANILIST_URL).netloc
+
+    async def scenario(client, server):
+        assert (await client.get("/thumb", params={"q": "not on anilist either"})).status == 404
+        thumbnail.upstream_breaker.failure(host)
+        r = await client.get("/thumb", params={"q": "lookup while the circuit is open"})
+        assert r.status == 503 and 1 <= int(r.headers["Retry-After"]) <= 60
+        thumbnail.upstream_breaker.success(host)
+        thumbnail.REQUEST_DEADLINE = 0
+        assert (await client.get("/thumb", params={"q": "lookup with no time left"})).status == 504
+
+    thumbnail.upstream_breaker = thumbnail.CircuitBreaker(failures=1, cooldown=60)
+    try:
+        _run(scenario)
+    finally:
+        thumbnail.upstream_breaker, thumbnail.REQUEST_DEADLINE = saved
+    print("  ✓ Failed lookups answered as 503/504")
+
+
+def main():
+    test_thumb_and_conditional_get()
+    test_render_post()
+    test_errors()
+    test_rendering_stays_off_the_loop()
+    test_busy_server_returns_503()
+    test_throttled_lookup_returns_503()
+    test_failed_lookup_is_not_404()
+    print("All server tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Tests for sprites.py: pasted sprites must give the same pixels as drawing
+with ImageDraw, and repeats must come from the cache.
+
+Usage:
+    python test_sprites.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+import sprites
+import textlayout
+from cache import LRUCache
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+
+
+def _fonts():
+    fonts = []
+    for name, size in (("Roboto-SemiBoldItalic.ttf", 24), ("Roboto-Thin.ttf", 22), ("Roboto-Regular.ttf", 30)):
+        path = os.path.join(FONTS_DIR, name)
+        if os.path.getsize(path):
+            fonts.append(ImageFont.truetype(path, size))
+    fonts.append(ImageFont.load_default())
+    return fonts
+
+
+def _background():
+    return Image.effect_mandelbrot((320, 80), (-2, -1.2, 1, 1.2), 40).convert("RGB")
+
+
+def test_text_matches_imagedraw():
+    """Same pixels as ImageDraw.text, at whole and fractional positions."""
+    print("Testing text sprites against ImageDraw...")
+    for font in _fonts():
+        for text in ("STUDIO : ", "FINISHED", "8.4/10", "jfy Ç", " "):
+            for xy in ((10, 12), (96.35, 20.0), (5.5, 0.75), (0, 0)):
+                want, got = _background(), _background()
+                ImageDraw.Draw(want).text(xy, text, font=font, fill=(245, 140, 60))
+                sprites.draw_text(got, xy, text, font, (245, 140, 60))
+                assert ImageChops.difference(want, got).getbbox() is None, (text, xy)
+    print("  ✓ Text sprites match")
+
+
+def test_pill_matches_imagedraw():
+    print("Testing pill sprites against ImageDraw...")
+    font = _fonts()[0]
+    for text in ("ACTION", "SLICE OF LIFE"):
+        want, got = _background(), _background()
+        draw = ImageDraw.Draw(want)
+        tw, th = textlayout.text_size(font, text)
+        draw.rounded_rectangle((12, 20, 12 + tw + 36, 56), radius=18, fill=(245, 245, 245))
+        draw.text((30, 20 + (36 - th) // 2), text, font=font, fill=(20, 20, 20))
+        width = sprites.draw_pill(got, (12, 20), text, font, (20, 20, 20), (245, 245, 245), 36, 18)
+        assert width == tw + 36
+        assert ImageChops.difference(want, got).getbbox() is None, text
+    print("  ✓ Pill sprites match")
+
+
+def test_sprites_are_cached_and_bounded():
+    """Repeats are hits, other colors share the text mask, and the byte cap holds."""
+    font = _fonts()[0]
+    canvas = _background()
+    sprites.draw_text(canvas, (4, 4), "DRAMA", font, (255, 255, 255))
+    before = sprites.cache_stats()["text"]["hits"]
+    sprites.draw_text(canvas, (40, 30), "DRAMA", font, (0, 0, 0))
+    assert sprites.cache_stats()["text"]["hits"] == before + 1
+    sprites.draw_pill(canvas, (0, 0), "DRAMA", font, (0, 0, 0), (255, 255, 255), 36, 18)
+    before = sprites.cache_stats()["pill"]["hits"]
+    sprites.draw_pill(canvas, (100, 0), "DRAMA", font, (0, 0, 0), (255, 255, 255), 36, 18)
+    assert sprites.cache_stats()["pill"]["hits"] == before + 1
+
+    saved = sprites._runs
+    sprites._runs = LRUCache(max_bytes=4096, name="sprite-text")
+    try:
+        for i in range(50):
+            sprites.draw_text(canvas, (0, 0), f"GENRE {i}", font, (255, 255, 255))
+        stats = sprites.cache_stats()["text"]
+        assert stats["bytes"] <= 4096 and stats["evictions"] > 0
+    finally:
+        sprites._runs = saved
+
+
+def main():
+    test_text_matches_imagedraw()
+    test_pill_matches_imagedraw()
+    test_sprites_are_cached_and_bounded()
+    print("All sprite tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Tests for textlayout.py: the cached wrapper must break lines exactly where
+the original textbbox-per-candidate algorithm did.
+
+Usage:
+    python test_textlayout.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageDraw, ImageFont
+
+import textlayout
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+
+SAMPLES = [
+    "SPY X FAMILY CODE: WHITE",
+    "A spy, an assassin and a telepath — a found family that must pretend to be normal.",
+    "Several hundred years ago, humans were nearly exterminated by titans. Titans are "
+    "typically several stories tall, seem to have no intelligence, devour human beings "
+    "and, worst of all, seem to do it for the pleasure rather than as a food source.",
+    "Supercalifragilisticexpialidocious word wider than the box",
+    "",
+]
+
+
+def _fonts():
+    fonts = []
+    for name, size in (("Roboto-SemiBoldItalic.ttf", 100), ("Roboto-Thin.ttf", 22), ("Roboto-Regular.ttf", 30)):
+        path = os.path.join(FONTS_DIR, name)
+        if os.path.getsize(path):
+            fonts.append(ImageFont.truetype(path, size))
+    fonts.append(ImageFont.load_default())
+    return fonts
+
+
+def _reference_wrap(text, font, max_width):
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    words = text.split()
+    if not words:
+        return []
+    lines, cur = [], words[0]
+    for w in words[1:]:
+        bbox = draw.textbbox((0, 0), cur + " " + w, font=font)
+        if bbox[2] - bbox[0] <= max_width:
+            cur = cur + " " + w
+        else:
+            lines.append(cur)
+            cur = w
+    lines.append(cur)
+    return lines
+
+
+def test_wrap_matches_reference():
+    """Same line breaks as measuring every candidate line with textbbox."""
+    print("Testing wrap_text against reference wrapping...")
+    for font in _fonts():
+        for text in SAMPLES:
+            for max_width in (120, 340, 678):
+                assert textlayout.wrap_text(text, font, max_width) == _reference_wrap(text, font, max_width)
+    print("  ✓ Line breaks match")
+
+
+def test_text_size_matches_textbbox():
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    for font in _fonts():
+        for text in ("ACTION", "SLICE OF LIFE", "fj"):
+            bbox = draw.textbbox((0, 0), text, font=font)
+            assert textlayout.text_size(font, text) == (bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+
+def test_measurements_are_cached():
+    """Repeated measurements of the same word are cache hits."""
+    font = _fonts()[0]
+    textlayout.text_length(font, "CACHED")
+    before = textlayout.cache_stats()["advance"]["hits"]
+    textlayout.text_length(font, "CACHED")
+    assert textlayout.cache_stats()["advance"]["hits"] == before + 1
+    # a second instance of the same face/size shares entries
+    twin = ImageFont.truetype(font.path, font.size)
+    textlayout.text_length(twin, "CACHED")
+    assert textlayout.cache_stats()["advance"]["hits"] == before + 2
+
+
+def main():
+    test_wrap_matches_reference()
+    test_text_size_matches_textbbox()
+    test_measurements_are_cached()
+    print("All text layout tests passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,220 +1,1161 @@
 #!/usr/bin/env python3
 """
 Sample test script to validate thumbnail generation with fallback flows.
+Runs offline: images and AniList answers come from the fixtures in bench.py.
 
 Usage:
     python test_thumbnail.py
 
 This script tests:
-1. Font loading with fallbacks
-2. Placeholder image generation when poster is missing
-3. Text outline rendering
-4. Title truncation for long titles
+1. Font loading with fallbacks, and the validated font index
+2. Placeholder image when the character image is missing
+3. Text wrapping for titles and descriptions
+4. Full thumbnail generation, missing posters and long titles
+5. Render cache, encoder profiles, output variants, the render job format and
+   the process render pool
+6. Layout templates and their compiled render plans
+7. The job scheduler: queue bound, fairness, coalescing and request IDs
+8. Async lookups and downloads, and their sync wrapper
+9. Batch rendering with checkpoints
+10. Download and pixel limits
+11. Deadlines, the circuit breaker and the failed-URL cache, and the bot's
+    request deadline and Telegram file_id reuse
+12. The AniList cache (search keys, stale entries, the shared index), and
+    AniList batch retries and rate limiting
+13. Cache prewarming against a local fake AniList server
+14. The benchmark harness
 """
 
 import os
 import sys
 import tempfile
+import shutil
+import io
+import copy
+import json
+import time
+import asyncio
+import datetime
+import threading
+import contextvars
+import requests
+from io import BytesIO
+from types import SimpleNamespace
 
 # Add the current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# bench points CACHE_DIR/FONTS_DIR at test-safe locations before thumbnail is imported
+import bench
+from bench import ANIME, FIXTURE_HOST, install_fixtures
 from thumbnail import (
     generate_thumbnail,
-    generate_placeholder_image,
-    draw_text_with_outline,
-    truncate_text,
-    TITLE_FONT,
-    BOLD_FONT,
-    MEDIUM_FONT,
-    REG_FONT,
-    GENRE_FONT,
+    get_font,
+    wrap_text_to_width,
+    thumbnail_assets,
+    pack_render_job,
+    unpack_render_job,
+    render_cache_stats,
+    ENCODER_PROFILES,
+    FONT_SPECS,
+    CHAR_CARD,
+    PLACEHOLDER_BG,
     CANVAS_WIDTH,
     CANVAS_HEIGHT,
-    logger
 )
-from PIL import Image, ImageDraw
+import thumbnail
+import metrics
+from PIL import Image, ImageFont
 
 # Use cross-platform temp directory
 TEMP_DIR = tempfile.gettempdir()
 
+install_fixtures()
+
+
+def _open(buf):
+    img = Image.open(BytesIO(buf.getvalue()))
+    img.load()
+    return img
+
 
 def test_font_loading():
-    """Test that fonts are loaded properly."""
+    """Every named font loads (a bundled face or PIL's default as fallback)."""
     print("Testing font loading...")
-    fonts = {
-        'TITLE_FONT': TITLE_FONT,
-        'BOLD_FONT': BOLD_FONT,
-        'MEDIUM_FONT': MEDIUM_FONT,
-        'REG_FONT': REG_FONT,
-        'GENRE_FONT': GENRE_FONT,
-    }
-    
-    for name, font in fonts.items():
-        if font is not None:
-            print(f"  ✓ {name} loaded successfully")
-        else:
-            print(f"  ✗ {name} failed to load")
-    print()
+    for name in FONT_SPECS:
+        font = get_font(name)
+        assert font is not None, f"{name} failed to load"
+        assert isinstance(font, ImageFont.FreeTypeFont), f"{name} fell back to PIL's default font"
+        assert getattr(thumbnail, name) is font
+        print(f"  ✓ {name} loaded successfully")
 
 
-def test_placeholder_generation():
-    """Test placeholder image generation."""
-    print("Testing placeholder image generation...")
-    
-    placeholder = generate_placeholder_image(400, 300)
-    assert placeholder is not None, "Placeholder should not be None"
-    assert placeholder.size == (400, 300), f"Expected size (400, 300), got {placeholder.size}"
-    print(f"  ✓ Generated placeholder: {placeholder.size}, mode={placeholder.mode}")
-    
-    # Save for visual inspection
-    output_path = os.path.join(TEMP_DIR, "test_placeholder.png")
-    placeholder.save(output_path)
-    print(f"  ✓ Saved placeholder to {output_path}")
-    print()
+def test_font_index():
+    """Empty and corrupt files are skipped, the index is reused until the directory changes, and styles rank deterministically."""
+    print("Testing the font index...")
+    fonts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+    with tempfile.TemporaryDirectory() as tmp:
+        font_dir = os.path.join(tmp, "fonts")
+        os.makedirs(font_dir)
+        for name in ("Roboto-SemiBold", "Roboto-ExtraBold", "Roboto-BoldItalic", "Roboto-Light",
+                     "Roboto_Condensed-Bold"):
+            shutil.copy(os.path.join(fonts_dir, name + ".ttf"), font_dir)
+        open(os.path.join(font_dir, "Roboto-Bold.ttf"), "wb").close()  # empty, like the bundled one
+        with open(os.path.join(font_dir, "Broken.ttf"), "wb") as f:
+            f.write(b"not a font at all" * 100)
+        index_path = os.path.join(tmp, "fonts_index.json")
 
+        manager = thumbnail.FontManager(font_dir, index_path=index_path, family="Roboto")
+        names = sorted(os.path.basename(e["path"]) for e in manager.index)
+        assert names == ["Roboto-BoldItalic.ttf", "Roboto-ExtraBold.ttf", "Roboto-Light.ttf",
+                         "Roboto-SemiBold.ttf", "Roboto_Condensed-Bold.ttf"], names
+        # bold: the Roboto family, upright, 600 and 800 equally close to 700, tie to the more neutral 600
+        assert os.path.basename(manager.best_match("bold")) == "Roboto-SemiBold.ttf"
+        assert os.path.basename(manager.best_match("light")) == "Roboto-Light.ttf"
+        assert os.path.basename(manager.best_match("regular")) == "Roboto-Light.ttf"
+        assert os.path.basename(manager.best_match("no such style")) == "Roboto-Light.ttf"
+        condensed = thumbnail.FontManager(font_dir, index_path=index_path, family="Roboto Condensed")
+        assert os.path.basename(condensed.best_match("bold")) == "Roboto_Condensed-Bold.ttf"
+        assert isinstance(manager.pick_font("bold", 20), ImageFont.FreeTypeFont)
 
-def test_truncate_text():
-    """Test text truncation with ellipsis."""
-    print("Testing text truncation...")
-    
-    # Short text - no truncation
-    result = truncate_text("Short Title", 50)
-    assert result == "Short Title", f"Expected 'Short Title', got '{result}'"
-    print(f"  ✓ Short text unchanged: '{result}'")
-    
-    # Long text - should be truncated
-    long_text = "This is a very long anime title that should be truncated with ellipsis"
-    result = truncate_text(long_text, 30)
-    assert len(result) == 30, f"Expected length 30, got {len(result)}"
-    assert result.endswith("..."), f"Expected text to end with '...', got '{result}'"
-    print(f"  ✓ Long text truncated: '{result}'")
-    print()
+        # same directory mtime: the saved index is used without opening a font
+        original = thumbnail.FontManager._scan_fonts
+        scans = []
+        thumbnail.FontManager._scan_fonts = lambda self: scans.append(1) or original(self)
+        try:
+            reused = thumbnail.FontManager(font_dir, index_path=index_path, family="Roboto")
+            assert not scans and reused.index == manager.index
+            # a changed directory is scanned again
+            shutil.copy(os.path.join(fonts_dir, "Roboto-Black.ttf"), font_dir)
+            stamp = os.stat(font_dir).st_mtime + 10
+            os.utime(font_dir, (stamp, stamp))
+            rescanned = thumbnail.FontManager(font_dir, index_path=index_path, family="Roboto")
+            assert scans == [1] and len(rescanned.index) == len(manager.index) + 1
+        finally:
+            thumbnail.FontManager._scan_fonts = original
+    print("  ✓ Font index validated, cached and ranked")
 
 
-def test_text_outline():
-    """Test text with outline rendering."""
-    print("Testing text outline rendering...")
-    
-    img = Image.new("RGBA", (400, 100), (50, 50, 50))
-    draw = ImageDraw.Draw(img)
-    
-    draw_text_with_outline(
-        draw, 
-        (20, 30), 
-        "Test Outline", 
-        BOLD_FONT, 
-        fill=(255, 255, 255),
-        outline_color=(0, 0, 0),
-        outline_width=2
-    )
-    
-    output_path = os.path.join(TEMP_DIR, "test_outline.png")
-    img.save(output_path)
-    print(f"  ✓ Saved outline test to {output_path}")
-    print()
+def test_placeholder_generation():
+    """Without any character image or poster the card shows the NO IMAGE placeholder."""
+    print("Testing placeholder image generation...")
+    anime = dict(ANIME[2], coverImage={"extraLarge": None})
+    img = _open(generate_thumbnail(anime, use_cache=False))
+    char_x, char_y = CHAR_CARD[0] + 10, CHAR_CARD[1] + 10
+    assert img.getpixel((char_x + 2, char_y + 2))[:3] == PLACEHOLDER_BG
+    print("  ✓ Placeholder drawn in the character card")
+
+
+def test_wrap_text():
+    """Wrapped lines fit the width and keep every word."""
+    print("Testing text wrapping...")
+    font = get_font("CHAR_DESC_FONT")
+    text = ANIME[1]["description"]
+    lines = wrap_text_to_width(text, font, 340)
+    assert len(lines) > 1
+    assert " ".join(lines).split() == text.split()
+    for line in lines:
+        if " " in line:
+            box = font.getbbox(line)
+            assert box[2] - box[0] <= 340, line
+    print(f"  ✓ Wrapped into {len(lines)} lines")
 
 
 def test_thumbnail_generation():
-    """Test full thumbnail generation with sample data."""
+    """Full thumbnail generation with fixture poster and character images."""
     print("Testing thumbnail generation...")
-    
-    # Sample anime data (mock)
-    sample_anime = {
-        'title': {
-            'english': 'Attack on Titan',
-            'romaji': 'Shingeki no Kyojin'
-        },
-        'coverImage': {
-            'extraLarge': 'https://s4.anilist.co/file/anilistcdn/media/anime/cover/large/bx16498-C6FPmWm59CyP.jpg'
-        },
-        'averageScore': 84,
-        'genres': ['Action', 'Drama', 'Fantasy'],
-        'description': 'Several hundred years ago, humans were nearly exterminated by titans. Titans are typically several stories tall, seem to have no intelligence, devour human beings and, worst of all, seem to do it for the pleasure rather than as a food source.'
-    }
-    
-    try:
-        result = generate_thumbnail(sample_anime)
-        if result:
-            # Save the generated thumbnail
-            output_path = os.path.join(TEMP_DIR, "test_thumbnail.png")
-            with open(output_path, 'wb') as f:
-                f.write(result.read())
-            print(f"  ✓ Generated thumbnail saved to {output_path}")
-        else:
-            print("  ✗ Thumbnail generation returned None")
-    except Exception as e:
-        print(f"  ✗ Thumbnail generation failed: {e}")
-        import traceback
-        traceback.print_exc()
-    print()
+    result = generate_thumbnail(ANIME[0])
+    img = _open(result)
+    assert img.format == "PNG" and img.size == (CANVAS_WIDTH, CANVAS_HEIGHT)
+    output_path = os.path.join(TEMP_DIR, "test_thumbnail.png")
+    with open(output_path, "wb") as f:
+        f.write(result.getvalue())
+    print(f"  ✓ Generated thumbnail saved to {output_path}")
+
+    # the same request again is answered from the render cache
+    hits = render_cache_stats()["memory"]["hits"]
+    again = generate_thumbnail(ANIME[0])
+    assert again.getvalue() == result.getvalue()
+    assert render_cache_stats()["memory"]["hits"] == hits + 1
+    print("  ✓ Repeat request served from the render cache")
 
 
 def test_thumbnail_with_missing_poster():
-    """Test thumbnail generation with missing/invalid poster URL."""
+    """A poster URL that fails to download still produces a thumbnail."""
     print("Testing thumbnail with missing poster (placeholder fallback)...")
-    
-    # Sample anime data with invalid poster URL
-    sample_anime = {
-        'title': {
-            'english': 'Test Anime',
-            'romaji': 'Tesuto Anime'
-        },
-        'coverImage': {
-            'extraLarge': 'https://invalid-url.example.com/nonexistent.jpg'
-        },
-        'averageScore': 75,
-        'genres': ['Comedy', 'Romance'],
-        'description': 'This is a test anime with a missing poster image to verify placeholder generation.'
-    }
-    
-    try:
-        result = generate_thumbnail(sample_anime)
-        if result:
-            output_path = os.path.join(TEMP_DIR, "test_thumbnail_placeholder.png")
-            with open(output_path, 'wb') as f:
-                f.write(result.read())
-            print(f"  ✓ Generated thumbnail with placeholder saved to {output_path}")
-        else:
-            print("  ✗ Thumbnail generation returned None")
-    except Exception as e:
-        print(f"  ✗ Thumbnail generation failed: {e}")
-        import traceback
-        traceback.print_exc()
-    print()
+    anime = dict(ANIME[1], coverImage={"extraLarge": FIXTURE_HOST + "nonexistent.jpg"})
+    assets = thumbnail_assets(anime)
+    assert assets.digest(FIXTURE_HOST + "nonexistent.jpg") is None
+    img = _open(generate_thumbnail(anime, assets=assets))
+    assert img.size == (CANVAS_WIDTH, CANVAS_HEIGHT)
+    print("  ✓ Generated thumbnail without a poster")
 
 
 def test_long_title():
-    """Test thumbnail generation with a very long title."""
-    print("Testing thumbnail with long title (truncation)...")
-    
-    sample_anime = {
-        'title': {
-            'english': 'My Very Long Anime Title That Should Be Properly Truncated With Ellipsis For Better Display',
-            'romaji': 'Watashi no Totemo Nagai Anime Title'
-        },
-        'coverImage': {
-            'extraLarge': 'https://s4.anilist.co/file/anilistcdn/media/anime/cover/large/bx16498-C6FPmWm59CyP.jpg'
-        },
-        'averageScore': 90,
-        'genres': ['Action', 'Adventure', 'Fantasy'],
-        'description': 'An anime with a very long title to test truncation.'
+    """A very long title is wrapped to at most two lines and still renders."""
+    print("Testing thumbnail with long title...")
+    anime = ANIME[2]
+    title = anime["title"]["romaji"].upper()
+    lines = wrap_text_to_width(title, get_font("TITLE_FONT"), thumbnail.MAIN_CARD[2] - 72)
+    assert len(lines) >= 2
+    img = _open(generate_thumbnail(anime))
+    assert img.size == (CANVAS_WIDTH, CANVAS_HEIGHT)
+    print("  ✓ Generated thumbnail with long title")
+
+
+def test_encoders():
+    """Each encoder profile produces its format and gets its own cache entry."""
+    print("Testing encoder profiles...")
+    assets = thumbnail_assets(ANIME[0])
+    keys = set()
+    for name, (fmt, _, _, _) in ENCODER_PROFILES.items():
+        img = _open(generate_thumbnail(ANIME[0], assets=assets, encoder=name))
+        assert img.format == fmt, (name, img.format)
+        keys.add(thumbnail.thumbnail_cache_key(ANIME[0], assets, encoder=name))
+    assert len(keys) == len(ENCODER_PROFILES)
+    try:
+        generate_thumbnail(ANIME[0], assets=assets, encoder="gif")
+        assert False, "unknown encoder accepted"
+    except ValueError:
+        pass
+    print("  ✓ All encoder profiles work")
+
+
+def test_render_job_roundtrip():
+    """Render jobs for the process pool survive packing and unpacking."""
+    assets = thumbnail_assets(ANIME[0])
+    anime, unpacked, prefer_local_bg, encoder, variants, template = unpack_render_job(
+        pack_render_job(ANIME[0], assets, True, "webp"))
+    assert anime == ANIME[0] and prefer_local_bg is True and encoder == "webp" and variants is None
+    assert unpacked.entries == assets.entries
+    assert thumbnail.template_key(template) == thumbnail.template_key(thumbnail.template_spec())
+    specs = [thumbnail.output_variant(v) for v in ("half", "square:jpeg")]
+    assert unpack_render_job(pack_render_job(ANIME[0], assets, variants=specs))[4] == specs
+
+
+def _hanging_render_worker(blob, job_id=None):
+    """
+    RenderPool worker (run in the spawned process) that never finishes
+    titles starting with "hang"; everything else renders normally.
+    """
+    if unpack_render_job(blob)[0]["title"]["english"].startswith("hang"):
+        thumbnail._render_job_started(job_id)
+        time.sleep(60)
+    return thumbnail._render_worker(blob, job_id)
+
+
+def test_render_pool():
+    """Worker processes give the same bytes; a hung job times out alone and queued jobs survive the restart."""
+    print("Testing the process render pool...")
+    anime = ANIME[0]
+    assets = thumbnail_assets(anime)
+    expected = thumbnail.render_thumbnail(anime, assets, False, "png")
+    pool = thumbnail.RenderPool(processes=1, timeout=2)
+    saved = thumbnail._render_worker
+    try:
+        assert pool.render(anime, assets, encoder="png") == expected
+        specs = [thumbnail.output_variant(v) for v in ("full", "half", "square:webp")]
+        assert pool.render(anime, assets, variants=specs) == thumbnail.render_variants(anime, assets, False, specs)
+
+        thumbnail._render_worker = _hanging_render_worker
+        results = {}
+
+        def run(name, payload):
+            try:
+                results[name] = pool.render(payload, assets, encoder="png")
+            except Exception as e:
+                results[name] = e
+
+        hung = threading.Thread(target=run, args=("hung", dict(anime, title={"english": "hang forever"})))
+        hung.start()
+        deadline = time.monotonic() + 10
+        while not any(pool._started.values()):
+            assert time.monotonic() < deadline, "hung job never started"
+            time.sleep(0.01)
+        # queued behind the hung job for longer than the timeout, but never started
+        queued = threading.Thread(target=run, args=("queued", anime))
+        queued.start()
+        hung.join(30)
+        queued.join(30)
+        assert isinstance(results["hung"], thumbnail.RenderTimeout), results["hung"]
+        assert results["queued"] == expected, results["queued"]
+        stats = pool.stats()
+        assert stats["timeouts"] == 1 and stats["restarts"] == 1 and stats["resubmitted"] == 1, stats
+    finally:
+        thumbnail._render_worker = saved
+        pool.shutdown()
+    print("  ✓ Pool output, timeout and restart")
+
+
+def test_variants():
+    """One call renders every variant once; each is cached on its own."""
+    print("Testing output variants...")
+    assets = thumbnail_assets(ANIME[0])
+    full = generate_thumbnail(ANIME[0], assets=assets).getvalue()
+    thumbnail.render_mem_cache.clear()
+    renders = []
+    original = thumbnail.compose_thumbnail
+
+    def counting_compose(*args, **kwargs):
+        renders.append(1)
+        return original(*args, **kwargs)
+
+    thumbnail.compose_thumbnail = counting_compose
+    try:
+        outputs = generate_thumbnail(ANIME[0], assets=assets, use_cache=False,
+                                     variants=["full", "half", "square:webp", (200, 100, (0, 0, 640, 720), "jpeg")])
+        assert len(renders) == 1
+        images = [_open(buf) for buf in outputs]
+        assert [(img.format, img.size) for img in images] == [
+            ("PNG", (CANVAS_WIDTH, CANVAS_HEIGHT)), ("PNG", (640, 360)), ("WEBP", (360, 360)), ("JPEG", (200, 100))]
+        assert outputs[0].getvalue() == full
+
+        # cached one by one: asking again for a subset plus a new size renders once more
+        generate_thumbnail(ANIME[0], assets=assets, variants=["full", "half"])
+        renders.clear()
+        again = generate_thumbnail(ANIME[0], assets=assets, variants=["half", "full"])
+        assert not renders and again[1].getvalue() == full
+        generate_thumbnail(ANIME[0], assets=assets, variants=["half", "320x180"])
+        assert len(renders) == 1
+    finally:
+        thumbnail.compose_thumbnail = original
+    for bad in ("huge", "0x10", (100, 100, (1200, 0, 200, 200)), "half:gif"):
+        try:
+            thumbnail.output_variant(bad)
+            assert False, bad
+        except ValueError:
+            pass
+    print("  ✓ Variants share one render and cache separately")
+
+
+def test_layout_templates():
+    """Templates are data, compiled once into a cached plan; anchored elements follow the title."""
+    print("Testing layout templates...")
+    plan = thumbnail.render_plan()
+    assert thumbnail.render_plan("classic") is plan
+    assert thumbnail.render_plan(copy.deepcopy(thumbnail.CLASSIC_TEMPLATE)) is plan  # keyed by content
+    try:
+        plan.ops = ()
+        assert False, "render plan is mutable"
+    except AttributeError:
+        pass
+
+    banner = {
+        "size": [640, 360],
+        "background": {"fill": [0, 0, 0]},
+        "elements": [
+            {"type": "text", "name": "title", "field": "title", "at": [20, 20], "max_width": 600, "max_lines": 2,
+             "font": "TITLE_FONT", "color": [255, 255, 255]},
+            {"type": "box", "box": [20, ["title", 10], 100, 10], "color": [255, 0, 0]},
+        ],
     }
-    
+    size = get_font("TITLE_FONT").size
+    for title, lines in (("AOT", 1), ("A RATHER LONG TITLE FOR A BANNER THIS SMALL", 2)):
+        anime = dict(ANIME[0], title={"english": title})
+        img = _open(generate_thumbnail(anime, template=banner))
+        assert img.size == (640, 360)
+        assert img.getpixel((30, 20 + size * lines + 15))[:3] == (255, 0, 0), (title, lines)
+    assets = thumbnail_assets(ANIME[0])
+    assert thumbnail.thumbnail_cache_key(ANIME[0], assets) != thumbnail.thumbnail_cache_key(ANIME[0], assets, template=banner)
+    thumbnail.register_template("banner", banner)
     try:
-        result = generate_thumbnail(sample_anime)
-        if result:
-            output_path = os.path.join(TEMP_DIR, "test_thumbnail_long_title.png")
-            with open(output_path, 'wb') as f:
-                f.write(result.read())
-            print(f"  ✓ Generated thumbnail with long title saved to {output_path}")
-        else:
-            print("  ✗ Thumbnail generation returned None")
-    except Exception as e:
-        print(f"  ✗ Thumbnail generation failed: {e}")
-        import traceback
-        traceback.print_exc()
-    print()
+        assert generate_thumbnail(ANIME[0], template="banner").getvalue() == \
+            generate_thumbnail(ANIME[0], template=banner, use_cache=False).getvalue()
+    finally:
+        del thumbnail.TEMPLATES["banner"]
+
+    bad_elements = ({"type": "circle"},
+                    {"type": "text", "text": "x", "at": [0, 0], "font": "NO_SUCH_FONT"},
+                    {"type": "box", "box": [0, ["later", 0], 10, 10]})
+    for element in bad_elements:
+        try:
+            thumbnail.compile_template({"elements": [element]})
+            assert False, element
+        except ValueError:
+            pass
+    try:
+        generate_thumbnail(ANIME[0], template="no-such-template")
+        assert False, "unknown template accepted"
+    except ValueError:
+        pass
+    print("  ✓ Templates compile to cached plans")
+
+
+def test_scheduler_keeps_request_ids():
+    """A job runs with the request ID of the request that started it; every
+    coalesced request's callback runs with its own."""
+    print("Testing request IDs through the scheduler...")
+    scheduler = thumbnail.ThumbScheduler(workers=1)
+    gate = threading.Event()
+    seen = {}
+    done = threading.Semaphore(0)
+
+    def job():
+        gate.wait(5)
+        seen["job"] = metrics.request_id.get()
+
+    def request(name):
+        seen[name + "-rid"] = metrics.new_request_id()
+
+        def callback(result, error):
+            seen[name] = metrics.request_id.get()
+            done.release()
+
+        assert scheduler.submit(1, "same-key", job, callback)
+
+    contextvars.copy_context().run(request, "first")
+    contextvars.copy_context().run(request, "second")  # joins the first job
+    gate.set()
+    for _ in range(2):
+        assert done.acquire(timeout=5)
+    scheduler.stop()
+    assert seen["job"] == seen["first-rid"]
+    assert seen["first"] == seen["first-rid"]
+    assert seen["second"] == seen["second-rid"] != seen["first-rid"]
+    print("  ✓ Request IDs follow jobs and callbacks")
+
+
+def _blocked_scheduler(**kwargs):
+    """
+    A one-worker ThumbScheduler whose worker is held by a job until the
+    returned gate is set, so later submissions stay queued.
+    """
+    scheduler = thumbnail.ThumbScheduler(workers=1, **kwargs)
+    gate = threading.Event()
+    assert scheduler.submit("blocker", "blocker", lambda: gate.wait(5), lambda result, error: None)
+    deadline = time.monotonic() + 5
+    while scheduler.stats()["running"] != 1:
+        assert time.monotonic() < deadline, "worker never started"
+        time.sleep(0.01)
+    return scheduler, gate
+
+
+def test_scheduler_queue_fairness_and_coalescing():
+    """A full queue rejects, chats take turns, and one query from two chats runs once."""
+    print("Testing the job scheduler...")
+    # bounded: a full queue (or a chat's share of it) makes submit() fail, which the bot answers as busy
+    scheduler, gate = _blocked_scheduler(max_queue=3, per_chat=2)
+    noop = lambda result, error: None
+    assert scheduler.submit(1, "a1", lambda: None, noop)
+    assert scheduler.submit(1, "a2", lambda: None, noop)
+    assert not scheduler.submit(1, "a3", lambda: None, noop)  # chat 1's share is used up
+    assert scheduler.submit(2, "b1", lambda: None, noop)
+    assert not scheduler.submit(3, "c1", lambda: None, noop)  # queue is full
+    assert scheduler.submit(3, "a1", lambda: None, noop)  # ...but joining a queued job is free
+    assert scheduler.stats()["rejected"] == 2
+    gate.set()
+    scheduler.stop()
+
+    # fair: waiting jobs are taken round-robin across chats, not in arrival order
+    scheduler, gate = _blocked_scheduler()
+    order = []
+    done = threading.Semaphore(0)
+    for chat, key in ((1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (2, "b2"), (3, "c1")):
+        assert scheduler.submit(chat, key, lambda key=key: order.append(key), lambda result, error: done.release())
+    gate.set()
+    for _ in range(6):
+        assert done.acquire(timeout=5)
+    scheduler.stop()
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"], order
+
+    # single-flight: the same normalized query from two chats is fetched and rendered once
+    scheduler, gate = _blocked_scheduler()
+    runs, results = [], {}
+    done = threading.Semaphore(0)
+
+    def job():
+        runs.append(1)
+        return "thumbnail"
+
+    for chat, query in ((1, "Spy x Family"), (2, "  spy X family ")):
+        def deliver(result, error, chat=chat):
+            results[chat] = (result, error)
+            done.release()
+        assert scheduler.submit(chat, thumbnail.normalize_search(query), job, deliver)
+    gate.set()
+    for _ in range(2):
+        assert done.acquire(timeout=5)
+    scheduler.stop()
+    assert len(runs) == 1
+    assert results == {1: ("thumbnail", None), 2: ("thumbnail", None)}
+    assert scheduler.stats()["coalesced"] == 1
+    print("  ✓ Bounded, fair and single-flight")
+
+
+def test_normalize_search():
+    print("Testing search normalization...")
+    key = thumbnail.normalize_search("spy x family")
+    for variant in ("SPY×FAMILY", "spy x family ", "  Spy  X\tFamily", "Spy x Family!"):
+        assert thumbnail.normalize_search(variant) == key, variant
+    assert thumbnail.normalize_search("Pokémon") == thumbnail.normalize_search("POKEMON") == "pokemon"
+    assert thumbnail.normalize_search("Re:Zero") == "re zero"
+    assert thumbnail.normalize_search("Spy x Family 2") != key
+    print("  ✓ Near-duplicate searches share a key")
+
+
+def test_anilist_cache_stale_while_revalidate():
+    """A stale entry is answered at once and refreshed by exactly one background request."""
+    print("Testing stale AniList entries...")
+    saved = thumbnail.anilist_cache, thumbnail._anilist_post
+    calls = []
+    release = threading.Event()
+
+    def post(query, variables, timeout=15, priority="interactive"):
+        calls.append((variables, priority))
+        release.wait(5)
+        return {"Media": {"id": 7, "title": {"english": "Refreshed"}}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # ttl=0: every entry is stale as soon as it is stored
+        cache = thumbnail.anilist_cache = thumbnail.AniListCache(tmp, ttl=0, stale_ttl=3600)
+        thumbnail._anilist_post = post
+        try:
+            cache.store({"id": 7, "title": {"english": "Old"}}, "some show")
+            assert cache.lookup("Some Show") == ({"id": 7, "title": {"english": "Old"}}, "stale")
+            for _ in range(3):
+                start = time.monotonic()
+                assert thumbnail.fetch_anime_from_anilist("some show")["title"]["english"] == "Old"
+                assert time.monotonic() - start < 0.5, "stale entry waited for the refresh"
+            assert not cache.start_refresh(7), "a second refresh was allowed"
+            release.set()
+            deadline = time.monotonic() + 5
+            while cache.lookup("some show")[0]["title"]["english"] != "Refreshed":
+                assert time.monotonic() < deadline, "refresh never landed"
+                time.sleep(0.01)
+            assert calls == [({"id": 7}, "background")]
+            assert cache.start_refresh(7)  # done: the next stale hit may refresh again
+            # past stale_ttl an entry is a miss
+            cache.stale_ttl = 0
+            assert cache.lookup("some show") == (None, None)
+        finally:
+            release.set()
+            thumbnail.anilist_cache, thumbnail._anilist_post = saved
+    print("  ✓ Served stale, refreshed once")
+
+
+def test_anilist_index_shared_between_processes():
+    """Two caches on one CACHE_DIR merge their indexes instead of overwriting each other."""
+    print("Testing a shared AniList index...")
+    with tempfile.TemporaryDirectory() as tmp:
+        first = thumbnail.AniListCache(tmp, flush_interval=3600)
+        second = thumbnail.AniListCache(tmp, flush_interval=3600)
+        first.store({"id": 1}, "Frieren")
+        second.store({"id": 2}, "Mushishi")
+        first.flush()
+        second.flush()
+        assert second.lookup("frieren")[0] == {"id": 1}  # payload from the shared disk tier
+        third = thumbnail.AniListCache(tmp)
+        assert dict(third.index) == {"frieren": 1, "mushishi": 2}
+        assert third.lookup("MUSHISHI")[0] == {"id": 2}
+    print("  ✓ Indexes merged")
+
+
+def test_anilist_index_lru_and_flush():
+    """New search strings are indexed in memory, trimmed least recently used first, and written out in batches."""
+    print("Testing the AniList index...")
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = thumbnail.AniListCache(tmp, max_index=3, flush_interval=3600)
+        for i, name in enumerate(("alpha", "bravo", "charlie")):
+            cache.store({"id": i}, name)
+        assert not os.path.exists(cache.index_path), "store() wrote the index"
+        assert cache.lookup("alpha")[0] == {"id": 0}  # now the most recently used
+        cache.store({"id": 3}, "delta")
+        assert list(cache.index) == ["charlie", "alpha", "delta"]  # bravo was the coldest
+        cache.flush()
+        with open(cache.index_path, encoding="utf-8") as f:
+            assert json.load(f) == {"charlie": 2, "alpha": 0, "delta": 3}
+        assert cache.stats()["index_flushes"] == 1
+        cache.flush()  # nothing changed: nothing written
+        assert cache.stats()["index_flushes"] == 1
+
+        # once the interval is up, store() hands the write to a background thread
+        cache.flush_interval = 0
+        cache.store({"id": 4}, "echo")
+        deadline = time.monotonic() + 5
+        while cache.stats()["index_flushes"] < 2:
+            assert time.monotonic() < deadline, "index never flushed"
+            time.sleep(0.01)
+        with open(cache.index_path, encoding="utf-8") as f:
+            assert "echo" in json.load(f)
+    print("  ✓ LRU index, flushed in batches")
+
+
+def test_async_lookups():
+    """Hundreds of lookups share one thread and overlap; a deadline cuts them short."""
+    print("Testing async lookups...")
+    install_fixtures(latency=0.05)
+    try:
+        names = ["attack on titan"] + [f"unknown show {i}" for i in range(300)]
+        start = time.perf_counter()
+        found = asyncio.run(thumbnail.fetch_many_anime_async(names, concurrency=len(names)))
+        elapsed = time.perf_counter() - start
+        assert list(found) == names
+        assert found["attack on titan"]["id"] == ANIME[1]["id"]
+        assert all(found[n] is None for n in names[1:])
+        assert elapsed < 3, f"lookups did not overlap ({elapsed:.1f}s)"
+        late = asyncio.run(thumbnail.fetch_many_anime_async(["another unknown"], deadline=0.01))
+        assert late == {"another unknown": None}
+    finally:
+        install_fixtures()
+    print(f"  ✓ {len(names)} lookups in {elapsed:.2f}s")
+
+
+def test_async_assets_and_run_sync():
+    """Async downloads build the same assets; run_sync keeps the caller's request ID."""
+    print("Testing async assets and run_sync...")
+    assets = thumbnail.run_sync(thumbnail.thumbnail_assets_async(ANIME[0]))
+    assert assets.entries == thumbnail_assets(ANIME[0]).entries
+    img = thumbnail.run_sync(thumbnail.download_image_async(FIXTURE_HOST + "plp.jpg"))
+    assert img is not None and img.size[0] > 0
+
+    async def current_rid():
+        return metrics.request_id.get()
+
+    def request():
+        rid = metrics.new_request_id()
+        return rid, thumbnail.run_sync(current_rid(), timeout=5)
+
+    rid, seen = contextvars.copy_context().run(request)
+    assert seen == rid
+
+    async def nested():
+        thumbnail.run_sync(current_rid())
+
+    try:
+        thumbnail.run_sync(nested(), timeout=5)
+        assert False, "run_sync on its own loop should raise"
+    except RuntimeError:
+        pass
+    print("  ✓ Async assets match and run_sync works")
+
+
+def test_async_http_client():
+    """AsyncHTTP against a local aiohttp server: bodies, statuses, kept-alive connections."""
+    if thumbnail.aiohttp is None:
+        print("  - aiohttp not installed, skipped")
+        return
+    print("Testing AsyncHTTP...")
+    from aiohttp import web, test_utils as aiohttp_test
+    peers = set()
+
+    async def handler(request):
+        peers.add(request.transport.get_extra_info("peername"))
+        if request.method == "POST":
+            return web.json_response({"echo": await request.json()})
+        return web.Response(status=int(request.query.get("status", 200)), body=b"pixels")
+
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/img", handler)
+        client = thumbnail.AsyncHTTP(limit_per_host=2)
+        async with aiohttp_test.TestServer(app) as server:
+            url = str(server.make_url("/img"))
+            r = await client.request("GET", url)
+            assert r.status == 200 and r.body == b"pixels"
+            r = await client.request("POST", url, json={"a": 1})
+            assert r.json() == {"echo": {"a": 1}}
+            r = await client.request("GET", url + "?status=404")
+            try:
+                r.raise_for_status()
+                assert False, "404 not raised"
+            except Exception as e:
+                assert "404" in str(e)
+            await client.close()
+        assert len(peers) == 1, peers  # sequential requests reuse one connection
+
+    asyncio.run(main())
+    print("  ✓ Pooled client works")
+
+
+def test_batch_input():
+    """Titles, id:<n> and JSONL objects are read; bad lines are reported, duplicates dropped."""
+    assert thumbnail.parse_batch_line("  # comment") is None
+    assert thumbnail.parse_batch_line("86") == {"search": "86"}
+    assert thumbnail.parse_batch_line("ID: 21") == {"id": 21}
+    assert thumbnail.parse_batch_line('{"request_id": "r1", "title": "Mushishi"}') == {"search": "Mushishi"}
+    assert thumbnail.parse_batch_line('{"anilist_id": 457}') == {"id": 457}
+    assert thumbnail.parse_batch_line('{"title": {"romaji": "Mushishi"}}') == {"search": "Mushishi"}
+    for bad in ('{"body": "x"}', "[1, 2]", '{"title": '):
+        try:
+            thumbnail.parse_batch_line(bad)
+            assert False, bad
+        except ValueError:
+            pass
+
+
+def test_batch_resume():
+    """A batch writes one file per item, reports failures, and a rerun only retries what is missing."""
+    print("Testing batch rendering...")
+    out_dir = tempfile.mkdtemp(prefix="thumb-batch-")
+    src = os.path.join(out_dir, "input.jsonl")
+    with open(src, "w", encoding="utf-8") as f:
+        f.write('{"title": "Attack on Titan"}\nid:1001\nattack  on titan\nno such anime\n{"body": 1}\n')
+    items, errors = thumbnail.read_batch_items(src)
+    assert [item["key"] for item in items] == ["q:attack on titan", "id:1001", "q:no such anime"]
+    assert errors and errors[0][0] == 5
+
+    summary = thumbnail.run_batch(items, out_dir, backend="thread", workers=2, progress=io.StringIO())
+    assert (summary["ok"], summary["failed"], summary["skipped"]) == (2, 1, 0)
+    assert summary["failures"][0]["key"] == "q:no such anime"
+    files = sorted(f for f in os.listdir(out_dir) if f.endswith(".png"))
+    assert files == ["1001-spy-x-family-code-white.png", "1002-attack-on-titan.png"]
+
+    # a killed run may leave a torn last line; a deleted output is rendered again
+    with open(os.path.join(out_dir, thumbnail.BATCH_CHECKPOINT), "a", encoding="utf-8") as f:
+        f.write('{"key": "id:10')
+    os.remove(os.path.join(out_dir, "1002-attack-on-titan.png"))
+    summary = thumbnail.run_batch(items, out_dir, backend="thread", workers=2, progress=None)
+    assert (summary["ok"], summary["failed"], summary["skipped"]) == (1, 1, 1)
+    assert os.path.isfile(os.path.join(out_dir, "1002-attack-on-titan.png"))
+    records = thumbnail.BatchCheckpoint(os.path.join(out_dir, thumbnail.BATCH_CHECKPOINT)).records
+    assert records["q:attack on titan"]["status"] == "ok"
+    print("  ✓ Batch renders, reports failures and resumes")
+
+
+def test_download_and_pixel_limits():
+    """Bodies over MAX_IMAGE_BYTES and images over MAX_IMAGE_PIXELS are refused, sync and async."""
+    print("Testing download and pixel limits...")
+    url = FIXTURE_HOST + "plp.jpg"
+    saved = thumbnail.MAX_IMAGE_BYTES, thumbnail.MAX_IMAGE_PIXELS
+    try:
+        thumbnail.MAX_IMAGE_BYTES = 1000
+        for fetch in (thumbnail.fetch_image_bytes,
+                      lambda u: thumbnail.run_sync(thumbnail.download_image_async(u))):
+            thumbnail.image_disk_cache.delete(url)
+            thumbnail.failed_urls.clear()
+            before = thumbnail.image_cache_stats()["network"]["too_large"]
+            assert fetch(url) is None
+            assert thumbnail.image_cache_stats()["network"]["too_large"] == before + 1
+        thumbnail.MAX_IMAGE_BYTES = saved[0]
+
+        thumbnail.MAX_IMAGE_PIXELS = 100 * 100
+        buf = BytesIO()
+        Image.new("RGB", (101, 100)).save(buf, "PNG")
+        try:
+            thumbnail.open_image(buf.getvalue())
+            assert False, "pixel limit not enforced"
+        except thumbnail.TooLarge:
+            pass
+        assets = thumbnail.RenderAssets({"bomb": (buf.getvalue(), "bomb-digest")})
+        assert assets.cover("bomb", 64, 64) is None
+        thumbnail.image_disk_cache.delete(url)
+        thumbnail.failed_urls.clear()
+        assert thumbnail.fetch_image_bytes(url) is None  # plp.jpg is far over 100x100
+    finally:
+        thumbnail.MAX_IMAGE_BYTES, thumbnail.MAX_IMAGE_PIXELS = saved
+        thumbnail.failed_urls.clear()
+    print("  ✓ Oversized downloads and images refused")
+
+
+class _FlakySession(bench.FixtureSession):
+    """
+    Fixture session where "slow/<file>" takes `delay` seconds and the
+    down.invalid host refuses every connection.
+    """
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self.requests += 1
+        if url.startswith("https://down.invalid/"):
+            raise requests.ConnectionError("connection refused")
+        if url.startswith(FIXTURE_HOST + "slow/"):
+            time.sleep(self.delay)
+            url = FIXTURE_HOST + url[len(FIXTURE_HOST + "slow/"):]
+        return self.serve_get(url, headers)
+
+
+def test_deadline_breaker_and_failed_urls():
+    """Late images become placeholders, failing hosts are cut off and broken URLs are not retried."""
+    print("Testing deadlines, circuit breaker and failed-URL cache...")
+    session = _FlakySession(delay=1.0)
+    saved = thumbnail._http_session, thumbnail._async_http, thumbnail.upstream_breaker, thumbnail.DEADLINE_RENDER_RESERVE
+    slow = FIXTURE_HOST + "slow/background.jpg"
+    thumbnail._http_session = session
+    thumbnail._async_http = bench.FixtureAsyncHTTP(session)
+    thumbnail.upstream_breaker = thumbnail.CircuitBreaker(failures=2, cooldown=60)
+    thumbnail.DEADLINE_RENDER_RESERVE = 0.1
+    try:
+        thumbnail.image_disk_cache.delete(slow)
+        anime = dict(ANIME[0], coverImage={"extraLarge": slow}, characters={"nodes": []})
+        start = time.monotonic()
+        out = generate_thumbnail(anime, use_cache=False, deadline=thumbnail.Deadline(0.4))
+        assert time.monotonic() - start < 0.9, "render waited for the slow image"
+        assert Image.open(out).size == (CANVAS_WIDTH, CANVAS_HEIGHT)
+        assets = thumbnail.thumbnail_assets(anime, deadline=thumbnail.Deadline(0.4))
+        assert assets.late == {slow} and assets.digest(slow) is None
+        time.sleep(1.2)  # the late downloads finish in the background...
+        before = session.requests
+        assert thumbnail.thumbnail_assets(anime).digest(slow)  # ...and land in the cache
+        assert session.requests == before
+        # no budget left: nothing is sent, not even to AniList
+        assert thumbnail.fetch_anime_from_anilist("no cached entry for this", deadline=thumbnail.Deadline(0)) is None
+        assert session.requests == before
+
+        # connection failures open the host's circuit; further calls are refused locally
+        for name in ("a.jpg", "b.jpg"):
+            assert thumbnail.fetch_image_bytes("https://down.invalid/" + name) is None
+        assert thumbnail.upstream_breaker.state("down.invalid") == "open"
+        before = session.requests
+        assert thumbnail.fetch_image_bytes("https://down.invalid/c.jpg") is None
+        assert session.requests == before
+        assert thumbnail.upstream_stats()["breaker"]["rejected"] == 1
+        # ...and are not remembered as broken URLs, unlike a 404
+        assert "https://down.invalid/a.jpg" not in thumbnail.failed_urls
+        missing = FIXTURE_HOST + "no-such-image.jpg"
+        for fetch in (thumbnail.fetch_image_bytes,
+                      lambda u: thumbnail.run_sync(thumbnail.download_image_async(u))):
+            before = session.requests
+            assert fetch(missing) is None
+            assert session.requests == before + (fetch is thumbnail.fetch_image_bytes)  # async: already known
+        assert missing in thumbnail.failed_urls
+        assert thumbnail.upstream_breaker.state(FIXTURE_HOST.split("/")[2]) == "closed"
+    finally:
+        thumbnail._http_session, thumbnail._async_http, thumbnail.upstream_breaker, thumbnail.DEADLINE_RENDER_RESERVE = saved
+        thumbnail.failed_urls.clear()
+    print("  ✓ Budgets, breaker and failed URLs")
+
+
+class _FakeBot:
+    """
+    Records send_photo calls. Uploads come back with two photo sizes; a
+    string photo (a file_id) is rejected with `reject` if set.
+    """
+
+    def __init__(self, reject=None):
+        self.sent = []
+        self.reject = reject
+
+    def send_photo(self, chat_id, photo, caption=None, timeout=None):
+        self.sent.append(photo)
+        if isinstance(photo, str):
+            if self.reject:
+                raise self.reject
+            return SimpleNamespace(photo=[])
+        n = len(self.sent)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"small-{n}"), SimpleNamespace(file_id=f"large-{n}")])
+
+
+def test_bot_job_bounds_the_whole_request():
+    """The bot sends what its job rendered: late images are not fetched again after the deadline."""
+    print("Testing the bot job deadline...")
+    session = _FlakySession(delay=1.0)
+    saved = (thumbnail._http_session, thumbnail._async_http, thumbnail.DEADLINE_RENDER_RESERVE,
+             thumbnail.fetch_anime_from_anilist, thumbnail.telegram_file_ids)
+    slow = FIXTURE_HOST + "slow/background.jpg"
+    anime = dict(ANIME[1], coverImage={"extraLarge": slow}, characters={"nodes": []})
+    thumbnail._http_session = session
+    thumbnail._async_http = bench.FixtureAsyncHTTP(session)
+    thumbnail.DEADLINE_RENDER_RESERVE = 0.1
+    thumbnail.fetch_anime_from_anilist = lambda query, deadline=None: anime
+    try:
+        thumbnail.telegram_file_ids = thumbnail.DiskStore(tempfile.mkdtemp(), 1 << 20, name="test-file-ids")
+        thumbnail.image_disk_cache.delete(slow)
+        got, found, assets = thumbnail.bot_thumb_job("attack on titan", deadline=0.4)
+        assert found and got is anime and assets.late == {slow}
+        time.sleep(1.2)  # the late download lands in the image cache meanwhile
+        before, hits = session.requests, render_cache_stats()["memory"]["hits"]
+        bot = _FakeBot()
+        thumbnail.send_thumbnail(bot, 1, anime, assets=assets)
+        assert session.requests == before, "send refetched the images"
+        assert render_cache_stats()["memory"]["hits"] == hits + 1, "send rendered a second time"
+        assert len(bot.sent) == 1 and not isinstance(bot.sent[0], str)
+    finally:
+        (thumbnail._http_session, thumbnail._async_http, thumbnail.DEADLINE_RENDER_RESERVE,
+         thumbnail.fetch_anime_from_anilist, thumbnail.telegram_file_ids) = saved
+    print("  ✓ One deadline for lookup, render and send")
+
+
+def test_bot_reuses_telegram_file_ids():
+    """A known thumbnail is resent by file_id without rendering; a rejected file_id is replaced."""
+    print("Testing Telegram file_id reuse...")
+    saved = thumbnail.fetch_anime_from_anilist, thumbnail.telegram_file_ids
+    anime = copy.deepcopy(ANIME[0])
+    thumbnail.fetch_anime_from_anilist = lambda query, deadline=None: anime
+    store = thumbnail.telegram_file_ids = thumbnail.DiskStore(tempfile.mkdtemp(), 1 << 20, name="test-file-ids")
+
+    def lookups():
+        stats = render_cache_stats()["memory"]
+        return stats["hits"] + stats["misses"]
+
+    try:
+        # first send: rendered, uploaded, and the largest size's file_id is kept
+        _, _, assets = thumbnail.bot_thumb_job("spy x family")
+        bot = _FakeBot()
+        thumbnail.send_thumbnail(bot, 1, anime, assets=assets)
+        key = thumbnail._telegram_file_id_key(anime, assets, False, thumbnail.BOT_ENCODER)
+        assert len(bot.sent) == 1 and store.get(key)[0] == b"large-1"
+
+        # known: the job skips the render and the send is the file_id alone
+        before = lookups()
+        _, _, assets = thumbnail.bot_thumb_job("spy x family")
+        bot = _FakeBot()
+        thumbnail.send_thumbnail(bot, 1, anime, assets=assets)
+        assert bot.sent == ["large-1"] and lookups() == before
+
+        # stale: Telegram rejects the file_id, it is dropped and the image uploaded again
+        stale = Exception("Bad Request: wrong file identifier/HTTP URL specified")
+        stale.error_code = 400
+        bot = _FakeBot(reject=stale)
+        thumbnail.send_thumbnail(bot, 1, anime, assets=assets)
+        assert bot.sent[0] == "large-1" and not isinstance(bot.sent[1], str)
+        assert store.get(key)[0] == b"large-2"
+    finally:
+        thumbnail.fetch_anime_from_anilist, thumbnail.telegram_file_ids = saved
+    print("  ✓ file_ids reused, stale ones replaced")
+
+
+class _ThrottledSession(bench.FixtureSession):
+    """
+    Fixture session whose AniList answers 429 (Retry-After: 1) to the first
+    `throttle` POSTs and reports `remaining` in X-RateLimit-Remaining.
+    """
+
+    def __init__(self, throttle, remaining=50):
+        super().__init__()
+        self.throttle = throttle
+        self.remaining = remaining
+
+    def post(self, url, json=None, timeout=None, **kwargs):
+        self.requests += 1
+        if self.throttle > 0:
+            self.throttle -= 1
+            return bench.FixtureResponse(429, headers={"Retry-After": "1", "X-RateLimit-Remaining": "0"},
+                                         payload={"data": None, "errors": [{"message": "Too Many Requests.", "status": 429}]})
+        r = self.serve_post(json)
+        r.headers = {"X-RateLimit-Limit": "90", "X-RateLimit-Remaining": str(self.remaining)}
+        return r
+
+
+class _PartialBatchSession(bench.FixtureSession):
+    """
+    Fixture session whose batched AniList answers fail the aliases of the
+    values in `flaky` (value -> times to fail) with a 500 error next to the
+    data of the others, the way AniList reports a partial failure.
+    Records the values of every batch it answers.
+    """
+
+    def __init__(self, flaky):
+        super().__init__()
+        self.flaky = dict(flaky)
+        self.batches = []
+
+    def post(self, url, json=None, timeout=None, **kwargs):
+        self.requests += 1
+        variables = (json or {}).get("variables") or {}
+        self.batches.append([variables[name] for name in sorted(variables, key=lambda n: int(n[1:]))])
+        r = self.serve_post(json)
+        body = r.json()
+        errors = list(body.get("errors") or [])
+        for name, value in variables.items():
+            if self.flaky.get(value, 0) > 0:
+                self.flaky[value] -= 1
+                body["data"]["m" + name[1:]] = None
+                errors.append({"status": 500, "message": "Internal Server Error", "path": ["m" + name[1:]]})
+        if len(errors) > len(body.get("errors") or []):
+            return bench.FixtureResponse(500, payload={"data": body["data"], "errors": errors})
+        return r
+
+
+def test_anilist_batches_retry_only_failed_aliases():
+    """Batches are chunked; aliases that errored are retried together, "not found" ones never."""
+    print("Testing AniList batch retries...")
+    saved = thumbnail._http_session, thumbnail.anilist_cache
+    with tempfile.TemporaryDirectory() as tmp:
+        thumbnail.anilist_cache = thumbnail.AniListCache(tmp)
+        try:
+            session = thumbnail._http_session = _PartialBatchSession({"titan": 1, "totemo nagai": 1})
+            names = ["Spy x Family", "titan", "zzz no match", "totemo nagai", "another miss"]
+            found = thumbnail.fetch_many_from_anilist(names, chunk_size=2)
+            assert session.batches == [["Spy x Family", "titan"], ["zzz no match", "totemo nagai"],
+                                       ["another miss"],
+                                       ["titan", "totemo nagai"]], session.batches  # the 500s, re-batched
+            assert [found[n] and found[n]["id"] for n in names] == [1001, 1002, None, 1003, None]
+
+            # a value that keeps failing is tried 1 + retries times, then answered as None
+            session = thumbnail._http_session = _PartialBatchSession({"kyojin": 99})
+            found = thumbnail.fetch_many_from_anilist(["kyojin"], retries=2)
+            assert found == {"kyojin": None} and session.requests == 3
+
+            # IDs: same chunking; an unknown ID is a 404 and costs no retry
+            session = thumbnail._http_session = _PartialBatchSession({})
+            thumbnail.anilist_cache = thumbnail.AniListCache(os.path.join(tmp, "ids"))
+            found = thumbnail.fetch_many_ids_from_anilist([1001, 1002, 1003, 9999], chunk_size=3)
+            assert session.batches == [[1001, 1002, 1003], [9999]]
+            assert [m and m["id"] for m in found.values()] == [1001, 1002, 1003, None]
+        finally:
+            thumbnail._http_session, thumbnail.anilist_cache = saved
+    print("  ✓ Only failed aliases retried")
+
+
+def test_anilist_rate_limit():
+    """A 429 pauses AniList traffic for its Retry-After and reaches callers as throttling, not "not found"."""
+    print("Testing the AniList rate limiter...")
+    session = _ThrottledSession(throttle=1)
+    saved = thumbnail._http_session, thumbnail.anilist_limiter
+    thumbnail._http_session = session
+    thumbnail.anilist_limiter = thumbnail.RateLimiter(thumbnail._anilist_rate(90), burst=5)
+    try:
+        try:
+            thumbnail.fetch_anime_from_anilist("a title that is throttled")
+            assert False, "429 reported as not found"
+        except thumbnail.AniListRateLimited as e:
+            assert e.retry_after == 1
+        # paused: an interactive lookup that cannot wait that long gives up without a request
+        before = session.requests
+        try:
+            thumbnail.fetch_anime_from_anilist("a title that is throttled", timeout=0.2)
+            assert False, "lookup sent during the Retry-After pause"
+        except thumbnail.AniListRateLimited as e:
+            assert 0 < e.retry_after <= 1
+        assert session.requests == before
+        # batch lookups wait the pause out instead of failing
+        start = time.monotonic()
+        session.throttle = 1
+        found = thumbnail.fetch_many_from_anilist(["kyojin", "zzz no match"])
+        assert time.monotonic() - start > 0.9
+        assert found["kyojin"]["id"] == 1002 and found["zzz no match"] is None
+        # X-RateLimit-Limit sets the pace, X-RateLimit-Remaining caps the bucket
+        stats = thumbnail.anilist_limiter_stats()
+        assert abs(stats["rate_per_s"] - thumbnail._anilist_rate(90)) < 1e-9
+        assert set(stats["waiting"]) == set(thumbnail.ANILIST_PRIORITIES)
+        session.remaining = 0
+        assert thumbnail.fetch_anime_from_anilist("totemo nagai", priority="background")
+        assert thumbnail.anilist_limiter_stats()["tokens"] < 1
+    finally:
+        thumbnail._http_session, thumbnail.anilist_limiter = saved
+    print("  ✓ 429 honored and reported as throttling")
+
+
+def test_queue_starved_lookup_keeps_circuit_closed():
+    """A lookup whose budget runs out while queued for a slot sends nothing and is not an AniList failure."""
+    print("Testing queue-starved AniList lookups...")
+    session = bench.FixtureSession()
+    host = thumbnail.urlsplit(thumbnail.ANILIST_URL).netloc
+    saved = (thumbnail._http_session, thumbnail._async_http, thumbnail.upstream_breaker,
+             thumbnail._anilist_slot, thumbnail._anilist_slot_async)
+
+    async def slot_async(priority, budget):
+        await asyncio.sleep(0.1)
+
+    thumbnail._http_session = session
+    thumbnail._async_http = bench.FixtureAsyncHTTP(session)
+    thumbnail.upstream_breaker = thumbnail.CircuitBreaker(failures=2, cooldown=60)
+    # the slot comes through only after the 0.05 s interactive budget is gone
+    thumbnail._anilist_slot = lambda priority, budget: time.sleep(0.1)
+    thumbnail._anilist_slot_async = slot_async
+    try:
+        for i in range(3):
+            assert thumbnail.fetch_anime_from_anilist(f"starved lookup {i}", timeout=0.05) is None
+            assert thumbnail.run_sync(thumbnail.fetch_anime_async(f"starved async lookup {i}", timeout=0.05)) is None
+        assert thumbnail.fetch_many_from_anilist(["starved batch"], timeout=0.05, priority="interactive") == {"starved batch": None}
+        assert session.requests == 0
+        assert thumbnail.upstream_breaker.state(host) == "closed"
+        # raised inside the guard, a spent deadline still isn't held against the host
+        for _ in range(3):
+            try:
+                with thumbnail._upstream(thumbnail.ANILIST_URL):
+                    raise thumbnail.DeadlineExceeded("deadline exceeded")
+            except thumbnail.DeadlineExceeded:
+                pass
+        assert thumbnail.upstream_breaker.state(host) == "closed"
+    finally:
+        (thumbnail._http_session, thumbnail._async_http, thumbnail.upstream_breaker,
+         thumbnail._anilist_slot, thumbnail._anilist_slot_async) = saved
+    print("  ✓ Circuit stays closed")
+
+
+def test_prewarm_against_fake_anilist():
+    """Prewarming over real sockets leaves lookups and renders for warmed titles with nothing to fetch."""
+    print("Testing cache prewarming...")
+    assert thumbnail.current_season(datetime.datetime(2025, 12, 3)) == ("WINTER", 2026)
+    assert thumbnail.current_season(datetime.datetime(2026, 5, 1)) == ("SPRING", 2026)
+    saved = thumbnail._http_session, thumbnail.ANILIST_URL, thumbnail.request_log, thumbnail.anilist_cache
+    with bench.FakeAniListServer() as server, tempfile.TemporaryDirectory() as tmp:
+        thumbnail._http_session = None  # a real requests.Session
+        thumbnail.ANILIST_URL = server.url
+        thumbnail.request_log = thumbnail.RequestLog(os.path.join(tmp, "requests.jsonl"))
+        thumbnail.anilist_cache = thumbnail.AniListCache(tmp)
+        try:
+            summary = thumbnail.run_prewarm(["trending"], limit=2, rate=6000, render=True, encoder="webp",
+                                            idle=lambda: True)
+            assert summary["titles"] == summary["warmed"] == summary["rendered"] == 2, summary
+            assert summary["anilist_requests"] == 1 and summary["images"] >= 2 and not summary["failed"]
+            # warmed titles: the search, the images and the render all come from cache
+            before = server.session.requests
+            anime = thumbnail.fetch_anime_from_anilist("Attack on Titan")
+            assert anime["id"] == 1002 and anime["coverImage"]["extraLarge"].startswith(server.url)
+            hits = render_cache_stats()["memory"]["hits"]
+            generate_thumbnail(anime, encoder="webp")
+            assert render_cache_stats()["memory"]["hits"] == hits + 1
+            assert server.session.requests == before
+
+            # the request log ranks titles; only uncached ones cost an AniList request
+            for query, media_id in (("totemo nagai", 1003), ("totemo nagai", 1003), ("titan", 1002)):
+                thumbnail.request_log.record(query, media_id)
+            assert thumbnail.request_log.popular() == [1003, 1002]
+            summary = thumbnail.run_prewarm(["log"], rate=6000, render=False, idle=lambda: True)
+            assert summary["titles"] == summary["warmed"] == 2 and summary["anilist_requests"] == 1, summary
+            summary = thumbnail.run_prewarm(["log"], rate=0, render=False, idle=lambda: True)  # 0: unpaced
+            assert summary["warmed"] == 2 and summary["anilist_requests"] == 0, summary
+
+            # no budget, no requests; never idle, nothing done until stopped
+            before = server.session.requests
+            summary = thumbnail.run_prewarm(["trending", "season"], anilist_budget=0, idle=lambda: True)
+            assert summary["titles"] == 0 and summary["anilist_requests"] == 0
+            stop = threading.Event()
+            threading.Timer(0.2, stop.set).start()
+            summary = thumbnail.run_prewarm(["trending"], idle=lambda: False, stop=stop)
+            assert summary["stopped"] and summary["titles"] == 0
+            assert server.session.requests == before
+        finally:
+            thumbnail._http_session, thumbnail.ANILIST_URL, thumbnail.request_log, thumbnail.anilist_cache = saved
+    print("  ✓ Metadata, images and renders warmed")
+
+
+def test_cover_crop_non_rgb_sources():
+    """Palette, CMYK and alpha sources are cropped before conversion, with the same result."""
+    base = Image.effect_mandelbrot((300, 480), (-2, -1.5, 1, 1.5), 60).convert("RGB")
+    rgba = base.convert("RGBA")
+    rgba.putalpha(Image.linear_gradient("L").resize(base.size))
+    sources = {"P": (base.convert("P"), lambda im: im.convert("RGB")),
+               "CMYK": (base.convert("CMYK"), lambda im: im.convert("RGB")),
+               "RGBA": (rgba, lambda im: im.convert("RGBA"))}
+    for mode, (img, reference) in sources.items():
+        for size in ((320, 90), (400, 800)):
+            got = thumbnail.resize_cover_to_fill(img, *size)
+            want = reference(img).resize(size, Image.Resampling.LANCZOS, box=_cover_box(img.size, size))
+            assert got.mode == want.mode and got.size == want.size, mode
+            diff = max(abs(a - b) for a, b in zip(got.tobytes(), want.tobytes()))
+            assert diff <= 3, (mode, size, diff)
+
+
+def _cover_box(src, target):
+    """The source box resize_cover_to_fill shows at target size (no draft)."""
+    ratio = src[0] / src[1]
+    if ratio > target[0] / target[1]:
+        new_w, new_h = int(target[1] * ratio), target[1]
+    else:
+        new_w, new_h = target[0], int(target[0] / ratio)
+    left, top = (new_w - target[0]) // 2, (new_h - target[1]) // 2
+    sx, sy = src[0] / new_w, src[1] / new_h
+    return (left * sx, top * sy, (left + target[0]) * sx, (top + target[1]) * sy)
+
+
+def test_benchmark_smoke():
+    """The benchmark runs offline and flags a slowdown against a faster baseline."""
+    print("Testing benchmark harness...")
+    result = bench.run_benchmark(renders=2, workers=1)
+    assert set(result["latency_ms"]["stages"]) == set(bench.STAGES)
+    assert result["latency_ms"]["total"]["p50"] > 0
+    assert result["renders_per_sec"]["1"] > 0
+    assert "render_peak_mb" in result
+    assert bench.compare(result, result) == []
+    faster = {"latency_ms": {"total": {"p50": result["latency_ms"]["total"]["p50"] / 2}, "stages": {}}}
+    assert bench.compare(result, faster)
+    print("  ✓ Benchmark harness works")
 
 
 def main():
@@ -222,15 +1163,41 @@ def main():
     print("Thumbnail Generator Test Suite")
     print("=" * 60)
     print()
-    
+
     test_font_loading()
+    test_font_index()
     test_placeholder_generation()
-    test_truncate_text()
-    test_text_outline()
+    test_wrap_text()
     test_thumbnail_generation()
     test_thumbnail_with_missing_poster()
     test_long_title()
-    
+    test_encoders()
+    test_render_job_roundtrip()
+    test_render_pool()
+    test_variants()
+    test_layout_templates()
+    test_scheduler_keeps_request_ids()
+    test_scheduler_queue_fairness_and_coalescing()
+    test_normalize_search()
+    test_anilist_cache_stale_while_revalidate()
+    test_anilist_index_shared_between_processes()
+    test_anilist_index_lru_and_flush()
+    test_async_lookups()
+    test_async_assets_and_run_sync()
+    test_async_http_client()
+    test_batch_input()
+    test_batch_resume()
+    test_download_and_pixel_limits()
+    test_deadline_breaker_and_failed_urls()
+    test_bot_job_bounds_the_whole_request()
+    test_bot_reuses_telegram_file_ids()
+    test_anilist_batches_retry_only_failed_aliases()
+    test_anilist_rate_limit()
+    test_queue_starved_lookup_keeps_circuit_closed()
+    test_prewarm_against_fake_anilist()
+    test_cover_crop_non_rgb_sources()
+    test_benchmark_smoke()
+
     print("=" * 60)
     print("All tests completed!")
     print(f"Check {TEMP_DIR}/test_*.png files for visual verification.")
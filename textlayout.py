@@ -0,0 +1,98 @@
+"""
+Text measurement and line wrapping for the thumbnail layout.
+- Word and space advances are measured once per font (font.getlength) and
+  kept in an LRU keyed by (font, string)
+- wrap_text() is a linear-time greedy wrapper: it adds up cached advances and
+  only measures the real line (kerning and glyph overhang included) when the
+  estimate is close to the limit
+- text_size() returns the same box as ImageDraw.textbbox at the origin
+"""
+
+from cache import LRUCache
+
+MEASURE_CACHE_SIZE = 20000
+
+_advances = LRUCache(max_entries=MEASURE_CACHE_SIZE, name="text-advance")
+_boxes = LRUCache(max_entries=MEASURE_CACHE_SIZE, name="text-bbox")
+_pinned_fonts = {}  # id -> font, for fonts without a file path (keeps ids unique)
+
+
+def font_key(font):
+    """
+    Cache key for a font: file path, size and face index when it has a file,
+    otherwise the object identity (the font is pinned so the id is never reused).
+    """
+    path = getattr(font, "path", None)
+    if isinstance(path, str):
+        return (path, getattr(font, "size", None), getattr(font, "index", 0))
+    _pinned_fonts.setdefault(id(font), font)
+    return ("id", id(font))
+
+
+def text_length(font, text):
+    """
+    Advance width of text (where the next glyph would start).
+    """
+    key = (font_key(font), text)
+    width = _advances.get(key)
+    if width is None:
+        try:
+            width = font.getlength(text)
+        except AttributeError:
+            box = font.getbbox(text)
+            width = box[2] - box[0]
+        _advances.put(key, width)
+    return width
+
+
+def text_size(font, text):
+    """
+    (width, height) of the ink box of text, as ImageDraw.textbbox((0, 0), ...).
+    """
+    key = (font_key(font), text)
+    size = _boxes.get(key)
+    if size is None:
+        box = font.getbbox(text)
+        size = (box[2] - box[0], box[3] - box[1])
+        _boxes.put(key, size)
+    return size
+
+
+def wrap_text(text, font, max_width):
+    """
+    Greedy word wrap: each line's ink width is <= max_width (a single word
+    wider than max_width gets a line of its own).
+
+    Line widths are estimated from cached word and space advances. Advances
+    and ink boxes differ by kerning and by glyph overhang at the line ends,
+    so lines within `slack` of the limit are measured for real.
+    """
+    words = text.split()
+    if not words:
+        return []
+    space = text_length(font, " ")
+    slack = max(4, int(getattr(font, "size", 10) * 0.25))
+    lines = []
+    cur = [words[0]]
+    cur_w = text_length(font, words[0])
+    for w in words[1:]:
+        est = cur_w + space + text_length(font, w)
+        if est + slack < max_width:
+            fits = True
+        elif est - slack > max_width:
+            fits = False
+        else:
+            fits = text_size(font, " ".join(cur + [w]))[0] <= max_width
+        if fits:
+            cur.append(w)
+            cur_w = est
+        else:
+            lines.append(" ".join(cur))
+            cur = [w]
+            cur_w = text_length(font, w)
+    lines.append(" ".join(cur))
+    return lines
+
+
+def cache_stats():
+    return {"advance": _advances.stats(), "bbox": _boxes.stats()}
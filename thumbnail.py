@@ -17,6 +17,33 @@ import textwrap
 import re
 import math
 import glob
+import time
+import datetime
+import hashlib
+import threading
+import json
+import tempfile
+import unicodedata
+import struct
+import email.utils
+import multiprocessing
+import atexit
+import contextlib
+import contextvars
+import functools
+import itertools
+import asyncio
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+from concurrent.futures import TimeoutError as FutureTimeoutError, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+
+from cache import LRUCache, DiskStore
+import textlayout
+import sprites
+import metrics
+from resilience import Deadline, DeadlineExceeded, CircuitBreaker, CircuitOpen, RateLimiter
 
 # Optional: telegram bot (pyTelegramBotAPI / telebot)
 try:
@@ -24,6 +51,14 @@ try:
 except Exception:
     telebot = None
 
+# Optional: async HTTP client and the HTTP API server (`python thumbnail.py serve`)
+try:
+    import aiohttp
+    from aiohttp import web
+except Exception:
+    aiohttp = None
+    web = None
+
 # ---------- Configuration ----------
 CANVAS_WIDTH, CANVAS_HEIGHT = 1280, 720
 
@@ -38,8 +73,29 @@ GENRE_BG = (245, 245, 245)
 GENRE_TEXT = (20, 20, 20)
 PLACEHOLDER_BG = (40, 45, 55)
 
-# Fonts directory
+# Card panels: (x, y, w, h, corner radius). The info box sits inside the main
+# card at a height that depends on the title, so only its size is fixed.
+MAIN_CARD = (50, 190, 750, 420, 28)
+CHAR_CARD = (850, 100, 380, 220, 18)  # landscape, with character bio
+CHAR_IMAGE_SIZE = (360, 120)          # character image crop at the top of the char card
+SYN_CARD = (850, 340, 380, 300, 18)   # below char card, slightly taller for more text
+INFO_BOX = (400, 100, 12)             # w, h, radius
+
+# Output variants cut from one rendered canvas: output size, the canvas box
+# (x, y, w, h) to show (None: the whole canvas) and an encoder (None: the
+# call's). A box whose shape differs from the output is center-cropped to fit.
+Variant = namedtuple("Variant", "width height crop encoder", defaults=(None, None))
+SQUARE_CROP = (24, 0, 720, 720)  # logo, genres and most of the main card
+VARIANT_PRESETS = {
+    "full": Variant(CANVAS_WIDTH, CANVAS_HEIGHT),
+    "half": Variant(CANVAS_WIDTH // 2, CANVAS_HEIGHT // 2),
+    "square": Variant(360, 360, SQUARE_CROP),
+}
+MAX_VARIANT_SIDE = 4096
+
+# Fonts directory, and the family preferred when several match a style
 FONTS_DIR = os.getenv("FONTS_DIR", "fonts")
+FONT_FAMILY = os.getenv("FONT_FAMILY", "Roboto")
 
 # TeleBot token (env) - replace with your token or set env BOT_TOKEN
 API_TOKEN = os.getenv("BOT_TOKEN", "8388209429:AAGSHFmVDpZqryMYJur4FGYZAjUxWEe8VIk")
@@ -49,65 +105,317 @@ NO_BOT = bool(os.getenv("NO_BOT", ""))
 # Local test background (the uploaded file path in the container)
 LOCAL_TEST_BG = "/mnt/data/6152203217874390055.jpg"
 
+# Caches: downloaded images are kept decoded in memory and raw on disk.
+# The disk tier can be shared by several worker processes.
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+IMAGE_CACHE_MEM_BYTES = int(os.getenv("IMAGE_CACHE_MEM_BYTES", 128 * 1024 * 1024))
+IMAGE_CACHE_DISK_BYTES = int(os.getenv("IMAGE_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", 24 * 3600))  # seconds before revalidating
+# Bounds for untrusted images: downloads are streamed and abandoned past
+# MAX_IMAGE_BYTES; images whose header declares more than MAX_IMAGE_PIXELS
+# are never decoded (a 1 MB PNG can expand to gigabytes)
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 20 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+
+# Rendered thumbnails, keyed by a hash of the inputs. Bump LAYOUT_VERSION
+# whenever the drawing code changes so stale renders are not served.
+LAYOUT_VERSION = 4
+# Layout template (see TEMPLATES): a registered name or the path of a JSON
+# template file. Compiled render plans are kept per template hash.
+THUMB_TEMPLATE = os.getenv("THUMB_TEMPLATE", "classic")
+RENDER_PLAN_CACHE_SIZE = 16
+RENDER_CACHE_MEM_BYTES = int(os.getenv("RENDER_CACHE_MEM_BYTES", 64 * 1024 * 1024))
+RENDER_CACHE_DISK_BYTES = int(os.getenv("RENDER_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+# Rendering backend: "thread" renders in the calling thread, "process" sends
+# jobs to a pool of long-lived worker processes (one per core by default)
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "thread")
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", os.cpu_count() or 1))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 60))  # seconds per job
+# Output encoders: profile name -> (PIL format, save options, MIME type, extension).
+# "png" is the historical output; compare profiles with `python thumbnail.py encoders`.
+ENCODER_PROFILES = {
+    "png": ("PNG", {"compress_level": 6}, "image/png", "png"),
+    "png-fast": ("PNG", {"compress_level": 1}, "image/png", "png"),
+    "png-optimized": ("PNG", {"optimize": True}, "image/png", "png"),
+    # 4:4:4 keeps the small coloured text sharp; 4:2:0 is ~10% smaller
+    "jpeg": ("JPEG", {"quality": 90, "subsampling": "4:4:4", "optimize": True}, "image/jpeg", "jpg"),
+    "webp": ("WEBP", {"quality": 85, "method": 4}, "image/webp", "webp"),
+}
+DEFAULT_ENCODER = os.getenv("THUMB_ENCODER", "png")
+# Bot job scheduler: render workers, max waiting jobs, max waiting jobs per chat
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 4))
+BOT_QUEUE_SIZE = int(os.getenv("BOT_QUEUE_SIZE", 100))
+BOT_PER_CHAT_QUEUE = int(os.getenv("BOT_PER_CHAT_QUEUE", 5))
+# Telegram recompresses photos to JPEG anyway, so the bot uploads JPEG by default
+BOT_ENCODER = os.getenv("BOT_ENCODER", "jpeg")
+# Telegram file_ids of thumbnails already uploaded, keyed by render cache key
+TELEGRAM_FILE_ID_DISK_BYTES = int(os.getenv("TELEGRAM_FILE_ID_DISK_BYTES", 16 * 1024 * 1024))
+
+# HTTP: one pooled session shared by all downloads; images needed by a render
+# are fetched in parallel on a small thread pool.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 8))
+# Async HTTP client (aiohttp): open connections per host, idle keep-alive in
+# seconds, and how many AniList searches fetch_many_anime_async runs at once
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", 8))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 30))
+ASYNC_LOOKUP_CONCURRENCY = int(os.getenv("ASYNC_LOOKUP_CONCURRENCY", 32))
+# AniList GraphQL endpoint (point it at a fake server to test without AniList)
+ANILIST_URL = os.getenv("ANILIST_URL", "https://graphql.anilist.co")
+# Latency budget, in seconds, of one bot or API request once its work starts:
+# the AniList lookup may use half of what is left, downloads what is left
+# minus DEADLINE_RENDER_RESERVE; an image not in by then is drawn as the
+# placeholder (it keeps downloading into the cache for the next request)
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 8))
+DEADLINE_RENDER_RESERVE = float(os.getenv("DEADLINE_RENDER_RESERVE", 1.0))
+# Circuit breaker per upstream host: after BREAKER_FAILURES consecutive
+# failures (timeouts, connection errors, 5xx) the host is not called for
+# BREAKER_COOLDOWN seconds, then one trial request decides whether it is back
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+# Image URLs that failed for good (HTTP error, too large, not an image) are
+# not requested again for FAILED_URL_TTL seconds
+FAILED_URL_TTL = int(os.getenv("FAILED_URL_TTL", 300))
+
+# AniList responses: Media payloads are cached by ID; normalized search strings
+# map to IDs through a persistent index. Payloads older than the TTL are still
+# served (and refreshed in the background) until ANILIST_STALE_TTL.
+ANILIST_CACHE_TTL = int(os.getenv("ANILIST_CACHE_TTL", 6 * 3600))
+ANILIST_STALE_TTL = int(os.getenv("ANILIST_STALE_TTL", 7 * 24 * 3600))
+ANILIST_CACHE_SIZE = int(os.getenv("ANILIST_CACHE_SIZE", 2000))  # payloads kept in memory
+ANILIST_INDEX_SIZE = int(os.getenv("ANILIST_INDEX_SIZE", 20000))  # search strings remembered
+# New index entries are written out at most this often (and after batch and prewarm runs)
+ANILIST_INDEX_FLUSH_INTERVAL = float(os.getenv("ANILIST_INDEX_FLUSH_INTERVAL", 30))
+ANILIST_CACHE_DISK_BYTES = int(os.getenv("ANILIST_CACHE_DISK_BYTES", 64 * 1024 * 1024))
+# Searches packed into one aliased GraphQL request (keeps under AniList's complexity limit)
+ANILIST_BATCH_SIZE = int(os.getenv("ANILIST_BATCH_SIZE", 10))
+# AniList rate limit in requests per minute (AniList allows 90 and reports its
+# current limit in X-RateLimit-Limit), of which ANILIST_BURST may go back to
+# back. Requests over it queue by priority: interactive lookups, then batch,
+# then background work (stale-entry refreshes, prewarming).
+ANILIST_RATE_LIMIT = int(os.getenv("ANILIST_RATE_LIMIT", 90))
+ANILIST_BURST = int(os.getenv("ANILIST_BURST", 5))
+ANILIST_PRIORITIES = {"interactive": 0, "batch": 1, "background": 2}
+
+# HTTP API server: render worker threads, max requests in progress (more get
+# 503), largest accepted POST body and the Cache-Control max-age of images
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", os.getenv("PORT", 8080)))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 4))
+SERVER_MAX_PENDING = int(os.getenv("SERVER_MAX_PENDING", 64))
+SERVER_MAX_BODY = int(os.getenv("SERVER_MAX_BODY", 1024 * 1024))
+SERVER_CACHE_MAX_AGE = int(os.getenv("SERVER_CACHE_MAX_AGE", 3600))
+
+# Batch rendering (`python thumbnail.py batch`): items resolved per AniList
+# round of lookups, and the checkpoint file name inside the output directory
+BATCH_LOOKUP_CHUNK = int(os.getenv("BATCH_LOOKUP_CHUNK", 100))
+BATCH_CHECKPOINT = ".batch-checkpoint.jsonl"
+
+# Prewarming: fetches metadata and images (and with PREWARM_RENDER=1 renders
+# thumbnails) for the titles most likely to be asked for next, from the
+# sources in PREWARM_SOURCES: AniList "trending", this "season", and our own
+# request "log". The bot and the API server run it every PREWARM_INTERVAL
+# seconds (0: never) while idle; `python thumbnail.py prewarm` runs it once.
+# A run warms at most PREWARM_LIMIT titles per source, PREWARM_RATE titles a
+# minute, and sends at most PREWARM_ANILIST_BUDGET AniList requests.
+PREWARM_INTERVAL = int(os.getenv("PREWARM_INTERVAL", 6 * 3600))
+PREWARM_SOURCES = os.getenv("PREWARM_SOURCES", "log,trending,season")
+PREWARM_LIMIT = int(os.getenv("PREWARM_LIMIT", 50))
+PREWARM_RATE = float(os.getenv("PREWARM_RATE", 30))
+PREWARM_ANILIST_BUDGET = int(os.getenv("PREWARM_ANILIST_BUDGET", 20))
+PREWARM_RENDER = bool(os.getenv("PREWARM_RENDER", ""))
+# Searches that found a title are logged to $CACHE_DIR/requests.jsonl (rotated
+# past REQUEST_LOG_BYTES); the "log" source ranks the last REQUEST_LOG_WINDOW seconds
+REQUEST_LOG_BYTES = int(os.getenv("REQUEST_LOG_BYTES", 4 * 1024 * 1024))
+REQUEST_LOG_WINDOW = int(os.getenv("REQUEST_LOG_WINDOW", 7 * 24 * 3600))
+
+# Metrics: counters, latency histograms and cache gauges (see metrics.py).
+# Off unless METRICS=1 or METRICS_PORT is set; METRICS_PORT serves them in
+# Prometheus format, and SIGUSR1 writes them to the log.
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_ENABLED = bool(os.getenv("METRICS", "")) or METRICS_PORT > 0
+
 # ---------- Logging ----------
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
+    format="%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(metrics.RequestIdFilter())
 logger = logging.getLogger("anime-mayhem-gen")
 
+# ---------- Stage timing hook ----------
+# Pipeline stages (download, decode, resize, layout, composite, encode) run
+# inside `with _stage(name):`. Without a hook this is a shared no-op context.
+_stage_hook = None
+_NO_STAGE = contextlib.nullcontext()
+
+def set_stage_hook(hook):
+    """
+    Installs hook(name) -> context manager, entered around every pipeline
+    stage (None removes it). Stages nest: "composite" wraps the whole render,
+    so a hook should subtract nested stages to get time spent compositing.
+    Used by bench.py; only stages running in this process are seen.
+    """
+    global _stage_hook
+    _stage_hook = hook
+
+def _stage(name):
+    hook = _stage_hook
+    return _NO_STAGE if hook is None else hook(name)
+
+def _metrics_stage(name):
+    # "composite" covers all of render_thumbnail, nested stages included
+    return metrics.span("render_stage", stage=name)
+
 # ---------- Font Manager ----------
+# Named weights as they appear in font style names, heaviest-first so that
+# "ExtraBold" is not read as "Bold" and "SemiBold" not as "Bold".
+FONT_WEIGHTS = (
+    ("black", 900), ("heavy", 900), ("extrabold", 800), ("ultrabold", 800),
+    ("semibold", 600), ("demibold", 600), ("bold", 700), ("medium", 500),
+    ("extralight", 200), ("ultralight", 200), ("light", 300), ("thin", 100),
+    ("hairline", 100),
+)
+STYLE_WEIGHTS = {"bold": 700, "regular": 400, "light": 300}
+
 class FontManager:
-    def __init__(self, fonts_dir=FONTS_DIR):
+    """
+    Validated index of the fonts directory. Each usable file is recorded with
+    the family, weight and italic flag from its own name table; empty or
+    corrupt files are skipped. The index is persisted (keyed by the directory
+    mtime) so later startups don't open every font, and fonts are loaded on
+    first use through a (path, size) cache.
+    """
+
+    def __init__(self, fonts_dir=FONTS_DIR, index_path=None, family=None):
         self.fonts_dir = fonts_dir
-        self.fonts = self._scan_fonts()
-        logger.info(f"Found {sum(len(v) for v in self.fonts.values())} fonts in {self.fonts_dir}")
+        self.family = family if family is not None else FONT_FAMILY
+        self.index_path = index_path or os.path.join(CACHE_DIR, "fonts_index.json")
+        self._lock = threading.Lock()
+        self._loaded = {}  # (path, size) -> font
+        self._picked = {}  # style -> path or None
+        self.index = self._load_index()
+        self.fonts = self._classify()
+        logger.info(f"Found {len(self.index)} usable fonts in {self.fonts_dir}")
+
+    def _dir_stamp(self):
+        try:
+            return os.stat(self.fonts_dir).st_mtime
+        except OSError:
+            return None
+
+    def _load_index(self):
+        stamp = self._dir_stamp()
+        if stamp is None:
+            logger.warning(f"Fonts dir '{self.fonts_dir}' not found. Using default PIL font.")
+            return []
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("dir") == os.path.abspath(self.fonts_dir) and cached.get("mtime") == stamp:
+                return cached["fonts"]
+        except (OSError, ValueError, KeyError):
+            pass
+        index = self._scan_fonts()
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(self.index_path) or ".")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"dir": os.path.abspath(self.fonts_dir), "mtime": stamp, "fonts": index}, f)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not save font index: {e}")
+        return index
 
     def _scan_fonts(self):
         """
-        Scans fonts directory and classifies them roughly into 'bold', 'regular', 'light', 'other'
-        based on filename heuristics.
-        Returns dict: {'bold': [...], 'regular': [...], 'light': [...], 'all':[...]}
+        Opens every .ttf/.otf in the fonts directory once and returns a list of
+        {'path', 'family', 'style', 'weight', 'italic'} for the usable ones.
+        """
+        index = []
+        paths = sorted(glob.glob(os.path.join(self.fonts_dir, "*.ttf")) + glob.glob(os.path.join(self.fonts_dir, "*.otf")))
+        for path in paths:
+            try:
+                if os.path.getsize(path) == 0:
+                    logger.warning(f"Skipping empty font file {path}")
+                    continue
+                family, style = ImageFont.truetype(path, 12).getname()
+            except Exception as e:
+                logger.warning(f"Skipping unreadable font {path}: {e}")
+                continue
+            style = style or "Regular"
+            key = style.lower().replace(" ", "").replace("-", "")
+            weight = next((w for name, w in FONT_WEIGHTS if name in key), 400)
+            index.append({"path": path, "family": family or "", "style": style,
+                          "weight": weight, "italic": "italic" in key or "oblique" in key})
+        return index
+
+    def _classify(self):
+        """
+        Compatibility view: {'bold': [...], 'regular': [...], 'light': [...], 'all':[...]}
         """
         data = {"bold": [], "regular": [], "light": [], "all": []}
-        if not os.path.isdir(self.fonts_dir):
-            logger.warning(f"Fonts dir '{self.fonts_dir}' not found. Using default PIL font.")
-            return data
-
-        exts = ("*.ttf", "*.otf")
-        for ext in exts:
-            for path in glob.glob(os.path.join(self.fonts_dir, ext)):
-                name = os.path.basename(path).lower()
-                data["all"].append(path)
-                if any(k in name for k in ("bold", "black", "heavy", "demi", "semibold")):
-                    data["bold"].append(path)
-                elif any(k in name for k in ("light", "thin", "hairline")):
-                    data["light"].append(path)
-                else:
-                    data["regular"].append(path)
-        # fallback: if classes empty, distribute
-        if not data["regular"] and data["all"]:
-            data["regular"] = data["all"][:]
+        for entry in self.index:
+            data["all"].append(entry["path"])
+            if entry["weight"] >= 600:
+                data["bold"].append(entry["path"])
+            elif entry["weight"] <= 300:
+                data["light"].append(entry["path"])
+            else:
+                data["regular"].append(entry["path"])
         return data
 
+    def best_match(self, style="regular"):
+        """
+        Path of the font that best fits style: preferred family first, upright
+        before italic, then the weight closest to the style's target.
+        """
+        style = style if style in STYLE_WEIGHTS else "regular"
+        if style not in self._picked:
+            target = STYLE_WEIGHTS[style]
+            ranked = sorted(self.index, key=lambda e: (
+                e["family"] != self.family, e["italic"], abs(e["weight"] - target),
+                abs(e["weight"] - 500), e["path"]))  # ties go to the more neutral weight
+            self._picked[style] = ranked[0]["path"] if ranked else None
+        return self._picked[style]
+
+    def load(self, path, size):
+        """
+        ImageFont for (path, size), loaded once. None if it cannot be loaded.
+        """
+        key = (path, size)
+        font = self._loaded.get(key)
+        if font is None:
+            with self._lock:
+                font = self._loaded.get(key)
+                if font is None:
+                    try:
+                        font = ImageFont.truetype(path, size)
+                    except Exception as e:
+                        logger.warning(f"Failed to load font {path} size {size}: {e}")
+                        font = False
+                    self._loaded[key] = font
+        return font or None
+
     def pick_font(self, style="regular", size=32):
         """
         Returns ImageFont instance. style in ('bold','regular','light').
         Falls back gracefully to other categories or default font.
         """
-        style = style if style in ("bold","regular","light") else "regular"
-        cand = self.fonts.get(style, []) or self.fonts.get("regular", []) or self.fonts.get("all", [])
-        if cand:
-            path = cand[0]
-            try:
-                return ImageFont.truetype(path, size)
-            except Exception as e:
-                logger.warning(f"Failed to load font {path} size {size}: {e}")
+        path = self.best_match(style)
+        font = self.load(path, size) if path else None
+        if font is not None:
+            return font
         # fallback default
-        logger.warning("Using default PIL font as fallback.")
-        return ImageFont.load_default()
+        key = ("default", size)
+        if key not in self._loaded:
+            logger.warning("Using default PIL font as fallback.")
+            self._loaded[key] = ImageFont.load_default()
+        return self._loaded[key]
 
-# Instantiate font manager
+# Instantiate font manager (reads the font index; no font is loaded yet)
 font_manager = FontManager()
 
 # Predefine sizes (you can tweak these)
@@ -121,22 +429,44 @@ CHAR_DESC_SIZE = 22
 GENRE_SIZE = 22  # Made smaller for genre pills
 OVERVIEW_TITLE_SIZE = 28  # New smaller size for "SYNOPSIS"
 
-# Load fonts (try to pick best available)
-LOGO_FONT = font_manager.pick_font("bold", LOGO_SIZE)
-TITLE_FONT = font_manager.pick_font("bold", TITLE_SIZE)
-SUBTITLE_FONT = font_manager.pick_font("bold", SUBTITLE_SIZE)
-INFO_LABEL_FONT = font_manager.pick_font("bold", INFO_LABEL_SIZE)
-INFO_VALUE_FONT = font_manager.pick_font("regular", INFO_VALUE_SIZE)
-CHAR_NAME_FONT = font_manager.pick_font("bold", CHAR_NAME_SIZE)
-CHAR_DESC_FONT = font_manager.pick_font("light", CHAR_DESC_SIZE)
-GENRE_FONT = font_manager.pick_font("bold", GENRE_SIZE)
-OVERVIEW_TITLE_FONT = font_manager.pick_font("bold", OVERVIEW_TITLE_SIZE)  # New font for synopsis title
+# Layout fonts: (style, size). Loaded on first use via get_font(); the
+# module attributes LOGO_FONT, TITLE_FONT, ... still work (see __getattr__).
+FONT_SPECS = {
+    "LOGO_FONT": ("bold", LOGO_SIZE),
+    "TITLE_FONT": ("bold", TITLE_SIZE),
+    "SUBTITLE_FONT": ("bold", SUBTITLE_SIZE),
+    "INFO_LABEL_FONT": ("bold", INFO_LABEL_SIZE),
+    "INFO_VALUE_FONT": ("regular", INFO_VALUE_SIZE),
+    "CHAR_NAME_FONT": ("bold", CHAR_NAME_SIZE),
+    "CHAR_DESC_FONT": ("light", CHAR_DESC_SIZE),
+    "GENRE_FONT": ("bold", GENRE_SIZE),
+    "OVERVIEW_TITLE_FONT": ("bold", OVERVIEW_TITLE_SIZE),  # synopsis title
+}
+
+def get_font(name):
+    """
+    Layout font by name (a FONT_SPECS key such as "TITLE_FONT").
+    """
+    style, size = FONT_SPECS[name]
+    return font_manager.pick_font(style, size)
+
+def __getattr__(name):
+    # lazy module attributes: thumbnail.TITLE_FONT etc.
+    if name in FONT_SPECS:
+        return get_font(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ---------- Utility functions ----------
 def text_size(draw, text, font):
     """
     Wrapper to get text size using textbbox where available for accuracy.
+    Measurements are cached per (font, text) by textlayout.
     """
+    try:
+        with _stage("layout"):
+            return textlayout.text_size(font, text)
+    except Exception:
+        pass
     try:
         bbox = draw.textbbox((0,0), text, font=font)
         return bbox[2]-bbox[0], bbox[3]-bbox[1]
@@ -147,44 +477,601 @@ def text_size(draw, text, font):
             # rough fallback
             return len(text) * (font.size if hasattr(font,'size') else 10), font.size if hasattr(font,'size') else 10
 
-def wrap_text_to_width(text, font, max_width, draw):
+def wrap_text_to_width(text, font, max_width, draw=None):
     """
     Wraps text into multiple lines so each line width <= max_width
-    Uses a word-based greedy algorithm.
-    """
-    words = text.split()
-    if not words:
-        return []
-    lines = []
-    cur = words[0]
-    for w in words[1:]:
-        wcur = cur + " " + w
-        wwidth, _ = text_size(draw, wcur, font)
-        if wwidth <= max_width:
-            cur = wcur
-        else:
-            lines.append(cur)
-            cur = w
-    lines.append(cur)
-    return lines
+    Uses a word-based greedy algorithm (linear time, see textlayout.wrap_text).
+    draw is accepted for compatibility and no longer used.
+    """
+    with _stage("layout"):
+        return textlayout.wrap_text(text, font, max_width)
+
+# ---------- HTTP session ----------
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """
+    Returns the process-wide requests.Session (keep-alive, pooled connections).
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = "Mozilla/5.0 (compatible)"
+                _http_session = session
+    return _http_session
+
+# ---------- Download limits ----------
+DOWNLOAD_CHUNK = 64 * 1024
+
+class TooLarge(ValueError):
+    """
+    A download over MAX_IMAGE_BYTES, or an image over MAX_IMAGE_PIXELS.
+    """
+
+def _check_length(content_length, limit, url):
+    if content_length and str(content_length).isdigit() and int(content_length) > limit:
+        raise TooLarge(f"{url}: Content-Length {content_length} is over the {limit} byte limit")
+
+def _read_capped(content_length, chunks, limit, url):
+    """
+    Joins the chunks of a streamed body, giving up (TooLarge) as soon as it
+    passes limit bytes; a declared Content-Length over the limit fails first.
+    """
+    _check_length(content_length, limit, url)
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) > limit:
+            raise TooLarge(f"{url}: body is over the {limit} byte limit")
+    return bytes(buf)
+
+def open_image(data, url=None):
+    """
+    Image.open on raw bytes. Only the header is read, and images declaring
+    more than MAX_IMAGE_PIXELS raise TooLarge before anything is decoded.
+    """
+    img = Image.open(BytesIO(data))
+    w, h = img.size
+    if w * h > MAX_IMAGE_PIXELS:
+        img.close()
+        raise TooLarge(f"{url or 'image'} is {w}x{h}, over the {MAX_IMAGE_PIXELS} pixel limit")
+    return img
+
+# ---------- Upstream health ----------
+upstream_breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+failed_urls = LRUCache(max_entries=4096, name="failed-urls")  # url -> (expires_at, reason)
+
+class RecentlyFailed(Exception):
+    """
+    The URL failed less than FAILED_URL_TTL seconds ago; it was not requested.
+    """
+
+def _error_status(e):
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _is_transport_error(e):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, TimeoutError)):
+        return True
+    return aiohttp is not None and isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+def _is_upstream_failure(e):
+    """
+    Whether e says the host itself is in trouble (as opposed to the one URL).
+    A 429 is not: it is throttling, handled by honoring Retry-After. Neither
+    are our own spent deadlines and open circuits, which send nothing.
+    """
+    if isinstance(e, (DeadlineExceeded, CircuitOpen)):
+        return False
+    status = _error_status(e)
+    return _is_transport_error(e) or (status is not None and status >= 500)
 
-def download_image(url, timeout=10):
+@contextlib.contextmanager
+def _upstream(url):
+    """
+    Guards one call to url's host: raises CircuitOpen while the host's circuit
+    is open, and reports how the with-block went to upstream_breaker.
+    """
+    host = urlsplit(url).netloc
+    if not upstream_breaker.allow(host):
+        metrics.inc("upstream_rejected_total", host=host)
+        retry = upstream_breaker.retry_in(host)
+        raise CircuitOpen(f"{host}: circuit open, retrying in {retry:.0f}s", retry_after=retry)
     try:
-        headers = {"User-Agent":"Mozilla/5.0 (compatible)"}
-        r = requests.get(url, headers=headers, timeout=timeout)
-        r.raise_for_status()
-        return Image.open(BytesIO(r.content))
+        yield
     except Exception as e:
+        if _is_upstream_failure(e):
+            upstream_breaker.failure(host)
+            if upstream_breaker.state(host) == "open":
+                logger.warning(f"{host} is failing ({e}); circuit open for {upstream_breaker.cooldown:.0f}s")
+        else:
+            upstream_breaker.success(host)
+        raise
+    upstream_breaker.success(host)
+
+def _remember_failure(url, e):
+    """
+    Negatively caches url after a failure that retrying soon will not fix.
+    Timeouts, connection errors, 429s and calls that were never made are not
+    remembered: they say nothing about the URL.
+    """
+    if isinstance(e, (CircuitOpen, RecentlyFailed)) or _is_transport_error(e) or _error_status(e) == 429:
+        return
+    failed_urls.put(url, (time.monotonic() + FAILED_URL_TTL, str(e)))
+
+def _check_failed_url(url):
+    """
+    Raises RecentlyFailed when url is negatively cached.
+    """
+    entry = failed_urls.get(url)
+    if entry is None:
+        return
+    expires_at, reason = entry
+    if time.monotonic() >= expires_at:
+        failed_urls.pop(url)
+        return
+    raise RecentlyFailed(f"{url} failed {FAILED_URL_TTL - (expires_at - time.monotonic()):.0f}s ago: {reason}")
+
+def upstream_stats():
+    return {"breaker": upstream_breaker.stats(), "failed_urls": failed_urls.stats()}
+
+# ---------- Async HTTP ----------
+class HTTPResult:
+    """
+    A fully read async response: status, headers and body bytes.
+    """
+    __slots__ = ("status", "headers", "body", "url")
+
+    def __init__(self, status, headers, body, url=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    @property
+    def status_code(self):
+        return self.status
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise requests.HTTPError(f"{self.status} for {self.url}", response=self)
+
+    def json(self):
+        return json.loads(self.body)
+
+class AsyncHTTP:
+    """
+    Pooled aiohttp client for the async fetch functions: keep-alive
+    connections, at most `limit` open in total and `limit_per_host` per host.
+    aiohttp sessions belong to the event loop that created them, so there is
+    one session per loop (the run_sync() loop, the API server's loop, ...).
+    """
+
+    def __init__(self, limit=HTTP_POOL_SIZE, limit_per_host=HTTP_LIMIT_PER_HOST, keepalive=HTTP_KEEPALIVE):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self._sessions = {}  # event loop -> aiohttp.ClientSession
+
+    def session(self):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp package not installed")
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            for old in [l for l in self._sessions if l.is_closed()]:
+                del self._sessions[old]
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": "Mozilla/5.0 (compatible)"})
+            self._sessions[loop] = session
+        return session
+
+    async def request(self, method, url, headers=None, json=None, timeout=10, max_bytes=None):
+        """
+        Sends one request and reads the whole body. timeout is the overall
+        deadline in seconds (connect, send, wait and read together). With
+        max_bytes the body is streamed and TooLarge is raised past that size.
+        """
+        async with self.session().request(method, url, headers=headers, json=json,
+                                          timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            if max_bytes is None or r.status >= 300:
+                return HTTPResult(r.status, r.headers, await r.read(), url)
+            _check_length(r.headers.get("Content-Length"), max_bytes, url)
+            buf = bytearray()
+            async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK):
+                buf += chunk
+                if len(buf) > max_bytes:
+                    raise TooLarge(f"{url}: body is over the {max_bytes} byte limit")
+            return HTTPResult(r.status, r.headers, bytes(buf), url)
+
+    async def close(self):
+        """
+        Closes the session of the running loop.
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+_async_http = None
+_async_http_lock = threading.Lock()
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+def async_http():
+    """
+    Returns the process-wide AsyncHTTP client.
+    """
+    global _async_http
+    if _async_http is None:
+        with _async_http_lock:
+            if _async_http is None:
+                _async_http = AsyncHTTP()
+    return _async_http
+
+def async_loop():
+    """
+    Event loop of the background "async-io" thread that run_sync() uses.
+    """
+    global _async_loop
+    if _async_loop is None:
+        with _async_loop_lock:
+            if _async_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="async-io", daemon=True).start()
+                _async_loop = loop
+    return _async_loop
+
+def run_sync(coro, timeout=None):
+    """
+    Runs a coroutine on the background I/O loop and blocks for its result, so
+    threaded callers (bot handlers, pools, scripts) can use the async fetch
+    functions: run_sync(fetch_anime_async("frieren")). The caller's
+    contextvars (request ID) carry over. Must not be called from that loop.
+    """
+    loop = async_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() called on the async I/O loop; await the coroutine instead")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+# ---------- Image cache ----------
+def image_nbytes(img):
+    """
+    Approximate memory held by a decoded image.
+    """
+    w, h = img.size
+    return w * h * len(img.getbands())
+
+image_mem_cache = LRUCache(max_bytes=IMAGE_CACHE_MEM_BYTES, sizeof=image_nbytes, name="image-mem")
+image_disk_cache = DiskStore(os.path.join(CACHE_DIR, "images"), IMAGE_CACHE_DISK_BYTES, name="image-disk")
+_image_fetch_lock = threading.Lock()
+_image_fetch_stats = {"downloads": 0, "not_modified": 0, "stale_served": 0, "too_large": 0,
+                      "failed_cached": 0, "circuit_open": 0, "deadline": 0}
+
+def _count_image_fetch(key):
+    with _image_fetch_lock:
+        _image_fetch_stats[key] += 1
+    metrics.inc("image_fetch_total", result=key)
+
+def image_cache_stats():
+    """
+    Hit/miss/eviction counters for both tiers plus network counters.
+    """
+    with _image_fetch_lock:
+        net = dict(_image_fetch_stats)
+    return {"memory": image_mem_cache.stats(), "disk": image_disk_cache.stats(), "network": net}
+
+def _image_cache_probe(url):
+    """
+    Disk-tier state of url: (entry, None) while the entry is fresh, otherwise
+    (entry or None, headers for a conditional request).
+    """
+    cached = image_disk_cache.get(url)
+    headers = {}
+    if cached:
+        data, meta = cached
+        if time.time() - meta.get("validated_at", 0) < IMAGE_CACHE_TTL:
+            return cached, None
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return cached, headers
+
+def _image_not_modified(url, cached):
+    data, meta = cached
+    meta["validated_at"] = time.time()
+    image_disk_cache.put(url, data, meta)
+    _count_image_fetch("not_modified")
+    return data, meta
+
+def _image_fetch_timeout(url, timeout, deadline):
+    """
+    Timeout for fetching url within deadline (keeping DEADLINE_RENDER_RESERVE
+    for the render). Raises instead when the fetch must not be attempted.
+    """
+    _check_failed_url(url)
+    return Deadline.coerce(deadline).timeout(timeout, reserve=DEADLINE_RENDER_RESERVE)
+
+def _image_fetch_failed(url, cached, e):
+    if isinstance(e, TooLarge):
+        _count_image_fetch("too_large")
+    if isinstance(e, RecentlyFailed):
+        _count_image_fetch("failed_cached")
+    elif isinstance(e, CircuitOpen):
+        _count_image_fetch("circuit_open")
+    elif isinstance(e, DeadlineExceeded):
+        _count_image_fetch("deadline")
+    else:
+        _remember_failure(url, e)
+    if cached:
+        logger.warning(f"Revalidation failed for {url}: {e}. Using cached copy.")
+        _count_image_fetch("stale_served")
+        return cached
+    if isinstance(e, RecentlyFailed):
+        logger.debug(f"Skipped image {url}: {e}")
+    else:
         logger.warning(f"Failed to download image {url}: {e}")
+    return None
+
+def _image_downloaded(url, data, headers):
+    _count_image_fetch("downloads")
+    meta = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "validated_at": time.time(),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+    image_disk_cache.put(url, data, meta)
+    return data, meta
+
+def _fetch_image_entry(url, timeout=10, deadline=None):
+    """
+    Returns (raw_bytes, meta) for url, or None. meta["sha256"] identifies the content.
+    Served from the disk tier while fresh; stale entries are revalidated with
+    If-None-Match / If-Modified-Since, and kept if the origin is unreachable.
+    The body is streamed and dropped past MAX_IMAGE_BYTES, and only images
+    within MAX_IMAGE_PIXELS (checked from the header) are stored.
+    The network is skipped (cached copy or None) once deadline is spent, while
+    the host's circuit is open, and for URLs that failed recently.
+    """
+    cached, headers = _image_cache_probe(url)
+    if headers is None:
+        return cached
+    try:
+        timeout = _image_fetch_timeout(url, timeout, deadline)
+        with _upstream(url), metrics.span("image_request"), \
+                http_session().get(url, headers=headers, timeout=timeout, stream=True) as r:
+            if cached and r.status_code == 304:
+                return _image_not_modified(url, cached)
+            r.raise_for_status()
+            data = _read_capped(r.headers.get("Content-Length"), r.iter_content(DOWNLOAD_CHUNK), MAX_IMAGE_BYTES, url)
+        open_image(data, url).close()
+    except Exception as e:
+        return _image_fetch_failed(url, cached, e)
+    return _image_downloaded(url, data, r.headers)
+
+async def _fetch_image_entry_async(url, timeout=10, deadline=None):
+    """
+    _fetch_image_entry on the async client; same disk tier, revalidation and
+    deadline / circuit breaker / failed-URL checks.
+    """
+    cached, headers = _image_cache_probe(url)
+    if headers is None:
+        return cached
+    try:
+        timeout = _image_fetch_timeout(url, timeout, deadline)
+        with _upstream(url):
+            with metrics.span("image_request"):
+                r = await async_http().request("GET", url, headers=headers, timeout=timeout, max_bytes=MAX_IMAGE_BYTES)
+            if cached and r.status == 304:
+                return _image_not_modified(url, cached)
+            r.raise_for_status()
+        open_image(r.body, url).close()
+    except Exception as e:
+        return _image_fetch_failed(url, cached, e)
+    return _image_downloaded(url, r.body, r.headers)
+
+def fetch_image_bytes(url, timeout=10, deadline=None):
+    """
+    Returns the raw (encoded) bytes for url through the disk tier, or None.
+    """
+    entry = _fetch_image_entry(url, timeout=timeout, deadline=deadline)
+    return entry[0] if entry else None
+
+def decode_image(data, digest=None, url=None):
+    """
+    Decodes raw image bytes, reusing the memory LRU (keyed by content digest).
+    The returned image may be shared with other callers: treat it as read-only.
+    """
+    digest = digest or hashlib.sha256(data).hexdigest()
+    img = image_mem_cache.get(digest)
+    if img is not None:
+        return img
+    try:
+        img = open_image(data, url)
+        img.load()
+    except Exception as e:
+        logger.warning(f"Failed to decode image {url or digest}: {e}")
+        if url:
+            image_disk_cache.delete(url)
         return None
+    image_mem_cache.put(digest, img)
+    return img
+
+def download_image(url, timeout=10, deadline=None):
+    """
+    Returns a decoded PIL image for url (or None), going through the disk tier
+    before the network and the memory LRU before decoding.
+    The returned image may be shared with other callers: treat it as read-only.
+    deadline: a Deadline (or seconds) after which the network is not tried.
+    """
+    with metrics.span("download_image"):
+        entry = _fetch_image_entry(url, timeout=timeout, deadline=deadline)
+        if entry is None:
+            return None
+        data, meta = entry
+        return decode_image(data, meta.get("sha256"), url)
+
+async def download_image_async(url, timeout=10, deadline=None):
+    """
+    download_image for async callers. The fetch runs on the loop; decoding
+    (CPU-bound) runs on the default executor so the loop keeps serving I/O.
+    """
+    with metrics.span("download_image"):
+        entry = await _fetch_image_entry_async(url, timeout=timeout, deadline=deadline)
+        if entry is None:
+            return None
+        data, meta = entry
+        return await asyncio.get_running_loop().run_in_executor(None, decode_image, data, meta.get("sha256"), url)
+
+_prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+class RenderAssets:
+    """
+    Raw image bytes a render needs, keyed by URL. Content digests are known
+    without decoding (so a render cache key can be built first); images are
+    decoded on demand through the memory LRU.
+    """
+
+    def __init__(self, entries=None, late=()):
+        self.entries = dict(entries or {})  # url -> (bytes, sha256) or None
+        self.late = frozenset(late)  # urls that missed the request's deadline
+
+    def digest(self, url):
+        entry = self.entries.get(url)
+        return entry[1] if entry else None
+
+    def image(self, url):
+        entry = self.entries.get(url)
+        if not entry:
+            return None
+        return decode_image(entry[0], entry[1], url)
+
+    def open(self, url):
+        """
+        Opened but not yet decoded image for url (so a reduced decode is still possible).
+        """
+        entry = self.entries.get(url)
+        if not entry:
+            return None
+        try:
+            return open_image(entry[0], url)
+        except Exception as e:
+            logger.warning(f"Failed to decode image {url}: {e}")
+            return None
+
+    def cover(self, url, width, height):
+        """
+        url decoded straight to a width x height cover crop, or None.
+        Results are cached by content digest and size: treat them as read-only.
+        """
+        entry = self.entries.get(url)
+        if not entry:
+            return None
+        key = (entry[1], width, height)
+        img = image_mem_cache.get(key)
+        if img is None:
+            src = self.open(url)
+            if src is None:
+                return None
+            try:
+                img = resize_cover_to_fill(src, width, height)
+            except Exception as e:
+                logger.warning(f"Failed to decode image {url}: {e}")
+                return None
+            image_mem_cache.put(key, img)
+        return img
+
+def _asset_entry(entry):
+    return (entry[0], entry[1].get("sha256") or hashlib.sha256(entry[0]).hexdigest()) if entry else None
+
+def _missed_deadline(late, total):
+    for _ in late:
+        _count_image_fetch("deadline")
+    logger.warning(f"{len(late)} of {total} images missed the deadline; drawing placeholders")
+
+def prefetch_assets(urls, timeout=10, deadline=None):
+    """
+    Fetches every distinct url in parallel (one round-trip of wall time)
+    and returns RenderAssets. Empty urls are skipped; failures map to None.
+    With a deadline, images still downloading when it is up (less
+    DEADLINE_RENDER_RESERVE) map to None too; they finish in the background
+    and are in the cache for the next request.
+    """
+    deadline = Deadline.coerce(deadline)
+    unique = list(dict.fromkeys(u for u in urls if u))
+    def fetch(u):
+        return _asset_entry(_fetch_image_entry(u, timeout=timeout, deadline=deadline))
+    with _stage("download"):
+        if len(unique) <= 1 and not deadline.bounded:
+            return RenderAssets({u: fetch(u) for u in unique})
+        # copy_context: log lines from the pool keep the request ID
+        futures = {u: _prefetch_pool.submit(contextvars.copy_context().run, fetch, u) for u in unique}
+        wait = None if not deadline.bounded else max(0.0, deadline.remaining() - DEADLINE_RENDER_RESERVE)
+        done, late = wait_futures(futures.values(), timeout=wait)
+        if late:
+            _missed_deadline(late, len(futures))
+        return RenderAssets({u: f.result() if f in done else None for u, f in futures.items()},
+                            late=[u for u, f in futures.items() if f not in done])
+
+_background_fetches = set()  # late async fetches still filling the cache
+
+async def prefetch_assets_async(urls, timeout=10, deadline=None):
+    """
+    prefetch_assets on the async client: all urls concurrently, in one thread.
+    """
+    deadline = Deadline.coerce(deadline)
+    unique = list(dict.fromkeys(u for u in urls if u))
+    tasks = {u: asyncio.ensure_future(_fetch_image_entry_async(u, timeout=timeout, deadline=deadline)) for u in unique}
+    if not tasks:
+        return RenderAssets()
+    wait = None if not deadline.bounded else max(0.0, deadline.remaining() - DEADLINE_RENDER_RESERVE)
+    done, late = await asyncio.wait(tasks.values(), timeout=wait)
+    if late:
+        _missed_deadline(late, len(tasks))
+        _background_fetches.update(late)
+        for task in late:
+            task.add_done_callback(_background_fetches.discard)
+    return RenderAssets({u: _asset_entry(t.result()) if t in done else None for u, t in tasks.items()},
+                        late=[u for u, t in tasks.items() if t not in done])
+
+def _resample_window(size, box, target):
+    """
+    Integer source region that a LANCZOS resample of box to target reads
+    (box widened by the filter support), clamped to the image size.
+    """
+    margin_x = math.ceil(3 * max((box[2] - box[0]) / target[0], 1.0)) + 1
+    margin_y = math.ceil(3 * max((box[3] - box[1]) / target[1], 1.0)) + 1
+    return (max(0, math.floor(box[0]) - margin_x), max(0, math.floor(box[1]) - margin_y),
+            min(size[0], math.ceil(box[2]) + margin_x), min(size[1], math.ceil(box[3]) + margin_y))
 
 def resize_cover_to_fill(img, target_w, target_h):
     """
     Resize and crop to cover target (similar to CSS cover)
+    For a not-yet-decoded JPEG the decoder is asked for a reduced-size decode
+    (Image.draft) first; the crop happens as part of the resample (box=), and
+    reducing_gap lets Pillow shrink in cheap integer steps before the LANCZOS
+    pass. The result keeps alpha only if the source has it (RGB or RGBA).
     """
     if img is None:
         return None
-    img = img.convert("RGBA")
     src_w, src_h = img.size
     src_ratio = src_w / src_h
     tgt_ratio = target_w / target_h
@@ -195,10 +1082,37 @@ def resize_cover_to_fill(img, target_w, target_h):
     else:
         new_w = target_w
         new_h = int(new_w / src_ratio)
-    img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
     left = (new_w - target_w) // 2
     top = (new_h - target_h) // 2
-    return img.crop((left, top, left + target_w, top + target_h))
+    # Decode at 1/2, 1/4 or 1/8 scale when that still covers new_w x new_h
+    # (no-op for other formats or images that are already loaded)
+    with _stage("decode"):
+        try:
+            img.draft("RGB", (new_w, new_h))
+        except Exception:
+            pass
+        img.load()
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    # The crop box, in (possibly reduced) source pixels
+    sx = img.size[0] / new_w
+    sy = img.size[1] / new_h
+    box = (left * sx, top * sy, (left + target_w) * sx, (top + target_h) * sy)
+    if img.mode not in ("RGB", "L"):
+        # Converting (palette, CMYK, ...) or resampling with alpha (Pillow
+        # premultiplies into a copy first) would copy the whole source: cut it
+        # down to the pixels the resample reads before either happens.
+        window = _resample_window(img.size, box, (target_w, target_h))
+        if window != (0, 0) + img.size:
+            img = img.crop(window)
+            box = (box[0] - window[0], box[1] - window[1], box[2] - window[0], box[3] - window[1])
+        if img.mode != "RGBA":
+            with _stage("decode"):
+                img = img.convert("RGBA" if has_alpha else "RGB")
+    with _stage("resize"):
+        img = img.resize((target_w, target_h), Image.Resampling.LANCZOS, box=box, reducing_gap=3.0)
+        if img.mode == "L":
+            img = img.convert("RGB")
+    return img
 
 def rounded_rectangle_mask(size, radius):
     w, h = size
@@ -207,241 +1121,945 @@ def rounded_rectangle_mask(size, radius):
     draw.rounded_rectangle((0,0,w,h), radius=radius, fill=255)
     return mask
 
-# ---------- Thumbnail generator ----------
-def generate_thumbnail(anime: dict, prefer_local_bg=False):
+# ---------- Layout templates ----------
+# A template is data: a background, then elements in drawing order. Coordinates
+# are canvas pixels; x or y may also be [name, offset], offset pixels past the
+# right (x) or bottom (y) edge of an earlier named element, so content can
+# follow a title of one or two lines. Fonts are FONT_SPECS names or
+# [style, size]; colors are RGB.
+#   box    "box": [x, y, w, h], "radius", "color"
+#   text   "at": [x, y], "font", "color", and "text" (fixed) or "field" (see
+#          layout_fields); "max_width" wraps, "max_lines" caps, "leading"
+#          (times the font size) or "line_gap" (pixels) spaces the lines
+#   row    "at", "label", "label_font", "field", "font", "color", "gap":
+#          a fixed label followed by a value
+#   pills  "at", "field" (a list), "max", "height", "padding", "gap", "font",
+#          "color", "fill": rounded labels side by side
+#   image  "box", "fields": image fields, the first one available is shown,
+#          "placeholder": {"fill", "text", "font", "color"} otherwise
+# Any element may have a "name", and "under": [box names] to stay beneath
+# those panels where it runs into them. Fixed boxes and texts go into the
+# plan's static layer, drawn before everything else; anchored to content,
+# they are pasted in order instead.
+CLASSIC_TEMPLATE = {
+    "size": [CANVAS_WIDTH, CANVAS_HEIGHT],
+    "background": {"image": "poster", "fill": BG_DARK, "overlay": [0, 0, 0, 120]},
+    "elements": [
+        {"type": "text", "text": "ANIMWORLDZONE", "at": [40, 28], "font": "LOGO_FONT", "color": TEXT_WHITE},
+        {"type": "text", "name": "team", "text": "TEAM", "at": [CANVAS_WIDTH - 260, 30],
+         "font": "INFO_LABEL_FONT", "color": TEXT_GREY},
+        {"type": "text", "text": "Animworldzone", "at": [["team", 8], 26], "font": "CHAR_NAME_FONT", "color": ACCENT_ORANGE},
+        {"type": "box", "name": "main_card", "box": list(MAIN_CARD[:4]), "radius": MAIN_CARD[4], "color": CARD_BG},
+        {"type": "box", "name": "character_card", "box": list(CHAR_CARD[:4]), "radius": CHAR_CARD[4], "color": CARD_BG},
+        {"type": "box", "name": "synopsis_card", "box": list(SYN_CARD[:4]), "radius": SYN_CARD[4], "color": CARD_BG},
+        {"type": "text", "text": "SYNOPSIS", "at": [SYN_CARD[0] + 18, SYN_CARD[1] + 18],
+         "font": "OVERVIEW_TITLE_FONT", "color": TEXT_WHITE},
+        # many genres run under the character card
+        {"type": "pills", "field": "genres", "at": [50, 120], "max": 5, "height": 36, "padding": 18, "gap": 14,
+         "font": "GENRE_FONT", "color": GENRE_TEXT, "fill": GENRE_BG, "under": ["character_card"]},
+        {"type": "text", "name": "title", "field": "title", "at": [MAIN_CARD[0] + 36, MAIN_CARD[1] + 36],
+         "max_width": MAIN_CARD[2] - 72, "max_lines": 2, "leading": 0.75, "font": "TITLE_FONT", "color": TEXT_WHITE},
+        {"type": "text", "field": "season", "at": [MAIN_CARD[0] + 36, ["title", 10]],
+         "font": "SUBTITLE_FONT", "color": TEXT_WHITE},
+        # the info box follows the title, inside the main card
+        {"type": "box", "box": [MAIN_CARD[0] + 36, ["title", 120], INFO_BOX[0], INFO_BOX[1]], "radius": INFO_BOX[2],
+         "color": CARD_BG},
+        {"type": "row", "label": "STUDIO : ", "field": "studio", "at": [MAIN_CARD[0] + 46, ["title", 130]],
+         "label_font": "INFO_LABEL_FONT", "font": "INFO_VALUE_FONT", "color": TEXT_WHITE, "gap": 8},
+        {"type": "row", "label": "STATUS : ", "field": "status", "at": [MAIN_CARD[0] + 46, ["title", 162]],
+         "label_font": "INFO_LABEL_FONT", "font": "INFO_VALUE_FONT", "color": TEXT_WHITE, "gap": 8},
+        {"type": "row", "label": "RATING : ", "field": "rating", "at": [MAIN_CARD[0] + 46, ["title", 194]],
+         "label_font": "INFO_LABEL_FONT", "font": "INFO_VALUE_FONT", "color": TEXT_WHITE, "gap": 8},
+        {"type": "image", "fields": ["character_image", "poster"],
+         "box": [CHAR_CARD[0] + 10, CHAR_CARD[1] + 10, CHAR_IMAGE_SIZE[0], CHAR_IMAGE_SIZE[1]],
+         "placeholder": {"fill": PLACEHOLDER_BG, "text": "NO IMAGE", "font": "CHAR_NAME_FONT", "color": TEXT_WHITE}},
+        {"type": "text", "field": "character_name", "at": [CHAR_CARD[0] + 20, CHAR_CARD[1] + 140],
+         "font": "CHAR_NAME_FONT", "color": TEXT_WHITE},
+        # the last bio line can reach into the synopsis card, which covers it
+        {"type": "text", "field": "character_bio", "at": [CHAR_CARD[0] + 20, CHAR_CARD[1] + 180],
+         "max_width": CHAR_CARD[2] - 40, "max_lines": 3, "line_gap": 2, "font": "CHAR_DESC_FONT", "color": TEXT_GREY,
+         "under": ["synopsis_card"]},
+        {"type": "text", "field": "synopsis", "at": [SYN_CARD[0] + 18, SYN_CARD[1] + 60],
+         "max_width": SYN_CARD[2] - 36, "max_lines": 8, "line_gap": 4, "font": "CHAR_DESC_FONT", "color": TEXT_GREY},
+    ],
+}
+
+TEMPLATES = {"classic": CLASSIC_TEMPLATE}
+
+def _excerpt(html, words):
     """
-    anime: dict with keys similar to AniList GraphQL result:
-      - title: {'romaji':..., 'english':...}
-      - coverImage: {'extraLarge':...}
-      - averageScore
-      - genres
-      - description
-      - status, season, seasonYear
-      - studios: {'nodes':[{'name':...}]}
-      - characters: {'nodes':[{'name':{'full':...}, 'description':..., 'image':{'large':...}}]}
-    Returns BytesIO PNG
+    Text of an AniList HTML description, cut to `words` words ("..." if cut).
     """
-    # Extract fields safely
-    title_raw = (anime.get("title", {}) or {}).get("english") or (anime.get("title", {}) or {}).get("romaji") or "UNKNOWN"
-    title = str(title_raw).upper()
-    poster_url = (anime.get("coverImage") or {}).get("extraLarge")
-    score = anime.get("averageScore", 0) or 0
-    genres = anime.get("genres", []) or []
-    status = (anime.get("status") or "UNKNOWN")
-    studios = (anime.get("studios", {}) or {}).get("nodes", []) or []
-    studio_name = studios[0]["name"] if studios else "Unknown Studio"
-    desc = anime.get("description") or "No description available"
-    # strip basic html tags that AniList uses
-    desc = re.sub(r"<[^>]+>", "", desc)
-    desc = " ".join(desc.split())
-    # Keep a shorter excerpt
-    desc_excerpt = " ".join(desc.split()[:60])
-    if len(desc.split()) > 60:
-        desc_excerpt += "..."
-
-    # Character extraction
-    characters = (anime.get("characters", {}) or {}).get("nodes", []) or []
+    text = re.sub(r"<[^>]+>", "", html).split()
+    return " ".join(text[:words]) + ("..." if len(text) > words else "")
+
+def layout_fields(anime):
+    """
+    The values a template can show, by field name, from an AniList Media dict.
+    Texts are ready to draw; "poster" and "character_image" are image URLs.
+    """
+    title = anime.get("title") or {}
+    studios = (anime.get("studios") or {}).get("nodes") or []
+    characters = (anime.get("characters") or {}).get("nodes") or []
+    score = anime.get("averageScore") or 0
+    season, year = anime.get("season") or "", anime.get("seasonYear") or ""
+    poster_url, char_img_url = thumbnail_image_urls(anime)
+    fields = {
+        "title": str(title.get("english") or title.get("romaji") or "UNKNOWN").upper(),
+        "season": f"{season.upper()} {year}" if season and year else "",
+        "studio": ((studios[0]["name"] if studios else "Unknown Studio") or "UNKNOWN").upper(),
+        "status": str(anime.get("status") or "UNKNOWN").upper(),
+        "rating": f"{(score / 10):.1f}/10" if score else "N/A",
+        "genres": [str(g).upper() for g in anime.get("genres") or []],
+        "synopsis": _excerpt(anime.get("description") or "No description available", 60),
+        "character_name": "MAIN CHARACTER",
+        "character_bio": "No character info available.",
+        "poster": poster_url,
+        "character_image": char_img_url,
+    }
     if characters:
         char = characters[0]
-        char_name = (char.get("name", {}) or {}).get("full", "MAIN CHARACTER").upper()
-        char_desc_raw = char.get("description", "No character description available")
-        char_desc_raw = re.sub(r"<[^>]+>", "", char_desc_raw)
-        char_desc_raw = " ".join(char_desc_raw.split())
-        char_desc_excerpt = " ".join(char_desc_raw.split()[:40])
-        if len(char_desc_raw.split()) > 40:
-            char_desc_excerpt += "..."
-        char_img_url = (char.get("image", {}) or {}).get("large")
-    else:
-        char_name = "MAIN CHARACTER"
-        char_desc_excerpt = "No character info available."
-        char_img_url = None
-
-    # Background: try poster_url first unless prefer_local_bg True
-    bg_img = None
-    if poster_url and not prefer_local_bg:
-        bg_img = download_image(poster_url)
-    if bg_img is None:
-        # try local test
-        if os.path.isfile(LOCAL_TEST_BG):
+        bio = char.get("description")
+        fields["character_name"] = ((char.get("name") or {}).get("full") or "MAIN CHARACTER").upper()
+        fields["character_bio"] = _excerpt("No character description available" if bio is None else bio, 40)
+    return fields
+
+def _text_mask(size, xy, text, font):
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).text(xy, text, font=font, fill=255)
+    return mask
+
+def _at(value, ends, axis):
+    """
+    A plan coordinate: a number, or (name, offset) past the right (axis 0) or
+    bottom (axis 1) edge the named element got in this render.
+    """
+    if isinstance(value, tuple):
+        return ends[value[0]][2 + axis] + value[1]
+    return value
+
+@contextlib.contextmanager
+def _kept(canvas, boxes, ends):
+    """
+    Restores the named boxes after the block: what was drawn stays under them.
+    """
+    saved = [(ends[name][:2], canvas.crop(ends[name])) for name in boxes]
+    yield
+    for xy, patch in saved:
+        canvas.paste(patch, xy)
+
+class _BoxOp(namedtuple("_BoxOp", "name x y patch mask")):
+    def run(self, canvas, draw, fields, assets, ends):
+        x, y = _at(self.x, ends, 0), _at(self.y, ends, 1)
+        canvas.paste(self.patch, (x, y), self.mask)
+        if self.name:
+            ends[self.name] = (x, y, x + self.patch.width, y + self.patch.height)
+
+class _TextOp(namedtuple("_TextOp", "name x y text field font color max_width max_lines step under")):
+    def run(self, canvas, draw, fields, assets, ends):
+        x, y = _at(self.x, ends, 0), _at(self.y, ends, 1)
+        value = self.text if self.field is None else fields.get(self.field)
+        lines = []
+        if value:
+            lines = wrap_text_to_width(str(value), self.font, self.max_width) if self.max_width else [str(value)]
+        with _kept(canvas, self.under, ends):
+            for i, line in enumerate(lines[:self.max_lines]):
+                draw.text((x, y + i * self.step), line, font=self.font, fill=self.color)
+        if self.name:
+            n = len(lines[:self.max_lines])
+            # one line takes the font size, several take their line steps
+            bottom = y + (self.font.size if n == 1 else self.step * n)
+            right = x + (self.max_width or (text_size(draw, lines[0], self.font)[0] if lines else 0))
+            ends[self.name] = (x, y, right, bottom)
+
+class _RowOp(namedtuple("_RowOp", "x y label label_font label_width field font color gap")):
+    # labels and values (studios, statuses, ratings) repeat: pasted as sprites
+    def run(self, canvas, draw, fields, assets, ends):
+        x, y = _at(self.x, ends, 0), _at(self.y, ends, 1)
+        sprites.draw_text(canvas, (x, y), self.label, self.label_font, self.color)
+        value = fields.get(self.field)
+        sprites.draw_text(canvas, (x + self.label_width + self.gap, y), "" if value is None else str(value),
+                          self.font, self.color)
+
+class _PillsOp(namedtuple("_PillsOp", "name x y field max height padding gap font color fill under")):
+    def run(self, canvas, draw, fields, assets, ends):
+        x0, y = _at(self.x, ends, 0), _at(self.y, ends, 1)
+        x = x0
+        with _kept(canvas, self.under, ends):
+            for text in (fields.get(self.field) or [])[:self.max]:
+                x += sprites.draw_pill(canvas, (x, y), text, self.font, self.color, self.fill, self.height,
+                                       self.padding) + self.gap
+        if self.name:
+            ends[self.name] = (x0, y, max(x0, x - self.gap), y + self.height)
+
+class _ImageOp(namedtuple("_ImageOp", "name x y size fields placeholder")):
+    def run(self, canvas, draw, fields, assets, ends):
+        x, y = _at(self.x, ends, 0), _at(self.y, ends, 1)
+        img = None
+        for field in self.fields:
+            url = fields.get(field)
+            if url:
+                img = assets.cover(url, *self.size)
+                if img is not None:
+                    break
+        img = img or self.placeholder
+        if img is not None:
+            canvas.paste(img, (x, y), img if img.mode == "RGBA" else None)
+        if self.name:
+            ends[self.name] = (x, y, x + self.size[0], y + self.size[1])
+
+class RenderPlan(namedtuple("RenderPlan", "key size background layer_color layer_alpha ends ops")):
+    """
+    A compiled template (compile_template): fonts resolved, label widths
+    measured, masks built and the fixed elements composited into one static
+    layer. Immutable, so one plan serves every thread; render() only does
+    the per-anime work.
+    """
+
+    def render(self, anime, assets, prefer_local_bg=False):
+        """
+        The RGB canvas for anime, with images from assets (RenderAssets).
+        """
+        fields = layout_fields(anime)
+        canvas = self._background(fields, assets, prefer_local_bg)
+        canvas.paste(self.layer_color, (0, 0), self.layer_alpha)
+        draw = ImageDraw.Draw(canvas)
+        ends = dict(self.ends)
+        for op in self.ops:
+            op.run(canvas, draw, fields, assets, ends)
+        return canvas
+
+    def _background(self, fields, assets, prefer_local_bg):
+        field, fill = self.background
+        width, height = self.size
+        bg_img = None
+        url = fields.get(field) if field else None
+        if url and not prefer_local_bg:
+            bg_img = assets.cover(url, width, height)
+        if bg_img is None and os.path.isfile(LOCAL_TEST_BG):
             try:
                 bg_img = Image.open(LOCAL_TEST_BG)
             except Exception:
                 bg_img = None
-    if bg_img is None:
-        bg_img = Image.new("RGB", (CANVAS_WIDTH, CANVAS_HEIGHT), BG_DARK)
-    # Resize + overlay
-    bg_img = resize_cover_to_fill(bg_img, CANVAS_WIDTH, CANVAS_HEIGHT).convert("RGBA")
-    overlay = Image.new("RGBA", (CANVAS_WIDTH, CANVAS_HEIGHT), (0,0,0,120))
-    canvas = Image.alpha_composite(bg_img, overlay)
-
-    draw = ImageDraw.Draw(canvas)
-
-    # --- Logo top-left ---
-    logo_x = 40
-    logo_y = 28
-    draw.text((logo_x, logo_y), "ANIMWORLDZONE", font=LOGO_FONT, fill=TEXT_WHITE)  # Fixed and replaced
-
-    # --- Team text top-right ---
-    team_text = "TEAM"
-    team_name = "Animworldzone"  # Updated to match
-    t_w, t_h = text_size(draw, team_text, INFO_LABEL_FONT)
-    draw.text((CANVAS_WIDTH - 260, 30), team_text, font=INFO_LABEL_FONT, fill=TEXT_GREY)
-    draw.text((CANVAS_WIDTH - 260 + t_w + 8, 26), team_name, font=CHAR_NAME_FONT, fill=ACCENT_ORANGE)
-
-    # --- Genre pills ---
-    genre_start_x = 50
-    genre_start_y = 120
-    pill_gap = 14
-    pill_height = 36  # Made smaller
-    max_genres = 5
-    for g in (genres or [])[:max_genres]:
-        text_g = str(g).upper()
-        tw, th = text_size(draw, text_g, GENRE_FONT)
-        pill_w = tw + 36
-        # pill box
-        pill_bbox = (genre_start_x, genre_start_y, genre_start_x + pill_w, genre_start_y + pill_height)
-        draw.rounded_rectangle(pill_bbox, radius=pill_height//2, fill=GENRE_BG)
-        draw.text((genre_start_x + 18, genre_start_y + (pill_height - th)//2), text_g, font=GENRE_FONT, fill=GENRE_TEXT)
-        genre_start_x += pill_w + pill_gap
-
-    # --- Main left card (transparent) ---
-    card_x = 50
-    card_y = 190
-    card_w = 750
-    card_h = 420
-    # semi-transparent card
-    card_layer = Image.new("RGBA", (card_w, card_h), (CARD_BG[0], CARD_BG[1], CARD_BG[2], CARD_ALPHA))
-    # rounded mask
-    mask = rounded_rectangle_mask((card_w, card_h), radius=28)
-    canvas.paste(card_layer, (card_x, card_y), mask)
-
-    # Title inside card (big, but smaller now)
-    inner_draw = ImageDraw.Draw(canvas)
-    title_x = card_x + 36
-    title_y = card_y + 36
-    # Wrap the title to max 2 lines
-    max_title_w = card_w - 72
-    title_lines = wrap_text_to_width(title, TITLE_FONT, max_title_w, draw)
-    # If more than 2 lines, combine/trim
-    if len(title_lines) > 2:
-        # join until fits 2 lines
-        joined = " ".join(title_lines)
-        title_lines = wrap_text_to_width(joined, TITLE_FONT, max_title_w, draw)[:2]
-    for i, line in enumerate(title_lines[:2]):
-        # reduce y-gap a bit for more compact look
-        y_off = title_y + i * int(TITLE_FONT.size * 0.75)
-        inner_draw.text((title_x, y_off), line, font=TITLE_FONT, fill=TEXT_WHITE)
-
-    # Subtitle: season/year or "SEASON X"
-    subtitle_y = title_y + (TITLE_FONT.size if len(title_lines)==1 else int(TITLE_FONT.size * 0.75)*len(title_lines)) + 10
-    season = anime.get("season") or ""
-    seasonYear = anime.get("seasonYear") or ""
-    if season and seasonYear:
-        subtitle_text = f"{season.upper()} {seasonYear}"
-        inner_draw.text((title_x, subtitle_y), subtitle_text, font=SUBTITLE_FONT, fill=TEXT_WHITE)
-
-    # --- Separate small transparent box for information ---
-    info_box_x = card_x + 36
-    info_box_y = subtitle_y + 110
-    info_box_w = 400
-    info_box_h = 100  # Slightly smaller
-    info_layer = Image.new("RGBA", (info_box_w, info_box_h), (CARD_BG[0], CARD_BG[1], CARD_BG[2], CARD_ALPHA))
-    info_mask = rounded_rectangle_mask((info_box_w, info_box_h), radius=12)
-    canvas.paste(info_layer, (info_box_x, info_box_y), info_mask)
-
-    # Information lines inside the info box (smaller equal sizes)
-    info_inner_y = info_box_y + 10
-    label_gap = 8
-    def draw_info(label, value, at_y):
-        inner_draw.text((info_box_x + 10, at_y), label, font=INFO_LABEL_FONT, fill=TEXT_WHITE)
-        try:
-            lw = inner_draw.textlength(label, font=INFO_LABEL_FONT)
-        except Exception:
-            lw = text_size(inner_draw, label, INFO_LABEL_FONT)[0]
-        inner_draw.text((info_box_x + 10 + lw + label_gap, at_y), value, font=INFO_VALUE_FONT, fill=TEXT_WHITE)
-
-    draw_info("STUDIO : ", (studio_name or "UNKNOWN").upper(), info_inner_y)
-    draw_info("STATUS : ", (status or "UNKNOWN").upper(), info_inner_y + 32)  # Adjusted spacing for smaller font
-    rating_display = f"{(score/10):.1f}/10" if score else "N/A"
-    draw_info("RATING : ", rating_display, info_inner_y + 64)
-
-    # --- Right character card (transparent, landscape, with bio) ---
-    char_card_x = 850  # Slightly adjusted position
-    char_card_y = 100
-    char_card_w = 380  # Wider for landscape
-    char_card_h = 220
-    char_card_layer = Image.new("RGBA", (char_card_w, char_card_h), (CARD_BG[0], CARD_BG[1], CARD_BG[2], CARD_ALPHA))
-    char_mask = rounded_rectangle_mask((char_card_w, char_card_h), radius=18)
-    canvas.paste(char_card_layer, (char_card_x, char_card_y), char_mask)
-
-    # Character image box inside char card (landscape crop)
-    char_img_w = 360
-    char_img_h = 120
-    char_img_x = char_card_x + 10
-    char_img_y = char_card_y + 10
-    char_img = None
-    # Try char_img_url first, then poster_url
-    urls_to_try = [char_img_url, poster_url]
-    for url in urls_to_try:
-        if url:
-            raw = download_image(url)
-            if raw:
-                char_img = resize_cover_to_fill(raw, char_img_w, char_img_h)
-                break
-    if char_img is None:
-        # placeholder fill
-        char_img = Image.new("RGBA", (char_img_w, char_img_h), PLACEHOLDER_BG)
-        dd = ImageDraw.Draw(char_img)
-        s = "NO IMAGE"
-        tw, th = text_size(dd, s, CHAR_NAME_FONT)
-        dd.text(((char_img_w-tw)//2, (char_img_h-th)//2), s, font=CHAR_NAME_FONT, fill=TEXT_WHITE)
-
-    # Paste char image
-    canvas.paste(char_img, (char_img_x, char_img_y), char_img if char_img.mode=="RGBA" else None)
-
-    # Character name below image
-    char_name_y = char_img_y + char_img_h + 10
-    inner_draw.text((char_card_x + 20, char_name_y), char_name, font=CHAR_NAME_FONT, fill=TEXT_WHITE)
-
-    # Character bio below name
-    char_bio_y = char_name_y + 40
-    char_bio_max_w = char_card_w - 40
-    char_desc_lines = wrap_text_to_width(char_desc_excerpt, CHAR_DESC_FONT, char_bio_max_w, inner_draw)
-    line_h = CHAR_DESC_FONT.size + 2
-    for idx, ln in enumerate(char_desc_lines[:3]):  # Limit lines
-        inner_draw.text((char_card_x + 20, char_bio_y + idx * line_h), ln, font=CHAR_DESC_FONT, fill=TEXT_GREY)
-
-    # --- Synopsis card (bottom-right, transparent) ---
-    syn_x = 850
-    syn_y = 340  # Adjusted to below char card
-    syn_w = 380
-    syn_h = 300  # Slightly taller for more text
-    syn_layer = Image.new("RGBA", (syn_w, syn_h), (CARD_BG[0], CARD_BG[1], CARD_BG[2], CARD_ALPHA))
-    syn_mask = rounded_rectangle_mask((syn_w, syn_h), radius=18)
-    canvas.paste(syn_layer, (syn_x, syn_y), syn_mask)
-    # Title "SYNOPSIS"
-    inner_draw.text((syn_x + 18, syn_y + 18), "SYNOPSIS", font=OVERVIEW_TITLE_FONT, fill=TEXT_WHITE)
-    # Description wrap
-    desc_max_w = syn_w - 36
-    desc_lines = wrap_text_to_width(desc_excerpt, CHAR_DESC_FONT, desc_max_w, inner_draw)
-    desc_start_y = syn_y + 60  # Adjusted
-    line_h = CHAR_DESC_FONT.size + 4 if hasattr(CHAR_DESC_FONT, "size") else 20
-    for idx, ln in enumerate(desc_lines[:8]):  # More lines
-        inner_draw.text((syn_x + 18, desc_start_y + idx * (line_h)), ln, font=CHAR_DESC_FONT, fill=TEXT_GREY)
-
-    # Finalize: convert to RGB PNG BytesIO
-    output = BytesIO()
-    canvas.convert("RGB").save(output, format="PNG", quality=95)
-    output.seek(0)
-    return output
+        if bg_img is None:
+            return Image.new("RGB", self.size, fill)
+        if bg_img.size != self.size:
+            bg_img = resize_cover_to_fill(bg_img, width, height)
+        # convert() also copies, so the cached cover is never drawn on
+        return bg_img.convert("RGB")
 
-# ---------- AniList helper ----------
-ANILIST_QUERY = """
-query ($search: String) {
-  Media(search: $search, type: ANIME) {
-    title { romaji english }
-    coverImage { extraLarge large medium color }
-    averageScore
+    def image_slots(self):
+        """
+        (image fields, size) for every image the plan draws, background first.
+        """
+        slots = [((self.background[0],), self.size)] if self.background[0] else []
+        return slots + [(op.fields, op.size) for op in self.ops if isinstance(op, _ImageOp)]
+
+def _template_font(spec):
+    if isinstance(spec, str):
+        if spec not in FONT_SPECS:
+            raise ValueError(f"unknown font {spec!r} (use a FONT_SPECS name or [style, size])")
+        return get_font(spec)
+    style, size = spec
+    return font_manager.pick_font(style, int(size))
+
+def _template_color(value):
+    color = tuple(int(c) for c in value)
+    if len(color) != 3:
+        raise ValueError(f"color {value!r} is not RGB")
+    return color
+
+def compile_template(spec, key=None):
+    """
+    Compiles a template spec (see CLASSIC_TEMPLATE) into a RenderPlan.
+    Raises ValueError for a bad spec.
+    """
+    size = tuple(int(v) for v in spec.get("size") or (CANVAS_WIDTH, CANVAS_HEIGHT))
+    background = spec.get("background") or {}
+    layer = Image.new("RGBA", size, tuple(background.get("overlay") or (0, 0, 0, 0)))
+    scratch = ImageDraw.Draw(Image.new("L", (1, 1)))
+    ends = {}        # fixed elements: name -> (x0, y0, x1, y1)
+    dynamic = set()  # names whose edges are only known while rendering
+    boxes = set()
+    ops = []
+
+    def add(color, mask, at=(0, 0)):
+        patch = Image.new("RGBA", mask.size, color)
+        patch.putalpha(mask)
+        layer.alpha_composite(patch, dest=at)
+
+    def coord(value, axis):
+        if not isinstance(value, (list, tuple)):
+            return value
+        name, offset = value
+        if name in ends:
+            return ends[name][2 + axis] + offset
+        if name in dynamic:
+            return (name, offset)
+        raise ValueError(f"anchor {name!r} is not an earlier named element")
+
+    for i, el in enumerate(spec.get("elements") or ()):
+        kind = el.get("type")
+        try:
+            name = el.get("name")
+            under = tuple(el.get("under") or ())
+            for box in under:
+                if box not in boxes:
+                    raise ValueError(f"'under' names {box!r}, not an earlier named box")
+            if kind == "box":
+                x, y, w, h = el["box"]
+                x, y = coord(x, 0), coord(y, 1)
+                color = _template_color(el.get("color", (0, 0, 0)))
+                mask = rounded_rectangle_mask((w, h), el.get("radius", 0))
+                if isinstance(x, tuple) or isinstance(y, tuple):
+                    ops.append(_BoxOp(name, x, y, Image.new("RGB", (w, h), color), mask))
+                else:
+                    add(color, mask, (x, y))
+                    if name:
+                        ends[name] = (x, y, x + w, y + h)
+                if name:
+                    boxes.add(name)
+            elif kind == "text":
+                font = _template_font(el["font"])
+                color = _template_color(el.get("color", TEXT_WHITE))
+                x, y = coord(el["at"][0], 0), coord(el["at"][1], 1)
+                if "field" not in el and not (isinstance(x, tuple) or isinstance(y, tuple)):
+                    add(color, _text_mask(size, (x, y), el["text"], font))
+                    if name:
+                        ends[name] = (x, y, x + text_size(scratch, el["text"], font)[0], y + font.size)
+                    continue
+                step = int(font.size * el["leading"]) if "leading" in el else font.size + el.get("line_gap", 0)
+                ops.append(_TextOp(name, x, y, el.get("text"), el.get("field"), font, color, el.get("max_width"),
+                                   el.get("max_lines"), step, under))
+            elif kind == "row":
+                label_font = _template_font(el.get("label_font", el["font"]))
+                ops.append(_RowOp(coord(el["at"][0], 0), coord(el["at"][1], 1), el["label"], label_font,
+                                  textlayout.text_length(label_font, el["label"]), el["field"],
+                                  _template_font(el["font"]), _template_color(el.get("color", TEXT_WHITE)),
+                                  el.get("gap", 0)))
+            elif kind == "pills":
+                ops.append(_PillsOp(name, coord(el["at"][0], 0), coord(el["at"][1], 1), el["field"], el.get("max", 5),
+                                    el["height"], el.get("padding", 0), el.get("gap", 0), _template_font(el["font"]),
+                                    _template_color(el["color"]), _template_color(el["fill"]), under))
+            elif kind == "image":
+                x, y, w, h = el["box"]
+                placeholder = None
+                if el.get("placeholder"):
+                    p = el["placeholder"]
+                    placeholder = Image.new("RGBA", (w, h), _template_color(p.get("fill", (0, 0, 0))))
+                    if p.get("text"):
+                        pd = ImageDraw.Draw(placeholder)
+                        p_font = _template_font(p["font"])
+                        tw, th = text_size(pd, p["text"], p_font)
+                        pd.text(((w - tw) // 2, (h - th) // 2), p["text"], font=p_font,
+                                fill=_template_color(p.get("color", TEXT_WHITE)))
+                ops.append(_ImageOp(name, coord(x, 0), coord(y, 1), (w, h), tuple(el["fields"]), placeholder))
+            else:
+                raise ValueError("unknown element type")
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"template element {i} ({kind}): {e}") from None
+        if name and name not in ends:
+            dynamic.add(name)
+
+    return RenderPlan(key, size, (background.get("image"), _template_color(background.get("fill", BG_DARK))),
+                      layer.convert("RGB"), layer.getchannel("A"), tuple(ends.items()), tuple(ops))
+
+def template_spec(template=None):
+    """
+    The spec for a template: a TEMPLATES name, the path of a JSON template
+    file, or a spec dict itself. THUMB_TEMPLATE if None. Raises ValueError.
+    """
+    template = THUMB_TEMPLATE if template is None else template
+    if isinstance(template, dict):
+        return template
+    spec = TEMPLATES.get(template)
+    if spec is None and str(template).endswith(".json") and os.path.isfile(template):
+        with open(template, "r", encoding="utf-8") as f:
+            spec = TEMPLATES[template] = json.load(f)
+    if spec is None:
+        raise ValueError(f"Unknown template {template!r} (choose from {', '.join(TEMPLATES)} or a .json file)")
+    return spec
+
+def template_key(spec):
+    """
+    Hash of a template spec; identifies its render plan and its renders.
+    """
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, separators=(",", ":")).encode()).hexdigest()[:16]
+
+_render_plans = LRUCache(max_entries=RENDER_PLAN_CACHE_SIZE, name="render-plans")
+
+def render_plan(template=None):
+    """
+    The RenderPlan for a template (see template_spec), compiled on first use
+    and cached by template hash.
+    """
+    spec = template_spec(template)
+    key = template_key(spec)
+    plan = _render_plans.get(key)
+    if plan is None:
+        plan = compile_template(spec, key)
+        _render_plans.put(key, plan)
+    return plan
+
+def register_template(name, spec):
+    """
+    Adds (or replaces) a named template; the spec is compiled first, so a bad
+    one raises ValueError here rather than at render time.
+    """
+    render_plan(spec)
+    TEMPLATES[name] = spec
+
+# ---------- Output variants ----------
+def output_variant(spec, encoder=None):
+    """
+    Normalizes a variant: a Variant (or tuple), a VARIANT_PRESETS name or
+    "<w>x<h>", optionally followed by ":<encoder>" ("square:webp",
+    "640x360:jpeg"). Variants without an encoder get `encoder`
+    (DEFAULT_ENCODER if None). Raises ValueError for bad specs.
+    """
+    if isinstance(spec, str):
+        name, _, spec_encoder = spec.partition(":")
+        variant = VARIANT_PRESETS.get(name)
+        if variant is None:
+            m = re.fullmatch(r"(\d+)x(\d+)", name)
+            if not m:
+                raise ValueError(f"Unknown variant {spec!r} (use {', '.join(VARIANT_PRESETS)} or <w>x<h>)")
+            variant = Variant(int(m.group(1)), int(m.group(2)))
+        variant = variant._replace(encoder=spec_encoder or variant.encoder)
+    else:
+        variant = Variant(*spec)
+    width, height, crop, variant_encoder = variant
+    if not (0 < width <= MAX_VARIANT_SIDE and 0 < height <= MAX_VARIANT_SIDE):
+        raise ValueError(f"Variant size {width}x{height} out of range")
+    if crop is not None:
+        crop = tuple(int(c) for c in crop)
+        x, y, w, h = crop
+        if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > CANVAS_WIDTH or y + h > CANVAS_HEIGHT:
+            raise ValueError(f"Variant crop {crop} is not inside the {CANVAS_WIDTH}x{CANVAS_HEIGHT} canvas")
+    variant_encoder = variant_encoder or encoder or DEFAULT_ENCODER
+    encoder_profile(variant_encoder)
+    return Variant(int(width), int(height), crop, variant_encoder)
+
+def _is_full_canvas(variant):
+    return variant.crop is None and (variant.width, variant.height) == (CANVAS_WIDTH, CANVAS_HEIGHT)
+
+def variant_image(canvas, variant):
+    """
+    The part of the canvas `variant` shows, at its size (the canvas itself
+    for the full-size variant).
+    """
+    if _is_full_canvas(variant):
+        return canvas
+    x, y, w, h = variant.crop or (0, 0) + canvas.size
+    # center the largest box with the output's shape inside the crop
+    if w * variant.height > h * variant.width:
+        fit_w = h * variant.width / variant.height
+        box = (x + (w - fit_w) / 2, y, x + (w + fit_w) / 2, y + h)
+    else:
+        fit_h = w * variant.height / variant.width
+        box = (x, y + (h - fit_h) / 2, x + w, y + (h + fit_h) / 2)
+    with _stage("resize"):
+        return canvas.resize((variant.width, variant.height), Image.Resampling.LANCZOS, box=box, reducing_gap=3.0)
+
+# ---------- Render cache ----------
+def _font_fingerprint():
+    """
+    Identifies the font set used by the layout (path, size and file stamp of each font).
+    """
+    parts = []
+    for name, (style, size) in FONT_SPECS.items():
+        path = font_manager.best_match(style)  # no need to load the font itself
+        try:
+            st = os.stat(path) if path else None
+            stamp = f"{st.st_size}:{int(st.st_mtime)}" if st else "-"
+        except OSError:
+            stamp = "-"
+        parts.append(f"{path or 'default'}@{size}:{stamp}")
+    return "|".join(parts)
+
+def thumbnail_image_urls(anime):
+    """
+    Returns (poster_url, char_img_url) used by the layout.
+    """
+    poster_url = (anime.get("coverImage") or {}).get("extraLarge")
+    characters = (anime.get("characters", {}) or {}).get("nodes", []) or []
+    char_img_url = ((characters[0].get("image", {}) or {}).get("large")) if characters else None
+    return poster_url, char_img_url
+
+def thumbnail_assets(anime, timeout=10, deadline=None):
+    """
+    Prefetches every image the layout may need in one parallel round-trip.
+    The poster doubles as the character-card fallback, so it is fetched once.
+    """
+    return prefetch_assets(thumbnail_image_urls(anime), timeout=timeout, deadline=deadline)
+
+async def thumbnail_assets_async(anime, timeout=10, deadline=None):
+    return await prefetch_assets_async(thumbnail_image_urls(anime), timeout=timeout, deadline=deadline)
+
+# ---------- Output encoders ----------
+_encode_lock = threading.Lock()
+_encode_stats = {}  # profile -> [count, seconds, bytes]
+
+def encoder_profile(name):
+    """
+    Returns (format, save options, MIME type, extension) for an encoder profile.
+    """
+    try:
+        return ENCODER_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown encoder {name!r} (choose from {', '.join(ENCODER_PROFILES)})")
+
+def encode_image(img, encoder=DEFAULT_ENCODER):
+    """
+    Encodes a PIL image with the named profile. Returns bytes.
+    """
+    fmt, options, _, _ = encoder_profile(encoder)
+    if img.mode not in ("RGB", "L") and fmt == "JPEG":
+        img = img.convert("RGB")
+    start = time.perf_counter()
+    output = BytesIO()
+    with _stage("encode"):
+        img.save(output, format=fmt, **options)
+    data = output.getvalue()
+    elapsed = time.perf_counter() - start
+    with _encode_lock:
+        stats = _encode_stats.setdefault(encoder, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += len(data)
+    return data
+
+def encoder_stats():
+    """
+    Per-profile encode count, mean time (ms) and mean output size (bytes)
+    for encodes done in this process.
+    """
+    with _encode_lock:
+        return {
+            name: {"count": n, "avg_ms": secs * 1000 / n, "avg_bytes": nbytes / n}
+            for name, (n, secs, nbytes) in _encode_stats.items()
+        }
+
+_font_fingerprint_value = None
+
+def thumbnail_cache_key(anime, assets, prefer_local_bg=False, encoder=DEFAULT_ENCODER, template=None):
+    """
+    Stable hash of everything a render depends on: the anime payload, the
+    content of the downloaded images, the font set, the output encoder
+    (profile and its options), the layout template and LAYOUT_VERSION.
+    """
+    fmt, options, _, _ = encoder_profile(encoder)
+    h = hashlib.sha256()
+    h.update(f"layout={LAYOUT_VERSION};template={template_key(template_spec(template))};"
+             f"local_bg={bool(prefer_local_bg)}\n".encode())
+    h.update(f"encoder={encoder};{fmt};{json.dumps(options, sort_keys=True)}\n".encode())
+    h.update(json.dumps(anime, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    for url in sorted(assets.entries):
+        h.update(f"\n{url}={assets.digest(url) or 'missing'}".encode("utf-8"))
+    global _font_fingerprint_value
+    if _font_fingerprint_value is None:
+        _font_fingerprint_value = _font_fingerprint()
+    h.update(_font_fingerprint_value.encode("utf-8"))
+    if os.path.isfile(LOCAL_TEST_BG):
+        h.update(f"\nlocal={os.path.getmtime(LOCAL_TEST_BG)}".encode())
+    return h.hexdigest()
+
+def variant_cache_key(anime, assets, prefer_local_bg, variant, base_key=None, template=None):
+    """
+    Render cache key of one output variant: the full-size variant shares
+    thumbnail_cache_key; the others add their size and crop to it.
+    base_key: thumbnail_cache_key for variant.encoder, if already computed.
+    """
+    key = base_key or thumbnail_cache_key(anime, assets, prefer_local_bg, variant.encoder, template)
+    if _is_full_canvas(variant):
+        return key
+    return hashlib.sha256(f"{key};variant={variant.width}x{variant.height};crop={variant.crop}".encode()).hexdigest()
+
+render_mem_cache = LRUCache(max_bytes=RENDER_CACHE_MEM_BYTES, sizeof=len, name="render-mem")
+render_disk_cache = DiskStore(os.path.join(CACHE_DIR, "renders"), RENDER_CACHE_DISK_BYTES, name="render-disk")
+
+def render_cache_get(key):
+    """
+    Returns the encoded thumbnail stored under key, or None.
+    """
+    data = render_mem_cache.get(key)
+    if data is None:
+        cached = render_disk_cache.get(key)
+        if cached is None:
+            return None
+        data = cached[0]
+        render_mem_cache.put(key, data)
+    return data
+
+def render_cache_put(key, data):
+    render_mem_cache.put(key, data)
+    render_disk_cache.put(key, data)
+
+def render_cache_stats():
+    return {"memory": render_mem_cache.stats(), "disk": render_disk_cache.stats()}
+
+# ---------- Thumbnail generator ----------
+def generate_thumbnail(anime: dict, prefer_local_bg=False, use_cache=True, assets=None, encoder=None, backend=None,
+                       variants=None, deadline=None, template=None):
+    """
+    anime: dict with keys similar to AniList GraphQL result:
+      - title: {'romaji':..., 'english':...}
+      - coverImage: {'extraLarge':...}
+      - averageScore
+      - genres
+      - description
+      - status, season, seasonYear
+      - studios: {'nodes':[{'name':...}]}
+      - characters: {'nodes':[{'name':{'full':...}, 'description':..., 'image':{'large':...}}]}
+    Returns BytesIO with the image encoded by `encoder` (an ENCODER_PROFILES
+    name, DEFAULT_ENCODER if None).
+    A repeat request for the same content is answered from the render cache
+    without decoding, compositing or encoding anything.
+    assets: RenderAssets from thumbnail_assets(anime), if already fetched.
+    backend: "thread" or "process" (render_pool()); RENDER_BACKEND if None.
+    variants: a list of output variants (see output_variant(); e.g.
+    ["full", "half", "square:webp"]). Returns a list of BytesIO instead, one
+    per variant, from a single download/decode/layout pass. Each variant is
+    cached on its own, so only the missing ones are rendered.
+    deadline: a Deadline (or seconds) for fetching the assets; images that
+    miss it are drawn as placeholders (see prefetch_assets).
+    template: layout template (see template_spec); THUMB_TEMPLATE if None.
+    """
+    encoder = encoder or DEFAULT_ENCODER
+    encoder_profile(encoder)  # fail fast on unknown names
+    template = template_spec(template)
+    backend = backend or RENDER_BACKEND
+    specs = [output_variant(v, encoder) for v in (variants if variants is not None else ["full"])]
+    if assets is None:
+        assets = thumbnail_assets(anime, deadline=deadline)
+    keys = [None] * len(specs)
+    if use_cache:
+        base_keys = {}
+        for i, spec in enumerate(specs):
+            if spec.encoder not in base_keys:
+                base_keys[spec.encoder] = thumbnail_cache_key(anime, assets, prefer_local_bg, spec.encoder, template)
+            keys[i] = variant_cache_key(anime, assets, prefer_local_bg, spec, base_keys[spec.encoder], template)
+    results = [render_cache_get(key) if key else None for key in keys]
+    for key, data in zip(keys, results):
+        if key:
+            metrics.inc("render_cache_total", result="miss" if data is None else "hit")
+    missing = [i for i, data in enumerate(results) if data is None]
+    if missing:
+        todo = [specs[i] for i in missing]
+        with metrics.span("render", backend=backend, encoder=encoder):
+            if backend == "process":
+                rendered = render_pool().render(anime, assets, prefer_local_bg, variants=todo, template=template)
+            else:
+                with _stage("composite"):
+                    rendered = render_variants(anime, assets, prefer_local_bg, todo, template)
+        for i, data in zip(missing, rendered):
+            results[i] = data
+            if keys[i]:
+                render_cache_put(keys[i], data)
+    if variants is None:
+        return BytesIO(results[0])
+    return [BytesIO(data) for data in results]
+
+def render_thumbnail(anime, assets, prefer_local_bg=False, encoder=DEFAULT_ENCODER, template=None):
+    """
+    Draws the thumbnail for anime using images from assets (RenderAssets).
+    No network access, no caching. Returns the image encoded with `encoder`.
+    """
+    return encode_image(compose_thumbnail(anime, assets, prefer_local_bg, template), encoder)
+
+def render_variants(anime, assets, prefer_local_bg, variants, template=None):
+    """
+    Draws the thumbnail once and returns it encoded as each of `variants`
+    (normalized Variants), in order.
+    """
+    canvas = compose_thumbnail(anime, assets, prefer_local_bg, template)
+    return [encode_image(variant_image(canvas, v), v.encoder) for v in variants]
+
+def compose_thumbnail(anime, assets, prefer_local_bg=False, template=None):
+    """
+    The full-size RGB canvas that render_thumbnail encodes.
+    """
+    return render_plan(template).render(anime, assets, prefer_local_bg)
+
+# ---------- Memory accounting ----------
+def _proc_status_bytes(field):
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def rss_bytes():
+    """
+    Current resident set size of this process, or None where /proc is missing.
+    """
+    return _proc_status_bytes("VmRSS")
+
+def peak_rss_bytes():
+    """
+    Highest resident set size since the process started or reset_peak_rss().
+    """
+    return _proc_status_bytes("VmHWM")
+
+def reset_peak_rss():
+    """
+    Restarts the kernel's peak-RSS counter (Linux >= 4.0), so peak_rss_bytes()
+    afterwards covers only what runs from here on. False where unsupported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+# ---------- Process-pool render backend ----------
+class RenderTimeout(Exception):
+    pass
+
+def pack_render_job(anime, assets, prefer_local_bg=False, encoder=DEFAULT_ENCODER, variants=None, template=None):
+    """
+    Serializes a render job to bytes: a length-prefixed JSON header followed
+    by the raw (still encoded) image bytes, so no PIL objects are pickled.
+    variants: normalized Variants to produce instead of one `encoder` image.
+    The template travels as its spec, so workers need no registry of their own.
+    """
+    images, blobs = [], []
+    for url, entry in assets.entries.items():
+        if entry:
+            images.append([url, entry[1], len(entry[0])])
+            blobs.append(entry[0])
+        else:
+            images.append([url, None, 0])
+    header = json.dumps({"anime": anime, "prefer_local_bg": bool(prefer_local_bg), "encoder": encoder,
+                         "variants": [list(v) for v in variants] if variants is not None else None,
+                         "template": template_spec(template), "images": images},
+                        ensure_ascii=False, default=str).encode("utf-8")
+    return struct.pack("!I", len(header)) + header + b"".join(blobs)
+
+def unpack_render_job(blob):
+    """
+    Inverse of pack_render_job. Returns (anime, RenderAssets, prefer_local_bg,
+    encoder, variants, template spec); variants is None for a single-image job.
+    """
+    (header_len,) = struct.unpack_from("!I", blob)
+    offset = 4 + header_len
+    header = json.loads(blob[4:offset].decode("utf-8"))
+    entries = {}
+    for url, digest, size in header["images"]:
+        if digest is None:
+            entries[url] = None
+            continue
+        entries[url] = (blob[offset:offset + size], digest)
+        offset += size
+    variants = header.get("variants")
+    if variants is not None:
+        variants = [Variant(w, h, tuple(crop) if crop else None, enc) for w, h, crop, enc in variants]
+    return header["anime"], RenderAssets(entries), header["prefer_local_bg"], header["encoder"], variants, header["template"]
+
+_render_started = None  # worker side: queue on which jobs report that they started
+
+def _render_worker_init(started=None):
+    """
+    Runs once in each worker process: touch every font so it is loaded and
+    its glyph cache is warm before the first job arrives.
+    """
+    global _render_started
+    _render_started = started
+    scratch = ImageDraw.Draw(Image.new("RGB", (8, 8)))
+    for font in (get_font(name) for name in FONT_SPECS):
+        text_size(scratch, "ABCDEFGHIJKLMNOPQRSTUVWXYZ abcdefghijklmnopqrstuvwxyz 0123456789", font)
+
+def _render_job_started(job_id):
+    # tells the parent the job left the queue, which starts its timeout
+    if job_id is not None and _render_started is not None:
+        _render_started.put(job_id)
+
+def _render_worker(blob, job_id=None):
+    """
+    Renders one job; returns (image bytes, or a list of them for a variants
+    job, and the worker's peak RSS during the job).
+    """
+    _render_job_started(job_id)
+    anime, assets, prefer_local_bg, encoder, variants, template = unpack_render_job(blob)
+    reset_peak_rss()
+    if variants is None:
+        data = render_thumbnail(anime, assets, prefer_local_bg, encoder, template)
+    else:
+        data = render_variants(anime, assets, prefer_local_bg, variants, template)
+    return data, peak_rss_bytes()
+
+class RenderPool:
+    """
+    Pool of long-lived worker processes running render_thumbnail.
+    Workers are spawned (not forked, the parent has threads running) and warm
+    their fonts at startup. A job gets `timeout` seconds from the moment a
+    worker starts it (time spent queued does not count); past that it raises
+    RenderTimeout and the pool is restarted, since a stuck worker cannot be
+    cancelled. Other jobs lost to a restart are resubmitted once.
+    """
+
+    def __init__(self, processes=RENDER_PROCESSES, timeout=RENDER_TIMEOUT):
+        self.processes = max(1, processes)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._started = {}  # job id -> monotonic start time, None while queued
+        self._started_queues = {}  # executor -> queue its workers report started jobs on
+        self._job_ids = itertools.count()
+        self.jobs = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.resubmitted = 0
+        self.peak_rss_max = 0  # largest worker RSS seen during a job, in bytes
+        self.peak_rss_last = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                ctx = multiprocessing.get_context("spawn")
+                started = ctx.Queue()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=ctx,
+                    initializer=_render_worker_init,
+                    initargs=(started,),
+                )
+                self._started_queues[self._executor] = started
+                threading.Thread(target=self._listen, args=(started,), name="render-started", daemon=True).start()
+            return self._executor
+
+    def _listen(self, started):
+        while True:
+            try:
+                job_id = started.get()
+            except (EOFError, OSError):
+                return
+            if job_id is None:
+                return
+            with self._lock:
+                if job_id in self._started:
+                    self._started[job_id] = time.monotonic()
+
+    def _restart(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return  # someone else already restarted it
+            self._executor = None
+            self.restarts += 1
+            started = self._started_queues.pop(executor, None)
+        # ProcessPoolExecutor has no public way to kill a busy worker
+        for proc in list((getattr(executor, "_processes", None) or {}).values()):
+            proc.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if started is not None:
+            started.put(None)  # ends its listener
+
+    def _wait(self, future, job_id, timeout):
+        """
+        future's result, raising FutureTimeoutError once the job has run for
+        timeout seconds. While it is still queued, the clock has not started.
+        """
+        while True:
+            with self._lock:
+                started = self._started.get(job_id)
+            if started is None:
+                wait = 0.05
+            else:
+                wait = started + timeout - time.monotonic()
+                if wait <= 0:
+                    raise FutureTimeoutError()
+            try:
+                return future.result(timeout=wait)
+            except FutureTimeoutError:
+                continue
+
+    def render(self, anime, assets, prefer_local_bg=False, timeout=None, encoder=DEFAULT_ENCODER, variants=None,
+               template=None):
+        """
+        Renders in a worker process. Returns the encoded image bytes, or with
+        `variants` (normalized Variants) a list with one image per variant.
+        """
+        blob = pack_render_job(anime, assets, prefer_local_bg, encoder, variants, template)
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(2):
+            executor = self._get_executor()
+            job_id = next(self._job_ids)
+            with self._lock:
+                self._started[job_id] = None
+            try:
+                future = executor.submit(_render_worker, blob, job_id)
+                data, peak = self._wait(future, job_id, timeout)
+                break
+            except FutureTimeoutError:
+                logger.error(f"Render job timed out after {timeout}s; restarting render pool")
+                with self._lock:
+                    self.timeouts += 1
+                self._restart(executor)
+                raise RenderTimeout(f"render exceeded {timeout}s")
+            except (BrokenProcessPool, CancelledError) as e:
+                # a worker died, or another job's timeout restarted the pool under us
+                self._restart(executor)
+                if attempt:
+                    logger.error("Render job lost to a pool restart twice; giving up")
+                    raise BrokenProcessPool("render pool restarted while the job was in it") from e
+                logger.warning("Render job lost to a pool restart; resubmitting")
+                with self._lock:
+                    self.resubmitted += 1
+            finally:
+                with self._lock:
+                    self._started.pop(job_id, None)
+        with self._lock:
+            self.jobs += 1
+            if peak:
+                self.peak_rss_last = peak
+                self.peak_rss_max = max(self.peak_rss_max, peak)
+        return data
+
+    def stats(self):
+        """
+        Jobs done and the worker peak RSS per job (bytes): size the pool so
+        processes * peak_rss_max fits in memory.
+        """
+        with self._lock:
+            return {"processes": self.processes, "jobs": self.jobs, "timeouts": self.timeouts,
+                    "restarts": self.restarts, "resubmitted": self.resubmitted,
+                    "peak_rss_max": self.peak_rss_max, "peak_rss_last": self.peak_rss_last}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            started = self._started_queues.pop(executor, None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if started is not None:
+            started.put(None)
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def render_pool():
+    """
+    Returns the shared RenderPool (created on first use).
+    """
+    global _render_pool
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                _render_pool = RenderPool()
+    return _render_pool
+
+# ---------- AniList helper ----------
+ANILIST_QUERY = """
+query ($search: String) {
+  Media(search: $search, type: ANIME) {
+    id
+    title { romaji english }
+    coverImage { extraLarge large medium color }
+    averageScore
     genres
     description
     status
@@ -458,24 +2076,963 @@ query ($search: String) {
   }
 }
 """
+# Same selection, looked up by ID (used to refresh stale cache entries)
+ANILIST_QUERY_BY_ID = ANILIST_QUERY.replace("($search: String)", "($id: Int)").replace("search: $search", "id: $id")
+
+def normalize_search(name):
+    """
+    Canonical form of a search string so near-duplicates share a cache entry:
+    "spy x family", "Spy x Family " and "SPY×FAMILY" all become "spy x family".
+    """
+    s = unicodedata.normalize("NFKD", str(name)).replace("×", " x ")
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = re.sub(r"[^\w]+", " ", s.casefold())
+    return " ".join(s.split())
+
+class AniListCache:
+    """
+    TTL cache of AniList Media payloads keyed by ID (memory LRU in front of a
+    DiskStore), plus a persistent index from normalized search strings to IDs.
+    The index is kept in least recently used order and trimmed from the cold
+    end; changes are written out by flush(), which store() starts in the
+    background at most every flush_interval seconds.
+    """
+
+    def __init__(self, root, ttl=ANILIST_CACHE_TTL, stale_ttl=ANILIST_STALE_TTL,
+                 max_entries=ANILIST_CACHE_SIZE, max_index=ANILIST_INDEX_SIZE,
+                 disk_bytes=ANILIST_CACHE_DISK_BYTES, flush_interval=ANILIST_INDEX_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_index = max_index
+        self.flush_interval = flush_interval
+        self.media = LRUCache(max_entries=max_entries, name="anilist-media")  # id -> (payload, fetched_at)
+        self.disk = DiskStore(os.path.join(root, "anilist"), disk_bytes, name="anilist-disk")
+        self.index_path = os.path.join(root, "anilist_index.json")
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one writer of index_path at a time
+        self.index = self._load_index()  # normalized search -> id, coldest first
+        self._dirty = False
+        self._flushing = False
+        self._flushed_at = time.monotonic()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.lookup_ns = 0
+        self.flushes = 0
+        self._refreshing = set()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return OrderedDict((str(k), int(v)) for k, v in data.items())
+        except FileNotFoundError:
+            return OrderedDict()
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable AniList index {self.index_path}: {e}")
+            return OrderedDict()
+
+    def _trim_locked(self):
+        while len(self.index) > self.max_index:
+            self.index.popitem(last=False)
+
+    def flush(self):
+        """
+        Writes the index out if it changed, merged with what other processes
+        may have written since: their entries we don't have are kept as the
+        coldest. Safe to call from any thread.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    self._flushing = False
+                    return
+                self._dirty = False
+                ours = list(self.index.items())
+            on_disk = self._load_index()
+            known = {key for key, _ in ours}
+            theirs = [(key, media_id) for key, media_id in on_disk.items() if key not in known]
+            with self._lock:
+                for key, media_id in reversed(theirs):
+                    if key not in self.index:
+                        self.index[key] = media_id
+                        self.index.move_to_end(key, last=False)
+                self._trim_locked()
+                payload = json.dumps(self.index, ensure_ascii=False)
+                self._flushed_at = time.monotonic()
+                self._flushing = False
+            directory = os.path.dirname(self.index_path) or "."
+            try:
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                os.replace(tmp, self.index_path)
+            except OSError as e:
+                logger.warning(f"Could not save AniList index: {e}")
+                with self._lock:
+                    self._dirty = True
+                return
+            self.flushes += 1
+
+    def _get_media(self, media_id):
+        entry = self.media.get(media_id)
+        if entry is None:
+            cached = self.disk.get(str(media_id))
+            if cached is None:
+                return None
+            data, meta = cached
+            try:
+                entry = (json.loads(data), meta["fetched_at"])
+            except (ValueError, KeyError):
+                return None
+            self.media.put(media_id, entry)
+        return entry
+
+    def lookup(self, name):
+        """
+        Returns (payload, state) with state "fresh" or "stale", or (None, None).
+        """
+        t0 = time.perf_counter_ns()
+        key = normalize_search(name)
+        with self._lock:
+            media_id = self.index.get(key)
+            if media_id is not None:
+                self.index.move_to_end(key)  # recently searched: trimmed last
+                self._dirty = True
+        return self._lookup_id(media_id, t0)
+
+    def get(self, media_id):
+        """
+        lookup() by AniList ID.
+        """
+        return self._lookup_id(media_id, time.perf_counter_ns())
+
+    def _lookup_id(self, media_id, t0):
+        payload, state = None, None
+        if media_id is not None:
+            entry = self._get_media(media_id)
+            if entry is not None:
+                age = time.time() - entry[1]
+                if age < self.ttl:
+                    payload, state = entry[0], "fresh"
+                elif age < self.stale_ttl:
+                    payload, state = entry[0], "stale"
+        with self._lock:
+            if state == "fresh":
+                self.hits += 1
+            elif state == "stale":
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+            self.lookup_ns += time.perf_counter_ns() - t0
+        return payload, state
+
+    def store(self, payload, *names):
+        """
+        Caches payload by ID, and indexes it under each search string in names.
+        """
+        media_id = payload.get("id")
+        if media_id is None:
+            return
+        now = time.time()
+        self.media.put(media_id, (payload, now))
+        self.disk.put(str(media_id), json.dumps(payload).encode("utf-8"), {"fetched_at": now})
+        keys = {normalize_search(name) for name in names if name}
+        with self._lock:
+            for key in keys:
+                self.index[key] = media_id
+                self.index.move_to_end(key)
+            self._trim_locked()
+            if keys:
+                self._dirty = True
+            due = (self._dirty and not self._flushing
+                   and time.monotonic() - self._flushed_at >= self.flush_interval)
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self.flush, name="anilist-index-flush", daemon=True).start()
+
+    def start_refresh(self, media_id):
+        """
+        Claims a background refresh for media_id; False if one is in flight.
+        """
+        with self._lock:
+            if media_id in self._refreshing:
+                return False
+            self._refreshing.add(media_id)
+            return True
+
+    def finish_refresh(self, media_id):
+        with self._lock:
+            self._refreshing.discard(media_id)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": ((self.hits + self.stale_hits) / lookups) if lookups else 0.0,
+            "avg_lookup_us": (self.lookup_ns / lookups / 1000.0) if lookups else 0.0,
+            "index_entries": len(self.index),
+            "index_flushes": self.flushes,
+            "media": self.media.stats(),
+        }
+
+anilist_cache = AniListCache(CACHE_DIR)
+atexit.register(lambda: anilist_cache.flush())
+_anilist_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="anilist-refresh")
+
+def anilist_cache_stats():
+    return anilist_cache.stats()
+
+# ---------- AniList rate limit ----------
+class AniListRateLimited(Exception):
+    """
+    AniList is throttling us (429), or no request slot freed up in time.
+    retry_after: seconds until a request is likely to go through.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _anilist_rate(per_minute):
+    # ANILIST_BURST back-to-back requests plus the refill stay within per_minute in any minute
+    return max(1, per_minute - ANILIST_BURST) / 60
+
+anilist_limiter = RateLimiter(_anilist_rate(ANILIST_RATE_LIMIT), burst=ANILIST_BURST)
+
+def _anilist_budget(priority, timeout):
+    """
+    Budget for one AniList call: interactive calls spend at most timeout
+    seconds waiting for a slot and sending, the others wait as long as it
+    takes and then get timeout for the request itself.
+    """
+    ANILIST_PRIORITIES[priority]  # fail fast on unknown names
+    return Deadline(timeout if priority == "interactive" else None)
+
+def _anilist_slot_taken(priority, start, ok):
+    waited = time.monotonic() - start
+    metrics.observe("anilist_queue_wait_seconds", waited, priority=priority)
+    if not ok:
+        metrics.inc("anilist_throttled_total", reason="queue")
+        raise AniListRateLimited(f"no AniList request slot within {waited:.1f}s", anilist_limiter.retry_in())
+
+def _anilist_slot(priority, budget):
+    """
+    Takes a request slot from anilist_limiter within budget (a Deadline).
+    Raises AniListRateLimited when none frees up in time.
+    """
+    start = time.monotonic()
+    _anilist_slot_taken(priority, start, anilist_limiter.acquire(ANILIST_PRIORITIES[priority], budget.timeout()))
+
+async def _anilist_slot_async(priority, budget):
+    start = time.monotonic()
+    ok = await anilist_limiter.acquire_async(ANILIST_PRIORITIES[priority], budget.timeout())
+    _anilist_slot_taken(priority, start, ok)
 
-def fetch_anime_from_anilist(name, timeout=15):
+def _header_number(headers, name):
     try:
-        r = requests.post("https://graphql.anilist.co", json={"query":ANILIST_QUERY, "variables":{"search":name}}, timeout=timeout)
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after(value):
+    """
+    Seconds from a Retry-After header (delta-seconds or an HTTP date), or None.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _anilist_rate_headers(r):
+    """
+    Feeds the rate headers of an AniList response to anilist_limiter, and
+    raises AniListRateLimited for a 429 after pausing for its Retry-After.
+    """
+    headers = r.headers or {}
+    limit = _header_number(headers, "X-RateLimit-Limit")
+    if limit:
+        anilist_limiter.set_rate(_anilist_rate(limit))
+    reset_at = _header_number(headers, "X-RateLimit-Reset")  # unix time
+    reset_in = max(0.0, reset_at - time.time()) if reset_at else None
+    if r.status_code == 429:
+        wait = _retry_after(headers.get("Retry-After"))
+        if wait is None:
+            wait = reset_in if reset_in is not None else 60.0
+        anilist_limiter.pause(wait)
+        metrics.inc("anilist_throttled_total", reason="429")
+        logger.warning(f"AniList rate limit hit; pausing AniList requests for {wait:.0f}s")
+        raise AniListRateLimited(f"AniList rate limit hit, retry in {wait:.0f}s", wait)
+    anilist_limiter.update(_header_number(headers, "X-RateLimit-Remaining"), reset_in)
+
+def anilist_limiter_stats():
+    stats = anilist_limiter.stats()
+    names = {level: name for name, level in ANILIST_PRIORITIES.items()}
+    stats["waiting"] = {name: stats["waiting"].get(level, 0) for level, name in names.items()}
+    return stats
+
+# ---------- AniList client ----------
+def _anilist_post(query, variables, timeout=15, priority="interactive"):
+    """
+    POSTs a GraphQL query and returns the decoded "data" object, once
+    anilist_limiter has a slot for `priority` (see _anilist_budget).
+    Raises on transport/HTTP errors, AniListRateLimited when throttled and
+    CircuitOpen while AniList is down.
+    """
+    budget = _anilist_budget(priority, timeout)
+    _anilist_slot(priority, budget)
+    # a budget spent in the queue raises here, before the breaker sees a call
+    request_timeout = budget.timeout(timeout)
+    with _upstream(ANILIST_URL):
+        with metrics.span("anilist_request"):
+            r = http_session().post(ANILIST_URL, json={"query":query, "variables":variables},
+                                    timeout=request_timeout)
+        _anilist_rate_headers(r)
         r.raise_for_status()
-        data = r.json()
-        return data.get("data", {}).get("Media")
+    return r.json().get("data") or {}
+
+def _refresh_anilist_media(media_id, timeout=15):
+    try:
+        media = _anilist_post(ANILIST_QUERY_BY_ID, {"id": media_id}, timeout=timeout, priority="background").get("Media")
+        if media:
+            anilist_cache.store(media)
     except Exception as e:
-        logger.warning(f"AniList fetch failed for '{name}': {e}")
+        logger.warning(f"AniList refresh failed for id {media_id}: {e}")
+    finally:
+        anilist_cache.finish_refresh(media_id)
+
+def _cached_anilist_lookup(name, timeout=15):
+    """
+    Cache-only lookup; schedules a background refresh for stale entries.
+    """
+    media, state = anilist_cache.lookup(name)
+    if media is not None and state == "stale" and anilist_cache.start_refresh(media["id"]):
+        _anilist_refresh_pool.submit(contextvars.copy_context().run, _refresh_anilist_media, media["id"], timeout)
+    return media
+
+def _anilist_lookup_failed(name, e, strict=False):
+    """
+    Logs and counts a failed lookup; re-raises AniListRateLimited, which
+    callers must be able to tell apart from "not found", and with strict
+    every other failure too.
+    """
+    logger.warning(f"AniList fetch failed for '{name}': {e}")
+    result = ("throttled" if isinstance(e, AniListRateLimited) else "circuit_open" if isinstance(e, CircuitOpen)
+              else "deadline" if isinstance(e, DeadlineExceeded) else "error")
+    metrics.inc("anilist_lookups_total", result=result)
+    if strict or isinstance(e, AniListRateLimited):
+        raise e
+
+def fetch_anime_from_anilist(name, timeout=15, deadline=None, priority="interactive"):
+    """
+    Returns the AniList Media dict for a search string, or None.
+    Repeat and near-duplicate searches are answered from anilist_cache;
+    stale entries are returned immediately and refreshed in the background.
+    deadline: a Deadline (or seconds) for the whole request; the lookup takes
+    at most half of what is left, so the images get the other half.
+    priority: an ANILIST_PRIORITIES name for the rate limiter queue.
+    Raises AniListRateLimited while AniList is throttling us (rather than
+    answering None, which means "not found" to callers).
+    """
+    with metrics.span("anilist_lookup"):
+        media = _cached_anilist_lookup(name, timeout)
+        if media is not None:
+            metrics.inc("anilist_lookups_total", result="cached")
+            return media
+        try:
+            timeout = Deadline.coerce(deadline).timeout(timeout, share=0.5)
+            media = _anilist_post(ANILIST_QUERY, {"search":name}, timeout=timeout, priority=priority).get("Media")
+        except Exception as e:
+            _anilist_lookup_failed(name, e)
+            return None
+        metrics.inc("anilist_lookups_total", result="found" if media else "not_found")
+        if media:
+            anilist_cache.store(media, name)
+        return media
+
+async def _anilist_post_async(query, variables, timeout=15, priority="interactive"):
+    budget = _anilist_budget(priority, timeout)
+    await _anilist_slot_async(priority, budget)
+    request_timeout = budget.timeout(timeout)
+    with _upstream(ANILIST_URL):
+        with metrics.span("anilist_request"):
+            r = await async_http().request("POST", ANILIST_URL, json={"query":query, "variables":variables},
+                                           timeout=request_timeout)
+        _anilist_rate_headers(r)
+        r.raise_for_status()
+    return r.json().get("data") or {}
+
+async def fetch_anime_async(name, timeout=15, deadline=None, priority="interactive", strict=False):
+    """
+    fetch_anime_from_anilist on the async client (same cache, same result).
+    strict: a lookup that failed (CircuitOpen, DeadlineExceeded, transport or
+    HTTP errors) raises instead of returning None, so None only ever means
+    "not found".
+    """
+    with metrics.span("anilist_lookup"):
+        media = _cached_anilist_lookup(name, timeout)
+        if media is not None:
+            metrics.inc("anilist_lookups_total", result="cached")
+            return media
+        try:
+            timeout = Deadline.coerce(deadline).timeout(timeout, share=0.5)
+            media = (await _anilist_post_async(ANILIST_QUERY, {"search":name}, timeout=timeout, priority=priority)).get("Media")
+        except Exception as e:
+            _anilist_lookup_failed(name, e, strict)
+            return None
+        metrics.inc("anilist_lookups_total", result="found" if media else "not_found")
+        if media:
+            anilist_cache.store(media, name)
+        return media
+
+async def fetch_many_anime_async(names, concurrency=ASYNC_LOOKUP_CONCURRENCY, timeout=15, deadline=None,
+                                 priority="batch"):
+    """
+    Concurrent fetch_anime_async for many names, all on the running loop.
+    Returns dict name -> Media dict or None, in input order. Near-duplicate
+    names share one lookup; at most `concurrency` requests are in flight.
+    Lookups still running when `deadline` (a Deadline or seconds from the
+    call) is up are cancelled and answered with None, as are throttled ones.
+    """
+    deadline = Deadline.coerce(deadline)
+    limit = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(name):
+        async with limit:
+            return await fetch_anime_async(name, timeout, priority=priority)
+
+    tasks = {}
+    for name in names:
+        key = normalize_search(name)
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(one(name))
+    if tasks:
+        _, late = await asyncio.wait(tasks.values(), timeout=deadline.remaining() if deadline.bounded else None)
+        for task in late:
+            task.cancel()
+        if late:
+            logger.warning(f"AniList lookups: {len(late)} of {len(tasks)} missed the deadline")
+            await asyncio.gather(*late, return_exceptions=True)
+    return {name: _task_result(tasks[normalize_search(name)]) for name in names}
+
+def _task_result(task):
+    if task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+# ---------- AniList batch lookups ----------
+def _anilist_media_selection(query=ANILIST_QUERY):
+    """
+    Returns the "{ ... }" selection set of the Media field in query.
+    """
+    start = query.index("{", query.index("Media("))
+    depth = 0
+    for i in range(start, len(query)):
+        if query[i] == "{":
+            depth += 1
+        elif query[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return query[start:i + 1]
+    raise ValueError("Unbalanced braces in AniList query")
+
+# by -> (variable prefix, GraphQL type)
+_ANILIST_BATCH_ARGS = {"search": ("s", "String"), "id": ("i", "Int")}
+
+def build_anilist_batch_query(count, by="search"):
+    """
+    Aliased query with `count` Media(search:) fields m0..m{count-1} (or
+    Media(id:) fields with by="id"), each selecting the same fields as ANILIST_QUERY.
+    """
+    var, gql_type = _ANILIST_BATCH_ARGS[by]
+    selection = _anilist_media_selection()
+    params = ", ".join(f"${var}{i}: {gql_type}" for i in range(count))
+    fields = "\n".join(f"  m{i}: Media({by}: ${var}{i}, type: ANIME) {selection}" for i in range(count))
+    return f"query ({params}) {{\n{fields}\n}}"
+
+def _anilist_batch_post(values, timeout=15, by="search", priority="batch"):
+    """
+    Runs one aliased request. Returns (data, not_found_aliases).
+    AniList answers partial failures with an error status but still sends the
+    data for the aliases that resolved, so the body is parsed before the status.
+    """
+    query = build_anilist_batch_query(len(values), by)
+    variables = {f"{_ANILIST_BATCH_ARGS[by][0]}{i}": v for i, v in enumerate(values)}
+    budget = _anilist_budget(priority, timeout)
+    _anilist_slot(priority, budget)
+    request_timeout = budget.timeout(timeout)
+    with _upstream(ANILIST_URL):
+        r = http_session().post(ANILIST_URL, json={"query":query, "variables":variables},
+                                timeout=request_timeout)
+        _anilist_rate_headers(r)
+        try:
+            body = r.json()
+        except ValueError:
+            r.raise_for_status()
+            raise
+        data = body.get("data")
+        if data is None:
+            r.raise_for_status()
+            raise ValueError(f"AniList returned no data: {body.get('errors')}")
+    not_found = set()
+    for err in body.get("errors") or []:
+        if err.get("status") == 404 and err.get("path"):
+            not_found.add(err["path"][0])
+    return data, not_found
+
+def fetch_many_from_anilist(names, chunk_size=ANILIST_BATCH_SIZE, retries=2, timeout=15, priority="batch"):
+    """
+    Batch version of fetch_anime_from_anilist.
+    Returns dict name -> Media dict or None, in input order.
+    Cached names are answered locally; the rest are packed chunk_size at a time
+    into aliased requests. Names whose alias failed (as opposed to "not found")
+    are retried, re-batched, up to `retries` more times.
+    """
+    results = {}
+    groups = {}  # normalized search -> original names sharing one alias
+    for name in names:
+        if name in results:
+            continue
+        media = _cached_anilist_lookup(name, timeout)
+        if media is not None:
+            results[name] = media
+        else:
+            results[name] = None
+            groups.setdefault(normalize_search(name), []).append(name)
+
+    def found(name, media):
+        anilist_cache.store(media, name)
+        for same in groups[normalize_search(name)]:
+            results[same] = media
+
+    _run_anilist_batches([group[0] for group in groups.values()], found, "search", chunk_size, retries, timeout,
+                         priority)
+    anilist_cache.flush()
+    return results
+
+def fetch_many_ids_from_anilist(ids, chunk_size=ANILIST_BATCH_SIZE, retries=2, timeout=15, priority="batch"):
+    """
+    fetch_many_from_anilist for AniList IDs: dict id -> Media dict or None.
+    """
+    results = {}
+    pending = []
+    for media_id in ids:
+        media_id = int(media_id)
+        if media_id in results:
+            continue
+        media, state = anilist_cache.get(media_id)
+        results[media_id] = media
+        if media is None:
+            pending.append(media_id)
+        elif state == "stale" and anilist_cache.start_refresh(media_id):
+            _anilist_refresh_pool.submit(contextvars.copy_context().run, _refresh_anilist_media, media_id, timeout)
+
+    def found(media_id, media):
+        anilist_cache.store(media)
+        results[media_id] = media
+
+    _run_anilist_batches(pending, found, "id", chunk_size, retries, timeout, priority)
+    return results
+
+def _run_anilist_batches(pending, found, by, chunk_size, retries, timeout, priority="batch"):
+    """
+    Looks up `pending` values chunk_size at a time, calling found(value, media)
+    for each hit. Values whose alias failed (as opposed to "not found") are
+    retried, re-batched, up to `retries` more times. Chunks queue on
+    anilist_limiter at `priority`; after a 429 the next chunk waits out the
+    Retry-After there.
+    """
+    attempt = 0
+    while pending:
+        failed = []
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            try:
+                data, not_found = _anilist_batch_post(chunk, timeout=timeout, by=by, priority=priority)
+            except Exception as e:
+                logger.warning(f"AniList batch of {len(chunk)} failed: {e}")
+                failed.extend(chunk)
+                continue
+            for i, value in enumerate(chunk):
+                alias = f"m{i}"
+                media = data.get(alias)
+                if media:
+                    found(value, media)
+                elif alias not in not_found:
+                    failed.append(value)
+        attempt += 1
+        if not failed or attempt > retries:
+            for value in failed:
+                logger.warning(f"AniList batch lookup gave up on '{value}'")
+            break
+        time.sleep(0.5 * attempt)
+        pending = failed
+
+# ---------- AniList lists ----------
+# list -> (extra query parameters, media() filters)
+_ANILIST_LISTS = {
+    "trending": ("", "sort: TRENDING_DESC"),
+    "season": (", $season: MediaSeason, $seasonYear: Int", "season: $season, seasonYear: $seasonYear, sort: POPULARITY_DESC"),
+}
+
+def current_season(when=None):
+    """
+    (season, year) of AniList's anime season for a datetime (default: now).
+    December belongs to the next year's WINTER season.
+    """
+    when = when or datetime.datetime.now()
+    year = when.year + (1 if when.month == 12 else 0)
+    return ("WINTER", "WINTER", "SPRING", "SPRING", "SPRING", "SUMMER",
+            "SUMMER", "SUMMER", "FALL", "FALL", "FALL", "WINTER")[when.month - 1], year
+
+def build_anilist_list_query(kind):
+    """
+    One Page of the "trending" or "season" list, each entry selecting the
+    same fields as ANILIST_QUERY.
+    """
+    params, filters = _ANILIST_LISTS[kind]
+    return (f"query ($page: Int, $perPage: Int{params}) {{\n"
+            f"  Page(page: $page, perPage: $perPage) {{\n"
+            f"    media(type: ANIME, isAdult: false, {filters}) {_anilist_media_selection()}\n"
+            f"  }}\n}}")
+
+def fetch_anilist_list(kind, page=1, per_page=ANILIST_BATCH_SIZE, timeout=15, priority="background"):
+    """
+    One page of an AniList list ("trending" or "season": the current season
+    by popularity) as Media dicts. Each is cached and indexed under its titles,
+    so searching for one of them later needs no request.
+    """
+    variables = {"page": page, "perPage": per_page}
+    if kind == "season":
+        variables["season"], variables["seasonYear"] = current_season()
+    data = _anilist_post(build_anilist_list_query(kind), variables, timeout=timeout, priority=priority)
+    media = [m for m in ((data.get("Page") or {}).get("media") or []) if m and m.get("id")]
+    for m in media:
+        anilist_cache.store(m, *(m.get("title") or {}).values())
+    return media
+
+# ---------- Job scheduler ----------
+class _Job:
+    __slots__ = ("key", "chat_id", "fn", "context", "waiters", "created", "started")
+
+    def __init__(self, key, chat_id, fn):
+        self.key = key
+        self.chat_id = chat_id
+        self.fn = fn
+        self.context = contextvars.copy_context()  # the submitter's request ID
+        self.waiters = []  # (callback, enqueued_at, context)
+        self.created = time.monotonic()
+        self.started = None
+
+class ThumbScheduler:
+    """
+    Worker pool between the bot handlers and the render pipeline.
+    - bounded: submit() returns False once max_queue jobs (or per_chat jobs
+      for one chat) are waiting, so the caller can tell the user we're busy
+    - fair: waiting jobs are taken round-robin across chats
+    - single-flight: a request whose key matches a waiting or running job is
+      attached to it; fn runs once and every waiter's callback gets the result
+    Callbacks are called as callback(result, error) on the worker thread, in
+    the order the requests arrived. fn runs in the contextvars context of the
+    request that created the job, each callback in that of its own request.
+    """
+
+    def __init__(self, workers=BOT_WORKERS, max_queue=BOT_QUEUE_SIZE, per_chat=BOT_PER_CHAT_QUEUE):
+        self.max_queue = max_queue
+        self.per_chat = per_chat
+        self._cond = threading.Condition()
+        self._chats = OrderedDict()  # chat_id -> deque of waiting jobs
+        self._jobs = {}  # key -> waiting or running job
+        self._queued = 0
+        self._running = 0
+        self._stopped = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._recent_waits = deque(maxlen=1000)
+        self._threads = [threading.Thread(target=self._worker, name=f"thumb-worker-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        for th in self._threads:
+            th.start()
+
+    def submit(self, chat_id, key, fn, callback):
+        """
+        Queues fn() for key on behalf of chat_id. Returns False if the queue is full.
+        """
+        now = time.monotonic()
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is not None:
+                job.waiters.append((callback, now, contextvars.copy_context()))
+                self.submitted += 1
+                self.coalesced += 1
+                return True
+            chat_queue = self._chats.get(chat_id)
+            if self._queued >= self.max_queue or (chat_queue and len(chat_queue) >= self.per_chat):
+                self.rejected += 1
+                return False
+            job = _Job(key, chat_id, fn)
+            job.waiters.append((callback, now, job.context))
+            self._jobs[key] = job
+            if chat_queue is None:
+                chat_queue = self._chats[chat_id] = deque()
+            chat_queue.append(job)
+            self._queued += 1
+            self.submitted += 1
+            self._cond.notify()
+            return True
+
+    def _next_locked(self):
+        chat_id, chat_queue = self._chats.popitem(last=False)
+        job = chat_queue.popleft()
+        if chat_queue:
+            self._chats[chat_id] = chat_queue  # back of the round-robin
+        self._queued -= 1
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._chats and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                job = self._next_locked()
+                job.started = time.monotonic()
+                self._running += 1
+                wait = job.started - job.created
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self._recent_waits.append(wait)
+            result, error = None, None
+            try:
+                result = job.context.run(job.fn)
+            except Exception as e:
+                logger.exception("Job %s failed: %s", job.key, e)
+                error = e
+            with self._cond:
+                # detach before notifying: later requests start a fresh job
+                self._jobs.pop(job.key, None)
+                waiters = list(job.waiters)
+                self._running -= 1
+                if error is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            for callback, _, context in waiters:
+                try:
+                    context.run(callback, result, error)
+                except Exception as e:
+                    logger.exception("Job callback for %s failed: %s", job.key, e)
+
+    def idle(self):
+        with self._cond:
+            return not self._queued and not self._running
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._recent_waits)
+            dequeued = self.completed + self.failed + self._running
+            return {
+                "queue_depth": self._queued,
+                "running": self._running,
+                "chats_waiting": len(self._chats),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_avg_s": (self.wait_total / dequeued) if dequeued else 0.0,
+                "wait_p95_s": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max_s": self.wait_max,
+            }
+
+# ---------- Metrics ----------
+def _collect_metrics():
+    """
+    Gauges read at scrape time: cache counters and hit ratios, image fetch
+    results, encoder averages, upstream circuits, the AniList rate limiter,
+    the bot queue and memory use.
+    """
+    text_stats = textlayout.cache_stats()
+    sprite_stats = sprites.cache_stats()
+    anilist_stats = anilist_cache_stats()
+    caches = {
+        "image_memory": image_mem_cache.stats(),
+        "image_disk": image_disk_cache.stats(),
+        "render_memory": render_mem_cache.stats(),
+        "render_disk": render_disk_cache.stats(),
+        "render_plan": _render_plans.stats(),
+        "anilist_search": anilist_stats,
+        "anilist_media": anilist_stats["media"],
+        "telegram_file_id": telegram_file_ids.stats(),
+        "failed_urls": failed_urls.stats(),
+        "text_advance": text_stats["advance"],
+        "text_bbox": text_stats["bbox"],
+        "sprite_text": sprite_stats["text"],
+        "sprite_pill": sprite_stats["pill"],
+    }
+    for cache, stats in caches.items():
+        for field in ("hits", "stale_hits", "misses", "evictions", "entries", "bytes", "hit_ratio"):
+            if field in stats:
+                yield f"cache_{field}", {"cache": cache}, stats[field]
+    for name, stats in encoder_stats().items():
+        yield "encode_avg_seconds", {"encoder": name}, stats["avg_ms"] / 1000
+        yield "encode_avg_bytes", {"encoder": name}, stats["avg_bytes"]
+    limiter = anilist_limiter_stats()
+    yield "anilist_limiter_tokens", {}, limiter["tokens"]
+    yield "anilist_limiter_paused_seconds", {}, limiter["paused_s"]
+    for priority, waiting in limiter["waiting"].items():
+        yield "anilist_queue_depth", {"priority": priority}, waiting
+    for host, state in upstream_breaker.stats()["hosts"].items():
+        yield "upstream_circuit_open", {"host": host}, 0 if state == "closed" else 1
+    if bot_scheduler is not None:
+        for field, value in bot_scheduler.stats().items():
+            yield f"scheduler_{field}", {}, value
+    if _render_pool is not None:
+        pool = _render_pool.stats()
+        yield "render_worker_peak_rss_bytes", {"stat": "max"}, pool["peak_rss_max"]
+        yield "render_worker_peak_rss_bytes", {"stat": "last"}, pool["peak_rss_last"]
+    for name, value in (("process_rss_bytes", rss_bytes()), ("process_peak_rss_bytes", peak_rss_bytes())):
+        if value is not None:
+            yield name, {}, value
+
+metrics.register_collector(_collect_metrics)
+for _name, _text in (
+    ("anilist_lookup_seconds", "fetch_anime_from_anilist latency, cache included"),
+    ("anilist_request_seconds", "AniList GraphQL round-trip"),
+    ("image_request_seconds", "Image CDN round-trip (download or revalidation)"),
+    ("download_image_seconds", "download_image latency, caches included"),
+    ("render_seconds", "Render time for render cache misses"),
+    ("render_stage_seconds", "Time per render stage; composite includes the nested stages"),
+    ("telegram_send_seconds", "Telegram send_photo call, by file_id reuse or upload"),
+    ("render_worker_peak_rss_bytes", "Peak RSS of a render worker process during one job"),
+    ("thumb_request_seconds", "/thumb from message to reply"),
+    ("prewarm_item_seconds", "Prewarming one title: images, decode and (optionally) render"),
+    ("upstream_circuit_open", "1 while calls to the host are being refused (open or half-open circuit)"),
+    ("upstream_rejected_total", "Calls not made because the host's circuit was open"),
+    ("anilist_queue_wait_seconds", "Wait for an AniList rate limiter slot, by priority"),
+    ("anilist_throttled_total", "AniList calls refused: 429 from AniList, or no slot in time (queue)"),
+):
+    metrics.describe(_name, _text)
+
+def start_metrics():
+    """
+    Turns instrumentation on when configured (METRICS / METRICS_PORT): render
+    stages are timed, METRICS_PORT serves /metrics and SIGUSR1 logs a dump.
+    """
+    if not METRICS_ENABLED:
         return None
+    metrics.enable()
+    set_stage_hook(_metrics_stage)
+    metrics.install_signal_dump()
+    if METRICS_PORT:
+        return metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+    return None
 
 # ---------- Telegram Bot ----------
+bot_scheduler = None  # ThumbScheduler of the running bot (for stats)
+telegram_file_ids = DiskStore(os.path.join(CACHE_DIR, "telegram"), TELEGRAM_FILE_ID_DISK_BYTES, name="telegram-file-ids")
+
+def _is_stale_file_id_error(e):
+    # Telegram answers 400 "wrong file identifier" / "file reference expired"
+    return getattr(e, "error_code", None) == 400
+
+def _telegram_file_id_key(anime, assets, prefer_local_bg, encoder):
+    # file_ids are only valid for the bot that uploaded them
+    return f"{API_TOKEN.split(':')[0]}:{thumbnail_cache_key(anime, assets, prefer_local_bg, encoder)}"
+
+def bot_thumb_job(query, deadline=None):
+    """
+    Looks query up on AniList and renders its thumbnail, all within one
+    deadline (REQUEST_DEADLINE from now if None). Titles AniList doesn't know
+    get a minimal payload drawn over the local background. Nothing is
+    rendered if this exact thumbnail already has a Telegram file_id.
+    Returns (anime, found, assets), or the AniListRateLimited error when
+    AniList is throttling us. Hand assets to send_thumbnail so the images
+    (and any that were late) are not fetched again.
+    """
+    deadline = Deadline(REQUEST_DEADLINE) if deadline is None else Deadline.coerce(deadline)
+    try:
+        anime = fetch_anime_from_anilist(query, deadline=deadline)
+    except AniListRateLimited as e:
+        return e  # answered with "try again", not as a failed job
+    found = anime is not None
+    if found:
+        request_log.record(query, anime.get("id"))
+    else:
+        # fallback generate with minimal info
+        anime = {"title":{"english":query},"coverImage":{"extraLarge":None},"averageScore":None,"genres":[],"description":"No description available","status":"UNKNOWN"}
+    assets = thumbnail_assets(anime, deadline=deadline)
+    if not telegram_file_ids.get(_telegram_file_id_key(anime, assets, not found, BOT_ENCODER)):
+        # warms the render cache for send_thumbnail
+        generate_thumbnail(anime, prefer_local_bg=not found, assets=assets, encoder=BOT_ENCODER)
+    return anime, found, assets
+
+def send_thumbnail(bot, chat_id, anime, prefer_local_bg=False, caption=None, encoder=None, assets=None):
+    """
+    Sends the thumbnail for anime to chat_id. If the same content was uploaded
+    before, its Telegram file_id is sent instead (no render, no upload); a
+    rejected file_id is forgotten and the image is uploaded again.
+    encoder: ENCODER_PROFILES name, BOT_ENCODER if None.
+    assets: RenderAssets the thumbnail was rendered from (see bot_thumb_job);
+    fetched here if None.
+    Returns the sent Message.
+    """
+    encoder = encoder or BOT_ENCODER
+    if assets is None:
+        assets = thumbnail_assets(anime)
+    key = _telegram_file_id_key(anime, assets, prefer_local_bg, encoder)
+    cached = telegram_file_ids.get(key)
+    if cached:
+        try:
+            with metrics.span("telegram_send", via="file_id"):
+                return bot.send_photo(chat_id, cached[0].decode("ascii"), caption=caption)
+        except Exception as e:
+            if _is_stale_file_id_error(e):
+                logger.warning(f"Telegram rejected cached file_id, re-uploading: {e}")
+                telegram_file_ids.delete(key)
+            else:
+                logger.warning(f"Sending cached file_id failed, re-uploading: {e}")
+
+    img_buf = generate_thumbnail(anime, prefer_local_bg=prefer_local_bg, assets=assets, encoder=encoder)
+    img_buf.name = f"thumbnail.{encoder_profile(encoder)[3]}"
+    with metrics.span("telegram_send", via="upload"):
+        msg = bot.send_photo(chat_id, img_buf, caption=caption, timeout=120)
+    photos = getattr(msg, "photo", None) or []
+    if photos:
+        # largest size last; any size's file_id resends the original upload
+        telegram_file_ids.put(key, photos[-1].file_id.encode("ascii"))
+    return msg
+
 def run_telegram_bot():
     if telebot is None:
         logger.error("telebot package not installed. Install pyTelegramBotAPI or set NO_BOT=1")
         return
 
+    global bot_scheduler
     bot = telebot.TeleBot(API_TOKEN, parse_mode=None)
+    scheduler = bot_scheduler = ThumbScheduler()
+    start_metrics()
+    start_prewarm(scheduler.idle)
 
     @bot.message_handler(commands=['start'])
     def cmd_start(m):
@@ -488,28 +3045,50 @@ def run_telegram_bot():
         if not query:
             bot.reply_to(m, "❌ Usage: /thumb Spy x Family")
             return
+        metrics.new_request_id()
+        received = time.monotonic()
+        logger.info(f"/thumb {query!r} from chat {m.chat.id}")
         # Inform user
         try:
             bot.send_chat_action(m.chat.id, "upload_photo")
         except Exception:
             pass
 
-        # fetch AniList
-        anime = fetch_anime_from_anilist(query)
-        if not anime:
-            bot.reply_to(m, f"❌ Couldn't find anime: {query}\nTrying with local sample image.")
-            # fallback generate with minimal info
-            anime = {"title":{"english":query},"coverImage":{"extraLarge":None},"averageScore":None,"genres":[],"description":"No description available","status":"UNKNOWN"}
-            img_buf = generate_thumbnail(anime, prefer_local_bg=True)
-        else:
-            img_buf = generate_thumbnail(anime)
+        # fetch + render once per distinct query, however many chats ask for it
+        def job():
+            # the budget starts when a worker picks the job up, not while it queues
+            return bot_thumb_job(query)
 
-        # send
-        try:
-            bot.send_photo(m.chat.id, img_buf, caption=f"🎬 {anime.get('title',{}).get('english') or anime.get('title',{}).get('romaji')}", timeout=120)
-        except Exception as e:
-            logger.exception("Failed to send photo: %s", e)
-            bot.reply_to(m, "❌ Failed to send generated image. Try again later.")
+        def deliver(result, error):
+            outcome = _deliver(result, error)
+            metrics.inc("thumb_requests_total", result=outcome)
+            metrics.observe("thumb_request_seconds", time.monotonic() - received, result=outcome)
+            logger.info(f"/thumb {query!r} {outcome} in {time.monotonic() - received:.2f}s")
+
+        def _deliver(result, error):
+            if error is not None:
+                bot.reply_to(m, "❌ Failed to generate image. Try again later.")
+                return "render_error"
+            if isinstance(result, AniListRateLimited):
+                when = f"in {math.ceil(result.retry_after)}s" if result.retry_after else "in a minute"
+                bot.reply_to(m, f"⏳ AniList is rate-limiting lookups right now. Please try again {when}.")
+                return "throttled"
+            anime, found, assets = result
+            if not found:
+                bot.reply_to(m, f"❌ Couldn't find anime: {query}\nTrying with local sample image.")
+            # send (reuses the Telegram file_id when this exact thumbnail was sent before)
+            try:
+                caption = f"🎬 {anime.get('title',{}).get('english') or anime.get('title',{}).get('romaji')}"
+                send_thumbnail(bot, m.chat.id, anime, prefer_local_bg=not found, caption=caption, assets=assets)
+            except Exception as e:
+                logger.exception("Failed to send photo: %s", e)
+                bot.reply_to(m, "❌ Failed to send generated image. Try again later.")
+                return "send_error"
+            return "ok" if found else "not_found"
+
+        if not scheduler.submit(m.chat.id, normalize_search(query), job, deliver):
+            metrics.inc("thumb_requests_total", result="busy")
+            bot.reply_to(m, "⏳ The bot is busy right now. Please try again in a minute.")
 
     @bot.message_handler(func=lambda message: True)
     def catch_all(m):
@@ -526,10 +3105,714 @@ def run_telegram_bot():
     bot.infinity_polling()
 
 
+# ---------- HTTP API server ----------
+def _etag_matches(if_none_match, etag):
+    """
+    True if an If-None-Match header value matches etag (weak comparison).
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+def _parse_flag(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+class ThumbServer:
+    """
+    aiohttp application serving thumbnails:
+    - GET /thumb?q=<search>   AniList search, then render
+    - POST /render            body: an AniList Media object (or {"data": {"Media": ...}})
+    Both take ?encoder=<profile> and ?local_bg=1. Responses carry the render
+    cache key as ETag, so a matching If-None-Match gets 304 without rendering.
+    AniList lookups and image downloads are async on the server's loop (one
+    pooled AsyncHTTP session); rendering runs on a thread pool, never on the
+    loop. Identical renders in flight are shared, and past `max_pending`
+    requests in progress the server answers 503.
+    """
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, workers=SERVER_WORKERS, max_pending=SERVER_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="api-render")
+        self.max_pending = max_pending
+        self.pending = 0
+        self._inflight = {}  # render key -> Future with the encoded image
+
+    def app(self):
+        @web.middleware
+        async def middleware(request, handler):
+            return await self._instrumented(request, handler)
+
+        app = web.Application(client_max_size=SERVER_MAX_BODY, middlewares=[middleware])
+        app.router.add_get("/thumb", self.handle_thumb)
+        app.router.add_post("/render", self.handle_render)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.on_response_prepare.append(self._add_request_id)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _cleanup(self, app):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        await async_http().close()
+
+    async def _add_request_id(self, request, response):
+        response.headers["X-Request-ID"] = metrics.request_id.get()
+
+    async def _instrumented(self, request, handler):
+        metrics.new_request_id()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "other"
+        status = 500
+        with metrics.span("api_request", route=route):
+            try:
+                response = await handler(request)
+                status = response.status
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            except Exception as e:
+                logger.exception("API request %s %s failed: %s", request.method, request.path_qs, e)
+                response = web.json_response({"error": "internal error"}, status=500)
+            finally:
+                metrics.inc("api_responses_total", route=route, status=status)
+        return response
+
+    async def _run(self, fn, *args, **kwargs):
+        # contextvars (the request ID) don't follow run_in_executor by themselves
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    def _options(self, request):
+        encoder = request.query.get("encoder") or DEFAULT_ENCODER
+        if encoder not in ENCODER_PROFILES:
+            raise web.HTTPBadRequest(text=json.dumps({"error": f"unknown encoder {encoder!r}", "encoders": list(ENCODER_PROFILES)}),
+                                     content_type="application/json")
+        return encoder, _parse_flag(request.query.get("local_bg", ""))
+
+    def _admit(self):
+        if self.pending >= self.max_pending:
+            raise web.HTTPServiceUnavailable(text=json.dumps({"error": "busy"}), content_type="application/json",
+                                             headers={"Retry-After": "1"})
+        self.pending += 1
+
+    async def handle_thumb(self, request):
+        query = (request.query.get("q") or "").strip()
+        if not query:
+            return web.json_response({"error": "missing ?q="}, status=400)
+        encoder, prefer_local_bg = self._options(request)
+        self._admit()
+        try:
+            deadline = Deadline(REQUEST_DEADLINE)
+            try:
+                anime = await fetch_anime_async(query, deadline=deadline, strict=True)
+            except AniListRateLimited as e:
+                return web.json_response({"error": "AniList rate limit, try again later"}, status=503,
+                                         headers={"Retry-After": str(math.ceil(e.retry_after or 1))})
+            except CircuitOpen as e:
+                return web.json_response({"error": "AniList is unavailable, try again later"}, status=503,
+                                         headers={"Retry-After": str(max(1, math.ceil(e.retry_after or 1)))})
+            except TimeoutError:
+                # DeadlineExceeded, or the request itself timing out
+                return web.json_response({"error": "AniList lookup timed out"}, status=504)
+            except Exception:
+                return web.json_response({"error": "AniList lookup failed"}, status=502)
+            if anime is None:
+                return web.json_response({"error": f"anime not found: {query}"}, status=404)
+            request_log.record(query, anime.get("id"))
+            return await self._respond(request, anime, encoder, prefer_local_bg, deadline)
+        finally:
+            self.pending -= 1
+
+    async def handle_render(self, request):
+        encoder, prefer_local_bg = self._options(request)
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": "body is not JSON"}, status=400)
+        if isinstance(body, dict) and isinstance(body.get("data"), dict):
+            body = body["data"].get("Media")
+        elif isinstance(body, dict) and isinstance(body.get("Media"), dict):
+            body = body["Media"]
+        if not isinstance(body, dict) or not isinstance(body.get("title"), dict):
+            return web.json_response({"error": "expected an AniList Media object with a title"}, status=400)
+        self._admit()
+        try:
+            return await self._respond(request, body, encoder, prefer_local_bg, Deadline(REQUEST_DEADLINE))
+        finally:
+            self.pending -= 1
+
+    async def handle_health(self, request):
+        return web.json_response({"ok": True, "pending": self.pending, "rendering": len(self._inflight)})
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    def _render(self, key, anime, assets, prefer_local_bg, encoder):
+        """
+        Future with the encoded image; concurrent requests for the same key share one.
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(
+                lambda: generate_thumbnail(anime, prefer_local_bg=prefer_local_bg, assets=assets, encoder=encoder).getvalue()))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: a client that goes away must not cancel a render others wait for
+        return asyncio.shield(future)
+
+    async def _respond(self, request, anime, encoder, prefer_local_bg, deadline=None):
+        assets = await thumbnail_assets_async(anime, deadline=deadline)
+        key = await self._run(thumbnail_cache_key, anime, assets, prefer_local_bg, encoder)
+        etag = f'"{key}"'
+        # placeholders for images that missed the deadline: fine now, not for an hour
+        cache_control = "no-cache" if assets.late else f"public, max-age={SERVER_CACHE_MAX_AGE}"
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if _etag_matches(request.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=headers)
+        data = await self._render(key, anime, assets, prefer_local_bg, encoder)
+        response = web.StreamResponse(headers=headers)
+        response.content_type = encoder_profile(encoder)[2]
+        response.content_length = len(data)
+        await response.prepare(request)
+        view = memoryview(data)
+        for offset in range(0, len(data), self.CHUNK):
+            await response.write(view[offset:offset + self.CHUNK])
+        await response.write_eof()
+        return response
+
+def run_server(host=SERVER_HOST, port=SERVER_PORT):
+    if web is None:
+        logger.error("aiohttp package not installed. Install aiohttp to use `serve`")
+        return
+    start_metrics()
+    server = ThumbServer()
+    app = server.app()
+    start_prewarm(lambda: server.pending == 0)
+    logger.info(f"Thumbnail API listening on http://{host}:{port} (GET /thumb?q=..., POST /render)")
+    web.run_app(app, host=host, port=port, print=None)
+
+# ---------- Batch rendering ----------
+def parse_batch_line(line):
+    """
+    One input line -> {"search": title} or {"id": anilist_id}; None for blank
+    lines and #comments. Plain text is a title, even if it is a number
+    ("id:<n>" is an ID). JSON lines may be a string or an object with
+    "id"/"anilist_id" or "title"/"search"/"name"/"query".
+    Raises ValueError for anything else.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    value = json.loads(line) if line[0] in '{["' else line
+    if isinstance(value, dict):
+        for field in ("id", "anilist_id"):
+            media_id = value.get(field)
+            if isinstance(media_id, int) and not isinstance(media_id, bool):
+                return {"id": media_id}
+            if isinstance(media_id, str) and media_id.strip().isdigit():
+                return {"id": int(media_id)}
+        for field in ("title", "search", "name", "query"):
+            title = value.get(field)
+            if isinstance(title, dict):
+                title = title.get("english") or title.get("romaji")
+            if isinstance(title, str) and title.strip():
+                return {"search": title.strip()}
+        raise ValueError("object has no id or title")
+    if isinstance(value, str):
+        m = re.fullmatch(r"id:\s*(\d+)", value.strip(), re.IGNORECASE)
+        if m:
+            return {"id": int(m.group(1))}
+        if value.strip():
+            return {"search": value.strip()}
+    raise ValueError(f"expected a title or an AniList ID, got {value!r}")
+
+def read_batch_items(path):
+    """
+    Reads a batch input file. Returns (items, errors): items are unique by
+    "key" (id:<n> or q:<normalized title>) and carry their "line" number;
+    errors are (line, message) for lines that could not be parsed.
+    """
+    items, errors, seen = [], [], set()
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                item = parse_batch_line(line)
+            except ValueError as e:
+                errors.append((lineno, str(e)))
+                continue
+            if item is None:
+                continue
+            item["key"] = f"id:{item['id']}" if "id" in item else f"q:{normalize_search(item['search'])}"
+            if item["key"] not in seen:
+                seen.add(item["key"])
+                item["line"] = lineno
+                items.append(item)
+    return items, errors
+
+class BatchCheckpoint:
+    """
+    Append-only JSONL record of finished batch items, flushed line by line so
+    a killed run loses at most the items it was working on. The last record
+    for a key wins; only "ok" records whose file still exists count as done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a kill
+                    if isinstance(record, dict) and "key" in record:
+                        self.records[record["key"]] = record
+
+    def done(self, key, out_dir):
+        record = self.records.get(key)
+        return bool(record and record.get("status") == "ok"
+                    and os.path.isfile(os.path.join(out_dir, record.get("file", ""))))
+
+    def record(self, key, **fields):
+        record = dict(key=key, **fields, at=round(time.time(), 3))
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                torn = False
+                if os.path.isfile(self.path) and os.path.getsize(self.path):
+                    with open(self.path, "rb") as f:
+                        f.seek(-1, os.SEEK_END)
+                        torn = f.read(1) != b"\n"
+                self._file = open(self.path, "a", encoding="utf-8")
+                if torn:
+                    self._file.write("\n")  # don't glue onto a half-written line
+            self._file.write(line)
+            self._file.flush()
+            self.records[key] = record
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def batch_filename(anime, encoder):
+    """
+    <anilist id>-<title slug>.<ext> for a rendered thumbnail.
+    """
+    title = (anime.get("title") or {}).get("english") or (anime.get("title") or {}).get("romaji") or "untitled"
+    slug = unicodedata.normalize("NFKD", str(title)).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "-", slug.lower()).strip("-")[:60].rstrip("-") or "untitled"
+    return f"{anime.get('id', 'x')}-{slug}.{encoder_profile(encoder)[3]}"
+
+def _write_file_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+def _resolve_batch_items(items, timeout=15):
+    """
+    [(item, Media dict or None)] with titles and IDs each looked up in batches.
+    """
+    searches = [item["search"] for item in items if "search" in item]
+    ids = [item["id"] for item in items if "id" in item]
+    by_search = fetch_many_from_anilist(searches, timeout=timeout) if searches else {}
+    by_id = fetch_many_ids_from_anilist(ids, timeout=timeout) if ids else {}
+    return [(item, by_id.get(item["id"]) if "id" in item else by_search.get(item["search"])) for item in items]
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+class _BatchProgress:
+    """
+    Counts finished items and prints a progress line at most every `every` seconds.
+    """
+
+    def __init__(self, total, stream, every=2.0):
+        self.total = total
+        self.stream = stream
+        self.every = every
+        self.ok = 0
+        self.failed = 0
+        self.start = self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, ok):
+        with self._lock:
+            if ok:
+                self.ok += 1
+            else:
+                self.failed += 1
+            now = time.monotonic()
+            if self.stream is None or (now - self._last < self.every and self.ok + self.failed < self.total):
+                return
+            self._last = now
+            done = self.ok + self.failed
+            rate = done / max(now - self.start, 1e-9)
+            eta = _format_duration((self.total - done) / rate) if rate else "?"
+            print(f"batch: {done}/{self.total} (ok {self.ok}, failed {self.failed}), "
+                  f"{rate:.2f}/s, eta {eta}", file=self.stream, flush=True)
+
+def run_batch(items, out_dir, encoder=None, backend="process", workers=None, checkpoint_path=None,
+              prefer_local_bg=False, lookup_chunk=BATCH_LOOKUP_CHUNK, progress=sys.stderr):
+    """
+    Renders items (from read_batch_items) into out_dir as batch_filename() files.
+    Items already recorded in the checkpoint (out_dir/BATCH_CHECKPOINT by
+    default) are skipped, so a killed run picks up where it stopped. Metadata
+    is resolved lookup_chunk items at a time with aliased AniList requests;
+    `workers` items are downloaded and rendered at once, on render_pool()
+    processes with backend="process". Renders bypass the render cache.
+    Returns a summary dict; Ctrl+C stops after the items in progress.
+    """
+    encoder = encoder or DEFAULT_ENCODER
+    encoder_profile(encoder)
+    if workers is None:
+        workers = render_pool().processes * 2 if backend == "process" else (os.cpu_count() or 1)
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = BatchCheckpoint(checkpoint_path or os.path.join(out_dir, BATCH_CHECKPOINT))
+    todo = [item for item in items if not checkpoint.done(item["key"], out_dir)]
+    tracker = _BatchProgress(len(todo), progress)
+    failures = []
+    failures_lock = threading.Lock()
+
+    def fail(item, error):
+        checkpoint.record(item["key"], status="failed", error=error)
+        with failures_lock:
+            failures.append({"line": item.get("line"), "key": item["key"], "error": error})
+        tracker.add(False)
+
+    def render(item, anime):
+        try:
+            data = generate_thumbnail(anime, prefer_local_bg, use_cache=False, encoder=encoder, backend=backend).getvalue()
+            name = batch_filename(anime, encoder)
+            _write_file_atomic(os.path.join(out_dir, name), data)
+        except Exception as e:
+            logger.warning(f"Batch item {item['key']} failed: {e}")
+            fail(item, f"{type(e).__name__}: {e}")
+            return
+        checkpoint.record(item["key"], status="ok", id=anime.get("id"), file=name, bytes=len(data))
+        tracker.add(True)
+
+    interrupted = False
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch")
+    try:
+        futures = []
+        for start in range(0, len(todo), max(1, lookup_chunk)):
+            for item, anime in _resolve_batch_items(todo[start:start + lookup_chunk]):
+                if anime is None:
+                    fail(item, "no AniList match")
+                else:
+                    futures.append(pool.submit(contextvars.copy_context().run, render, item, anime))
+        for future in futures:
+            future.result()
+    except KeyboardInterrupt:
+        interrupted = True
+        logger.warning("Batch interrupted; finishing the items in progress")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        checkpoint.close()
+    elapsed = time.monotonic() - tracker.start
+    return {
+        "total": len(items),
+        "skipped": len(items) - len(todo),
+        "ok": tracker.ok,
+        "failed": tracker.failed,
+        "failures": sorted(failures, key=lambda f: f["line"] or 0),
+        "seconds": elapsed,
+        "per_sec": tracker.ok / elapsed if elapsed > 0 else 0.0,
+        "workers": workers,
+        "backend": backend,
+        "interrupted": interrupted,
+        "out_dir": out_dir,
+        "checkpoint": checkpoint.path,
+    }
+
+def print_batch_report(summary, input_errors=()):
+    s = summary
+    print(f"Batch {'interrupted' if s['interrupted'] else 'finished'} in {_format_duration(s['seconds'])}: "
+          f"{s['ok']} rendered, {s['failed']} failed, {s['skipped']} already done")
+    print(f"Throughput: {s['per_sec']:.2f} thumbnails/s ({s['workers']} workers, {s['backend']} backend)")
+    if input_errors:
+        print(f"Unreadable input lines ({len(input_errors)}):")
+        for lineno, message in input_errors:
+            print(f"  line {lineno}: {message}")
+    if s["failures"]:
+        print(f"Failures ({len(s['failures'])}):")
+        for f in s["failures"]:
+            print(f"  line {f['line']}: {f['key']}: {f['error']}")
+    print(f"Output in {s['out_dir']} (checkpoint {s['checkpoint']}); rerun the same command to retry failures.")
+
+def cli_batch(argv):
+    """
+    `python thumbnail.py batch INPUT [-o DIR] ...`; returns the exit status.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="thumbnail.py batch",
+                                     description="Render thumbnails for every title or AniList ID in a file.")
+    parser.add_argument("input", help="text file (one title or id:<n> per line) or JSONL")
+    parser.add_argument("-o", "--out", default="thumbnails", help="output directory (default: thumbnails)")
+    parser.add_argument("--encoder", default=DEFAULT_ENCODER, choices=list(ENCODER_PROFILES))
+    parser.add_argument("--backend", default="process", choices=("process", "thread"))
+    parser.add_argument("--workers", type=int, default=None,
+                        help="items in progress at once (default: 2 per render process, or CPU count)")
+    parser.add_argument("--checkpoint", default=None, help=f"checkpoint file (default: OUT/{BATCH_CHECKPOINT})")
+    parser.add_argument("--local-bg", action="store_true", help="use the local test background")
+    args = parser.parse_args(argv)
+    items, errors = read_batch_items(args.input)
+    summary = run_batch(items, args.out, encoder=args.encoder, backend=args.backend, workers=args.workers,
+                        checkpoint_path=args.checkpoint, prefer_local_bg=args.local_bg)
+    if args.backend == "process":
+        render_pool().shutdown()
+    print_batch_report(summary, errors)
+    return 1 if summary["failed"] or errors or summary["interrupted"] else 0
+
+# ---------- Request log ----------
+class RequestLog:
+    """
+    Append-only JSON-lines log of searches that found a title: time, AniList
+    ID and normalized search. Past max_bytes the file is rotated to
+    <path>.1 (one generation kept). Appends are single writes, so several
+    processes can share the file.
+    """
+
+    def __init__(self, path, max_bytes=REQUEST_LOG_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def record(self, query, media_id):
+        if media_id is None:
+            return
+        line = json.dumps({"t": round(time.time()), "id": media_id, "q": normalize_search(query)}) + "\n"
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                    size = f.tell()
+                if size > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+            except OSError as e:
+                logger.warning(f"Could not write request log {self.path}: {e}")
+
+    def popular(self, limit=PREWARM_LIMIT, window=REQUEST_LOG_WINDOW):
+        """
+        AniList IDs requested in the last `window` seconds, most requested first.
+        """
+        since = time.time() - window
+        counts = {}
+        for path in (self.path + ".1", self.path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            if entry["t"] >= since:
+                                counts[int(entry["id"])] = counts.get(int(entry["id"]), 0) + 1
+                        except (ValueError, KeyError, TypeError):
+                            continue  # torn or foreign line
+            except FileNotFoundError:
+                continue
+        return sorted(counts, key=counts.get, reverse=True)[:limit]
+
+request_log = RequestLog(os.path.join(CACHE_DIR, "requests.jsonl"))
+
+# ---------- Prewarming ----------
+class _PrewarmBudget:
+    """
+    AniList requests a prewarm run may still send.
+    """
+
+    def __init__(self, requests):
+        self.left = requests
+
+    def take(self, n=1):
+        if self.left < n:
+            return False
+        self.left -= n
+        return True
+
+def _wait_idle(idle, stop, poll=1.0):
+    """
+    Blocks until idle() is true; False if stop was set first.
+    """
+    while not (stop is not None and stop.is_set()):
+        if idle is None or idle():
+            return True
+        time.sleep(poll) if stop is None else stop.wait(poll)
+    return False
+
+def prewarm_candidates(sources, limit, budget, idle=None, stop=None):
+    """
+    Media dicts to warm, from each source in turn ("log", "trending",
+    "season"), at most `limit` per source, without duplicates. AniList
+    requests are taken from budget (a _PrewarmBudget); a source that runs
+    out of budget contributes what it got so far.
+    """
+    found = OrderedDict()  # id -> Media
+    for source in sources:
+        got = 0
+        if source == "log":
+            ids = [i for i in request_log.popular(limit) if i not in found]
+            missing = [i for i in ids if anilist_cache.get(i)[0] is None]
+            affordable = min(len(missing), budget.left * ANILIST_BATCH_SIZE)
+            budget.take(math.ceil(affordable / ANILIST_BATCH_SIZE))
+            skip = set(missing[affordable:])
+            if _wait_idle(idle, stop):
+                by_id = fetch_many_ids_from_anilist([i for i in ids if i not in skip], retries=0, priority="background")
+                for media_id in ids:
+                    if by_id.get(media_id):
+                        found[media_id] = by_id[media_id]
+                        got += 1
+        elif source in _ANILIST_LISTS:
+            page, per_page = 1, min(ANILIST_BATCH_SIZE, limit)
+            while got < limit and _wait_idle(idle, stop) and budget.take():
+                try:
+                    media = fetch_anilist_list(source, page, per_page)
+                except Exception as e:
+                    logger.warning(f"Prewarm: AniList {source} list failed: {e}")
+                    break
+                for m in media:
+                    if m["id"] not in found and got < limit:
+                        found[m["id"]] = m
+                        got += 1
+                if len(media) < per_page:
+                    break  # last page
+                page += 1
+        else:
+            logger.warning(f"Prewarm: unknown source {source!r}")
+        logger.info(f"Prewarm: {got} titles from {source}")
+    return list(found.values())
+
+def prewarm_images(anime, assets, template=None):
+    """
+    Decodes the image crops the template will ask for into the memory LRU.
+    Returns how many are warm.
+    """
+    fields = layout_fields(anime)
+    warm = 0
+    for names, size in render_plan(template).image_slots():
+        for name in names:
+            url = fields.get(name)
+            if url and assets.cover(url, *size) is not None:
+                warm += 1
+                break
+    return warm
+
+def run_prewarm(sources=None, limit=PREWARM_LIMIT, rate=PREWARM_RATE, anilist_budget=PREWARM_ANILIST_BUDGET,
+                render=PREWARM_RENDER, encoder=None, idle=None, stop=None):
+    """
+    Warms the caches for the most likely next requests: AniList metadata,
+    downloaded and decoded images, and with render=True the finished
+    thumbnail (encoded with `encoder`, BOT_ENCODER by default). AniList calls
+    use the "background" priority and at most anilist_budget requests; titles
+    are warmed at most `rate` per minute (no pacing if rate <= 0), each only
+    once idle() is true. Setting the stop event ends the run early. Returns a
+    summary dict.
+    """
+    sources = sources or [s.strip() for s in PREWARM_SOURCES.split(",") if s.strip()]
+    encoder = encoder or BOT_ENCODER
+    start = time.monotonic()
+    budget = _PrewarmBudget(anilist_budget)
+    pace = RateLimiter(rate / 60, burst=1) if rate > 0 else None
+    summary = {"titles": 0, "warmed": 0, "images": 0, "rendered": 0, "failed": 0, "anilist_requests": 0, "stopped": False}
+    candidates = prewarm_candidates(sources, limit, budget, idle, stop)
+    summary["titles"] = len(candidates)
+    for anime in candidates:
+        if pace:
+            pace.acquire()
+        if not _wait_idle(idle, stop):
+            break
+        try:
+            with metrics.span("prewarm_item"):
+                assets = thumbnail_assets(anime)
+                summary["images"] += prewarm_images(anime, assets)
+                if render:
+                    generate_thumbnail(anime, assets=assets, encoder=encoder)
+                    summary["rendered"] += 1
+            summary["warmed"] += 1
+        except Exception as e:
+            logger.warning(f"Prewarm failed for AniList id {anime.get('id')}: {e}")
+            summary["failed"] += 1
+    anilist_cache.flush()  # the titles prewarm indexed
+    summary["anilist_requests"] = anilist_budget - budget.left
+    summary["stopped"] = stop is not None and stop.is_set()
+    summary["seconds"] = time.monotonic() - start
+    metrics.inc("prewarm_titles_total", summary["warmed"], result="warmed")
+    metrics.inc("prewarm_titles_total", summary["failed"], result="failed")
+    logger.info(f"Prewarm: warmed {summary['warmed']}/{summary['titles']} titles ({summary['images']} images, "
+                f"{summary['rendered']} renders, {summary['anilist_requests']} AniList requests) "
+                f"in {summary['seconds']:.1f}s")
+    return summary
+
+def start_prewarm(idle, interval=PREWARM_INTERVAL, **kwargs):
+    """
+    Runs run_prewarm(idle=idle, **kwargs) every `interval` seconds on a
+    daemon thread. The first run starts right away when the AniList cache is
+    empty (a fresh deploy), otherwise after one interval. Returns the event
+    that stops it, or None when interval is 0.
+    """
+    if interval <= 0:
+        return None
+    stop = threading.Event()
+
+    def loop():
+        delay = 0 if not anilist_cache.index else interval
+        while not stop.wait(delay):
+            try:
+                run_prewarm(idle=idle, stop=stop, **kwargs)
+            except Exception as e:
+                logger.exception("Prewarm run failed: %s", e)
+            delay = interval
+
+    threading.Thread(target=loop, name="prewarm", daemon=True).start()
+    return stop
+
+def cli_prewarm(argv):
+    """
+    `python thumbnail.py prewarm [--source log,trending,season] [--limit N] [--render]`
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="thumbnail.py prewarm", description="Warm the caches for popular titles.")
+    parser.add_argument("--source", default=PREWARM_SOURCES, help=f"comma-separated sources (default {PREWARM_SOURCES})")
+    parser.add_argument("--limit", type=int, default=PREWARM_LIMIT, help="titles per source")
+    parser.add_argument("--rate", type=float, default=PREWARM_RATE, help="titles per minute (0: no pacing)")
+    parser.add_argument("--anilist-budget", type=int, default=PREWARM_ANILIST_BUDGET, help="max AniList requests")
+    parser.add_argument("--render", action="store_true", default=PREWARM_RENDER, help="also render thumbnails")
+    parser.add_argument("--encoder", default=BOT_ENCODER, choices=sorted(ENCODER_PROFILES))
+    args = parser.parse_args(argv)
+    summary = run_prewarm([s.strip() for s in args.source.split(",") if s.strip()], args.limit, args.rate,
+                          args.anilist_budget, args.render, args.encoder)
+    print(json.dumps(summary, indent=2))
+    return 0 if not summary["failed"] else 1
+
 # ---------- CLI quick test ----------
-def cli_test():
-    print("CLI test: generate thumbnail for 'SPY x FAMILY' using local background if available.")
-    sample = fetch_anime_from_anilist("Spy x Family") or {
+def _cli_sample():
+    try:
+        anime = fetch_anime_from_anilist("Spy x Family")
+    except AniListRateLimited as e:
+        logger.warning(f"{e}; using the built-in sample")
+        anime = None
+    return anime or {
         "title": {"english":"Spy x Family", "romaji":"Spy x Family"},
         "coverImage": {"extraLarge": None},
         "averageScore": 85,
@@ -541,14 +3824,47 @@ def cli_test():
         "studios":{"nodes":[{"name":"WIT STUDIO"}]},
         "characters": {"nodes": [{"name": {"full": "Anya Forger"}, "description": "Anya is a young girl who can read people's thoughts and is the only one who escaped from an experimental human test subject dubbed '007'. She likes spy missions and thinks anything involving 'secrets' and 'missions' are exciting.", "image": {"large": None}}]}
     }
+
+def cli_test():
+    print("CLI test: generate thumbnail for 'SPY x FAMILY' using local background if available.")
+    sample = _cli_sample()
     buf = generate_thumbnail(sample, prefer_local_bg=True)
     out_path = "anime_mayhem_thumb_test.png"
     with open(out_path, "wb") as f:
         f.write(buf.getbuffer())
     print(f"Saved test thumbnail to {out_path}. Open it to inspect. Fonts folder used: {FONTS_DIR}")
 
+def cli_encoders(repeat=3):
+    """
+    Renders the CLI sample once per encoder profile and prints encode time
+    and output size, to choose a profile from measurements.
+    """
+    sample = _cli_sample()
+    assets = thumbnail_assets(sample)
+    print(f"{'encoder':<15} {'encode ms':>10} {'bytes':>10}")
+    for name in ENCODER_PROFILES:
+        for _ in range(repeat):
+            render_thumbnail(sample, assets, prefer_local_bg=True, encoder=name)
+        stats = encoder_stats()[name]
+        print(f"{name:<15} {stats['avg_ms']:>10.1f} {stats['avg_bytes']:>10.0f}")
+
 # ---------- Main ----------
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "encoders":
+        cli_encoders()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "batch":
+        sys.exit(cli_batch(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "prewarm":
+        sys.exit(cli_prewarm(sys.argv[2:]))
+
+    # `serve` runs the HTTP API instead of the bot
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "serve":
+        run_server()
+        sys.exit(0)
+
     # If first arg is "test", run cli_test()
     if len(sys.argv) > 1 and sys.argv[1].lower() in ("test","local"):
         cli_test()